@@ -25,6 +25,7 @@ if __name__ == '__main__':
     # pi_controller = PIController("172.23.82.5", 4011)
     # Ethernet
     #pi_controller = PIController.PIController("172.23.82.249", 50000, debug=False)
+    # Other connections and several stages are described in the manual
     pi_controller = PIController.PIController("Fake address 01", 50000,
                                               debug=True)
 
@@ -1,14 +1,70 @@
+import hashlib
+
+
 class CommandStore:
-    """Store a set of commands, add to it and clear it"""
+    """Store a set of commands, add to it and clear it.
+
+    Commands are appended to a bytearray, so adding stays cheap however many
+    commands there are, and the size of the store is counted as we go.
+    Commands can be added under a group name, so that groups which have not
+    changed since they were last sent can be left out of the next upload."""
 
     def __init__(self):
-        self.commands = ""
+        self.clear()
 
-    def add(self, command):
+    def add(self, command, group=None):
+        start = len(self.commands)
         self.commands += command
+        self.lines += command.count("\n")
+
+        # Runs of commands in the same group are kept as one span
+        if len(self.spans) > 0 and self.spans[-1][0] == group:
+            self.spans[-1][2] = len(self.commands)
+        else:
+            self.spans.append([group, start, len(self.commands)])
 
     def clear(self):
-        self.commands = ""
+        self.commands = bytearray()
+        self.lines = 0
+        self.spans = []
 
     def get(self):
-        return self.commands
+        return str(self.commands)
+
+    def copy(self):
+        """A separate store holding the same commands"""
+        store = CommandStore()
+        store.commands = bytearray(self.commands)
+        store.lines = self.lines
+        store.spans = [list(span) for span in self.spans]
+        return store
+
+    def size(self):
+        """Number of bytes stored"""
+        return len(self.commands)
+
+    def line_count(self):
+        """Number of command lines stored, including an unterminated last line"""
+        if len(self.commands) > 0 and self.commands[-1] != ord("\n"):
+            return self.lines + 1
+        return self.lines
+
+    def group_digests(self):
+        """A hash of the commands in each group, to compare with what
+        was sent before"""
+        digests = {}
+        for group, start, end in self.spans:
+            digests.setdefault(group, hashlib.sha1()).update(
+                buffer(self.commands, start, end - start))
+        return dict((group, digest.hexdigest())
+                    for group, digest in digests.iteritems())
+
+    def select(self, groups):
+        """The commands in the given groups, in the order they were added.
+        Commands are added as whole stripped lines, so these are ready to
+        write to the controller as they are."""
+        selected = bytearray()
+        for group, start, end in self.spans:
+            if group in groups:
+                selected += buffer(self.commands, start, end - start)
+        return str(selected)
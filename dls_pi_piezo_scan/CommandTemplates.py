@@ -1,3 +1,5 @@
+import string
+
 def get_command_templates():
     """Give us the command templates - separated from the main class for clairity"""
 
@@ -8,20 +10,27 @@ def get_command_templates():
 SVO 2 1
 SVO 3 1
 """
-    # One X step
-    templates["x_step"] = """WAV {TABLE:d} {first:s} LIN {MOVETIME:d} 0 {xDemand:f} {MOVETIME:d} 0 0
-WAV {TABLE:d} & LIN {EXPOSURE:d} 0 {xDemand:f} {EXPOSURE:d} 0 0
+    # Hold at one position: an X step is a hold for MOVETIME then
+    # one for EXPOSURE, a Y step is a wait then two moves
+    templates["hold"] = """WAV {TABLE:d} {first:s} LIN {LENGTH:d} 0 {value:f} {LENGTH:d} 0 0
 """
 
-    # One Y step
-    templates["y_step"] = """WAV {TABLE:d} {first:s} LIN {yWaitTime:d} 0 {y0:f} {yWaitTime:d} 0 0
-WAV {TABLE:d} & LIN {yMOVETIME:d} 0 {xDemand:f} {yMOVETIME:d} 0 0
-WAV {TABLE:d} & LIN {yMOVETIME:d} 0 {y1:f} {yMOVETIME:d} 0 0
+    # One ramp of a fly scan row. The curve can be shorter than the
+    # segment, in which case it holds at the end.
+    templates["ramp"] = """WAV {TABLE:d} {first:s} LIN {LENGTH:d} {AMPLITUDE:f} {OFFSET:f} {CURVE:d} 0 0
 """
 
+    # Start fly scans at the start of the first row. The Y offset
+    # builds up each row, so it is put back first.
+    templates["fly_start"] = """WOS {AXISY:d} {Y0:f}
+MOV {AXISX:d} {XSTART:f}
+MOV {AXISY:d} {Y0:f}
+MOV {AXISZ:d} {Z0:f}
+WGO {AXISX:d} 1 {AXISY:d} 257"""
+
+    # Trigger points follow, from TriggerTable
     templates["setup_trigger"]="""TWC
 CTO {OUTPUT:d} 3 4
-TWS {TABLE:d} {TRIGPOINT} 1
 """
     # Set gneerator level trigger mode for out id 1 (OUT1)
     # Set trigger high at specified step number
@@ -31,15 +40,15 @@ TWS {TABLE:d} {TRIGPOINT} 1
     # Move to start poisition
     # etc.
 
-    # One servo cycle is 50 us,
-    # so 20 cycles per point works out as 1 ms per point.
-    set_wave_table_rate = """WTR 0 20 1
+    # One servo cycle is 50 us, so a WTR of 20 cycles per point works
+    # out as 1 ms per point. The scan chooses the rates, see choose_rates.
+    set_wave_table_rate = """WTR 0 {WTR:d} 1
 """
-    set_record_table_rate = """RTR 40
+    set_record_table_rate = """RTR {RTR:d}
 """
-    connect_wave_table_to_generator = """WSL 1 1
-WSL 2 2
-WSL 3 3
+    connect_wave_table_to_generator = """WSL {AXISX:d} {WAVE_TABLEX:d}
+WSL {AXISY:d} {WAVE_TABLEY:d}
+WSL {AXISZ:d} {WAVE_TABLEZ:d}
 """
     templates["set_wave_generator_cycles"] = """WGC {TABLE:d} {N_CYCLES:d}
 """
@@ -51,23 +60,63 @@ DRC 4 1 1
 DRC 5 2 1
 DRC 6 3 1
 """
-    set_wave_generator_offset = """WOS 1 {X0:f}
-WOS 2 {Y0:f}
-WOS 3 {Z0:f}
+    # Generator n drives axis n
+    set_wave_generator_offset = """WOS {AXISX:d} {X0:f}
+WOS {AXISY:d} {Y0:f}
+WOS {AXISZ:d} {Z0:f}
 """
-    move_to_start_position = """MOV 1 {X0:f}
-MOV 2 {Y0:f}
-MOV 3 {Z0:f}
+    move_to_start_position = """MOV {AXISX:d} {X0:f}
+MOV {AXISY:d} {Y0:f}
+MOV {AXISZ:d} {Z0:f}
 """
 
-    templates["rest"] = set_wave_table_rate \
-            + set_record_table_rate \
-            + connect_wave_table_to_generator \
-            + configure_data_recorder \
-            + set_wave_generator_offset #\
+    # The rest of the setup, in groups that can be sent on their own
+    templates["rates"] = set_wave_table_rate + set_record_table_rate
+    templates["routing"] = connect_wave_table_to_generator
+    templates["recorder"] = configure_data_recorder
+    templates["offsets"] = set_wave_generator_offset
+
+    templates["rest"] = templates["rates"] \
+            + templates["routing"] \
+            + templates["recorder"] \
+            + templates["offsets"] #\
             #+ move_to_start_position
 
     templates["stop_commands"] = """WGO 1 0 2 0
 STP"""
 
     return templates
+
+def bulk_template(template, fields, **values):
+    """Prepare a template to be rendered for many rows in one go.
+
+    The fields named in fields change from row to row, and are left as %
+    format placeholders. Every other field is filled in now from values.
+    :return %-format string for one row and the order of its fields"""
+    row = []
+    order = []
+    for literal, name, spec, conversion in string.Formatter().parse(template):
+        row.append(literal.replace("%", "%%"))
+        if name is None:
+            continue
+        if name in fields:
+            row.append("%" + spec)
+            order.append(name)
+        else:
+            row.append(("{0:" + spec + "}").format(values[name]).replace("%", "%%"))
+    return "".join(row), order
+
+def render_bulk(row, order, columns):
+    """Render rows prepared by bulk_template
+    :param columns dict of array of values for each field
+    :return the rows, joined together"""
+    if len(order) == 0:
+        return ""
+    number_of_rows = len(columns[order[0]])
+    if number_of_rows == 0:
+        return ""
+    # One format operation for all the rows, with the fields interleaved
+    interleaved = [None] * (number_of_rows * len(order))
+    for i, name in enumerate(order):
+        interleaved[i::len(order)] = list(columns[name])
+    return (row * number_of_rows) % tuple(interleaved)
@@ -0,0 +1,131 @@
+"""Configure scans without holding up the IOC.
+
+CONFIGURE and START come in as record callbacks. Configuring means an
+upload which can take seconds, so it is done by a worker instead: a
+cothread if the controller is cooperative, otherwise a thread of its own,
+which hands back to cothread when it is done. A CONFIGURE that comes in
+while we are configuring is merged into one more run afterwards, which
+picks up the latest parameters. A START that comes in while we are
+configuring is held until the scan is READY.
+
+Other uploads, such as a ScanQueue loading the next scan, go through
+call_in_background in the same way."""
+
+# Standard dependencies
+import logging
+import threading
+
+# Extra dependencies
+from pkg_resources import require
+require('cothread')
+import cothread
+
+from PIConstants import *
+
+
+class ConfigureWorker():
+    """Runs configure_scan for a PIStepScan in the background"""
+
+    def __init__(self, scan, cooperative=None):
+        """:param scan PIStepScan, or anything else with configure_scan,
+        start_scan, get_state and set_state, to configure and start
+        :param cooperative If True, configure in a cothread rather than a
+        thread. By default, whether the scan's controller is cooperative."""
+        self.scan = scan
+        if cooperative is None:
+            cooperative = scan.controller.cooperative
+        self.cooperative = cooperative
+
+        # True while a configure is in progress, and whether another
+        # has been asked for since it began
+        self.lock = threading.Lock()
+        self.configuring = False
+        self.pending = False
+
+        # Start the scan as soon as configuring finishes
+        self.start_armed = False
+
+    def configure(self, value=None):
+        """Callback for the CONFIGURE record"""
+        with self.lock:
+            if self.configuring:
+                logging.info("Configure requested during configure, "
+                             "will configure again with the latest parameters")
+                self.pending = True
+                return
+            self.configuring = True
+
+        if self.cooperative:
+            cothread.Spawn(self.run)
+        else:
+            worker = threading.Thread(target=self.run, name="configure_scan")
+            worker.daemon = True
+            worker.start()
+
+    def start(self, value=None):
+        """Callback for the START record"""
+        with self.lock:
+            if self.configuring:
+                logging.info("Start requested during configure, "
+                             "will start when the scan is ready")
+                self.start_armed = True
+                return
+        self.scan.start_scan()
+
+    def run(self):
+        """Configure until no more configures have been asked for"""
+        while True:
+            try:
+                self.scan.configure_scan()
+            except Exception:
+                logging.exception("Configure failed")
+                self.scan.set_state(STATE_ERROR)
+
+            with self.lock:
+                if not self.pending:
+                    self.configuring = False
+                    break
+                self.pending = False
+
+        if self.cooperative:
+            self.finished()
+        else:
+            cothread.Callback(self.finished)
+
+    def finished(self):
+        """Back in cothread: start the scan if that was asked for meanwhile"""
+        with self.lock:
+            if not self.start_armed:
+                return
+            self.start_armed = False
+
+        if self.scan.get_state() == STATE_READY:
+            self.scan.start_scan()
+        else:
+            logging.error("Not starting scan - configure failed")
+
+
+def call_in_background(cooperative, function, *args):
+    """Call function without holding up the IOC: directly if the controller
+    is cooperative, otherwise in a thread of its own while the calling
+    cothread waits for it
+    :param cooperative Whether the controller only suspends the calling cothread
+    :return What function returned. Anything it raised is raised here."""
+    if cooperative:
+        return function(*args)
+
+    done = cothread.Event()
+    def run():
+        try:
+            outcome = (True, function(*args))
+        except Exception as error:
+            outcome = (False, error)
+        cothread.Callback(done.Signal, outcome)
+
+    worker = threading.Thread(target=run, name=function.__name__)
+    worker.daemon = True
+    worker.start()
+    succeeded, result = done.Wait()
+    if not succeeded:
+        raise result
+    return result
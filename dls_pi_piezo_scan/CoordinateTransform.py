@@ -1,70 +1,88 @@
 from math import *
 
+from pkg_resources import require
+require("numpy")
+import numpy
+
+# Rotation matrices kept before we start again
+MAX_CACHED_MATRICES = 64
+
 class CoordinateTransform:
 
     def __init__(self, r_y=0.0):
         self.r_y = float(r_y) # angle of rotation about Y, degrees
         self.decimal_places = 6
 
+        # Rotation matrix for each (theta, pitch, roll) we have used
+        self.matrices = {}
+
     def set_theta(self, theta):
         self.r_y = theta
 
-    def forward(self, x_real, y_real, z_real, theta=None, pitch=0.0, roll=0.0):
-        XPOS = float(x_real)
-        YPOS = float(y_real)
-        ZPOS = float(z_real)
-
+    def rotation_matrix(self, theta=None, pitch=0.0, roll=0.0):
+        """Matrix taking real coordinates to lab coordinates. Its transpose
+        (and inverse) takes lab coordinates back to real ones."""
         if theta is None:
             theta = self.r_y
+        key = (float(theta), float(pitch), float(roll))
+
+        if key not in self.matrices:
+            if len(self.matrices) >= MAX_CACHED_MATRICES:
+                self.matrices.clear()
+
+            KPOS = float(roll) * pi / 180.0
+            PPOS = float(theta) * pi / 180.0
+            OPOS = float(pitch) * pi / 180.0
+
+            self.matrices[key] = numpy.array([
+                [cos(KPOS) * cos(PPOS),
+                 (cos(KPOS) * sin(PPOS) * sin(OPOS)) - (sin(KPOS) * cos(OPOS)),
+                 (cos(KPOS) * sin(PPOS) * cos(OPOS)) + (sin(KPOS) * sin(OPOS))],
+                [sin(KPOS) * cos(PPOS),
+                 (sin(KPOS) * sin(PPOS) * sin(OPOS)) + (cos(KPOS) * cos(OPOS)),
+                 (sin(KPOS) * sin(PPOS) * cos(OPOS)) - (cos(KPOS) * sin(OPOS))],
+                [-sin(PPOS),
+                 cos(PPOS) * sin(OPOS),
+                 cos(PPOS) * cos(OPOS)]])
 
-        KPOS = float(roll) * pi / 180.0
-        PPOS = float(theta) * pi / 180.0
-        OPOS = float(pitch) * pi / 180.0
-
-        VIRTUAL_X = (XPOS * cos(KPOS) * cos(PPOS)) + (YPOS * (
-        (cos(KPOS) * sin(PPOS) * sin(OPOS)) - (sin(KPOS) * cos(OPOS)))) + (
-                    ZPOS * ((cos(KPOS) * sin(PPOS) * cos(OPOS)) + (
-                    sin(KPOS) * sin(OPOS))))
-        VIRTUAL_Y = (XPOS * sin(KPOS) * cos(PPOS)) + (YPOS * (
-        (sin(KPOS) * sin(PPOS) * sin(OPOS)) + (cos(KPOS) * cos(OPOS)))) + (
-                    ZPOS * ((sin(KPOS) * sin(PPOS) * cos(OPOS)) - (
-                    cos(KPOS) * sin(OPOS))))
-        VIRTUAL_Z = (XPOS * (-sin(PPOS))) + (YPOS * cos(PPOS) * sin(OPOS)) + (
-        ZPOS * cos(PPOS) * cos(OPOS))
-
-        x_lab = round(VIRTUAL_X, self.decimal_places)
-        y_lab = round(VIRTUAL_Y, self.decimal_places)
-        z_lab = round(VIRTUAL_Z, self.decimal_places)
+        return self.matrices[key]
+
+    def forward_array(self, points, theta=None, pitch=0.0, roll=0.0, rounded=True):
+        """Transform many real positions to lab positions at once
+        :param points Array of shape (N, 3) of x, y, z
+        :param rounded If True, round to decimal_places like forward
+        :return Array of shape (N, 3)"""
+        matrix = self.rotation_matrix(theta, pitch, roll)
+        lab = numpy.dot(numpy.asarray(points, dtype=float), matrix.T)
+        if rounded:
+            numpy.round(lab, self.decimal_places, out=lab)
+        return lab
+
+    def inverse_array(self, points, theta=None, pitch=0.0, roll=0.0, rounded=True):
+        """Transform many lab positions back to real positions at once
+        :param points Array of shape (N, 3) of x, y, z
+        :param rounded If True, round to decimal_places like inverse
+        :return Array of shape (N, 3)"""
+        matrix = self.rotation_matrix(theta, pitch, roll)
+        real = numpy.dot(numpy.asarray(points, dtype=float), matrix)
+        if rounded:
+            numpy.round(real, self.decimal_places, out=real)
+        return real
+
+    def forward(self, x_real, y_real, z_real, theta=None, pitch=0.0, roll=0.0):
+        lab = self.forward_array([[x_real, y_real, z_real]], theta, pitch, roll)[0]
+
+        x_lab = float(lab[0])
+        y_lab = float(lab[1])
+        z_lab = float(lab[2])
 
         return x_lab, y_lab, z_lab
 
     def inverse(self, x_lab, y_lab, z_lab, theta=None, pitch=0.0, roll=0.0):
-        VIRTUAL_X = x_lab
-        VIRTUAL_Y = y_lab
-        VIRTUAL_Z = z_lab
-
-        if theta is None:
-            theta = self.r_y
+        real = self.inverse_array([[x_lab, y_lab, z_lab]], theta, pitch, roll)[0]
 
-        KPOS = float(roll) * pi / 180.0
-        PPOS = float(theta) * pi / 180.0
-        OPOS = float(pitch) * pi / 180.0
-
-        INVERSE_X = VIRTUAL_X * (cos(KPOS) * cos(PPOS)) + VIRTUAL_Y * (
-        sin(KPOS) * cos(PPOS)) - VIRTUAL_Z * sin(PPOS)
-        INVERSE_Y = VIRTUAL_X * (
-        cos(KPOS) * sin(PPOS) * sin(OPOS) - sin(KPOS) * cos(
-            OPOS)) + VIRTUAL_Y * (
-        sin(KPOS) * sin(PPOS) * sin(OPOS) + cos(KPOS) * cos(
-            OPOS)) + VIRTUAL_Z * cos(PPOS) * sin(OPOS)
-        INVERSE_Z = VIRTUAL_X * (
-        cos(KPOS) * sin(PPOS) * cos(OPOS) + sin(KPOS) * sin(
-            OPOS)) + VIRTUAL_Y * (
-        sin(KPOS) * sin(PPOS) * cos(OPOS) - cos(KPOS) * sin(
-            OPOS)) + VIRTUAL_Z * cos(PPOS) * cos(OPOS)
-
-        x_real = round(INVERSE_X, self.decimal_places)
-        y_real = round(INVERSE_Y, self.decimal_places)
-        z_real = round(INVERSE_Z, self.decimal_places)
+        x_real = float(real[0])
+        y_real = float(real[1])
+        z_real = float(real[2])
 
         return x_real, y_real, z_real
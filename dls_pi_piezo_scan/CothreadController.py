@@ -0,0 +1,259 @@
+# Standard dependencies
+import time
+import socket
+import logging
+import collections
+
+# Extra dependencies
+from pkg_resources import require
+require('cothread')
+import cothread
+from cothread import cosocket
+
+# Other files in this module
+import PIController
+
+class ControllerCancelled(Exception):
+    """Raised in anything waiting on a reply that was cancelled"""
+
+
+class Response():
+    """A reply we expect from the controller. Waiting on it blocks only the
+    calling cothread, so several requests can be in flight at once."""
+
+    def __init__(self, command, timeout):
+        """:param command The query this is the reply to
+        :param timeout Seconds from now before we stop waiting for the reply"""
+        self.command = command
+        self.deadline = time.time() + timeout
+        self.cancelled = False
+        self.event = cothread.Event(auto_reset=False)
+
+    def set(self, reply):
+        """Called by the reader when the reply arrives"""
+        self.event.Signal(reply)
+
+    def ready(self):
+        """True once the reply has arrived, or the request was cancelled"""
+        return bool(self.event)
+
+    def cancel(self):
+        """Wake up anyone waiting, who will get ControllerCancelled"""
+        self.cancelled = True
+        self.event.Signal(None)
+
+    def wait(self, timeout=None):
+        """Wait for the reply.
+        :param timeout Seconds to wait, or None to wait until the deadline
+        :raises cothread.Timedout if no reply came in time
+        :raises ControllerCancelled if the request was cancelled"""
+        if timeout is None:
+            timeout = max(0.0, self.deadline - time.time())
+        reply = self.event.Wait(timeout)
+        if self.cancelled:
+            raise ControllerCancelled("Cancelled waiting for reply to %s" %
+                                      self.command)
+        return reply
+
+
+class CothreadLock():
+    """Re-entrant lock between cothreads, which threading.RLock is not: every
+    cothread runs in the same thread. Non-blocking acquire returns False when
+    another cothread holds it, as for threading.RLock."""
+
+    def __init__(self):
+        self.lock = cothread.RLock()
+
+    def acquire(self, blocking=True):
+        """:param blocking If False, give up at once if the lock is taken
+        :return True if we now hold the lock"""
+        try:
+            self.lock.acquire(timeout=None if blocking else 0)
+        except cothread.Timedout:
+            return False
+        return True
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class CothreadController(PIController.PIController):
+    """Connection to the controller using cooperative cothread sockets.
+
+    A reader cothread frames incoming data into GCS responses and hands each
+    one to the oldest outstanding Response. Sends and waits only suspend the
+    calling cothread, so configuring, progress polling and aborting can all
+    overlap on the IOC's cothread scheduler."""
+
+    # Sends and receives only suspend the calling cothread
+    cooperative = True
+
+    def __init__(self, host, port=50000, debug=False,
+                 max_outstanding_bytes=PIController.E727_MAX_OUTSTANDING_BYTES,
+                 checkpoint_lines=PIController.DEFAULT_CHECKPOINT_LINES,
+                 timeout=PIController.DEFAULT_REPLY_TIMEOUT, sock=None):
+        """:param timeout Default deadline for replies, seconds
+        Other parameters as for PIController"""
+
+        self.timeout = timeout
+
+        # Responses in the order their queries went down the wire,
+        # and those of them which get_response can still hand out
+        self.pending = collections.deque()
+        self.unclaimed = collections.deque()
+
+        # Responses to ERR? checkpoints, oldest first
+        self.checkpoint_responses = collections.deque()
+
+        # Only one cothread writes to the socket at a time, so
+        # lines from different senders never interleave
+        self.writing = False
+        self.write_done = cothread.Event()
+
+        PIController.PIController.__init__(
+            self, host, port, debug=debug,
+            max_outstanding_bytes=max_outstanding_bytes,
+            checkpoint_lines=checkpoint_lines, sock=sock, timeout=timeout)
+
+    def create_lock(self):
+        """Exclude other cothreads, not just other threads"""
+        return CothreadLock()
+
+    def create_socket(self):
+        """Make a cooperative socket so we never block other cothreads"""
+        return cosocket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    def connect(self):
+        """Connect socket to controller and start reading replies"""
+        PIController.PIController.connect(self)
+        if not self.debug:
+            self.reader = cothread.Spawn(self.read_responses)
+
+    def read_responses(self):
+        """Reader cothread: pass each complete response to whoever is
+        waiting for it"""
+        data = ""
+        while True:
+            try:
+                received = self.socket.recv(4096)
+            except socket.timeout:
+                continue
+            except socket.error:
+                received = ""
+
+            if len(received) == 0:
+                logging.warning("Connection to controller closed")
+                self.cancel()
+                return
+
+            responses, data = PIController.split_responses(data + received)
+            for reply in responses:
+                logging.debug("RECEIVE: " + reply)
+                if len(self.pending) > 0:
+                    self.pending.popleft().set(reply)
+                else:
+                    logging.warning("Unexpected reply from controller: %s" % reply)
+
+    def expect(self, command, timeout=None):
+        """Queue a Response for a query that is about to be sent"""
+        if timeout is None:
+            timeout = self.timeout
+        response = Response(command, timeout)
+        if self.debug:
+            # The zero makes ERR? command happy
+            response.set("0")
+        else:
+            self.pending.append(response)
+        return response
+
+    def write(self, data):
+        """Write a block of already encoded commands to the controller"""
+        while self.writing:
+            self.write_done.Wait()
+        self.writing = True
+        try:
+            PIController.PIController.write(self, data)
+        finally:
+            self.writing = False
+            self.write_done.Signal()
+
+    def send(self, command):
+        """Send a string to the controller. A Response is queued for every
+        query in it, for get_response to return in order."""
+        responses = [self.expect(line) for line in command.split("\n")
+                     if is_query(line)]
+        self.unclaimed.extend(responses)
+        self.write(command)
+
+    def get_response(self, timeout=None):
+        """Wait for the reply to the oldest query sent with send
+        :param timeout Seconds to wait, or None to wait until its deadline"""
+        if len(self.unclaimed) == 0:
+            raise ValueError("No reply expected from controller")
+        return self.unclaimed.popleft().wait(timeout)
+
+    def query_async(self, command, timeout=None):
+        """Send a single query without waiting for its reply
+        :param timeout Seconds before the reply is overdue, default self.timeout
+        :return Response to wait on"""
+        response = self.expect(command, timeout)
+        self.write(command + "\n")
+        return response
+
+    def query(self, command, timeout=None):
+        """Send a single query and wait for the controller's reply to it"""
+        return self.query_async(command, timeout).wait()
+
+    def query_pipelined(self, commands, timeout=None):
+        """Send several queries in one write and wait for all their replies"""
+        responses = [self.expect(command, timeout) for command in commands]
+        self.write(PIController.encode_queries(commands))
+        return [response.wait() for response in responses]
+
+    def send_checkpoint(self):
+        """Ask for the error code, to be collected by checkpoint_reply"""
+        self.checkpoint_responses.append(self.query_async("ERR?"))
+
+    def checkpoint_reply(self, wait):
+        """The reply to the oldest checkpoint
+        :param wait If False, return None rather than wait for it"""
+        if not wait and not self.checkpoint_responses[0].ready():
+            return None
+        return self.checkpoint_responses.popleft().wait()
+
+    def write_checkpointed(self, data, count):
+        """Write encoded lines with count ERR? checkpoints among them,
+        whose replies are collected by checkpoint_reply"""
+        self.checkpoint_responses.extend([self.expect("ERR?") for i in range(count)])
+        self.write(data)
+
+    def query_multiline(self, command, timeout=None):
+        """The reader frames long replies like any other"""
+        return self.query(command, timeout)
+
+    def cancel(self):
+        """Give up on every outstanding reply. Anyone waiting gets
+        ControllerCancelled, and replies that still turn up are dropped."""
+        for response in list(self.pending) + list(self.unclaimed):
+            response.cancel()
+        self.unclaimed.clear()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Make sure we close the socket on destruction"""
+        self.cancel()
+        self.socket.close()
+
+
+def is_query(line):
+    """True if a GCS command line gets a reply: queries such as ERR? and
+    POS? 1, or single character commands such as #9"""
+    if PIController.is_single_character(line):
+        return True
+    words = line.split()
+    return len(words) > 0 and words[0].endswith("?")
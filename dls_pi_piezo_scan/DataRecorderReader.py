@@ -0,0 +1,173 @@
+"""Read the controller's data recorder into NumPy arrays.
+
+The recorder is read with DRR? in chunks of a few thousand points, so it
+can be read while the scan is still recording. Each reply is a GCS data
+header followed by rows of values, which are parsed in one go by NumPy."""
+
+# Standard dependencies
+import time
+import logging
+
+# Extra dependencies
+from pkg_resources import require
+require("numpy")
+import numpy
+
+from PIConstants import *
+
+# Channels set up by the recorder template: target then
+# current position of axes 1 to 3
+DEFAULT_CHANNELS = (1, 2, 3, 4, 5, 6)
+
+# Points per channel asked for with each DRR?
+DEFAULT_CHUNK_POINTS = 4096
+
+# How often to ask how much has been recorded when we are ahead / s
+DEFAULT_POLL_INTERVAL = 0.1
+
+END_OF_HEADER = "# END_HEADER"
+
+
+def parse_header(text):
+    """Parse a GCS data header
+    :return dict of header values, with NAMEn entries collected in "NAMES"""
+    header = {"NAMES": []}
+    for line in text.split("\n"):
+        line = line.strip().lstrip("#").strip()
+        if "=" not in line:
+            continue
+        key, value = [part.strip() for part in line.split("=", 1)]
+        if key.startswith("NAME"):
+            header["NAMES"].append(value)
+        else:
+            header[key] = value
+    return header
+
+
+def split_reply(reply):
+    """Split a DRR? reply into its header and the text of its values"""
+    end = reply.find(END_OF_HEADER)
+    if end < 0:
+        raise ValueError("No data header in recorder reply")
+    data = reply.find("\n", end)
+    if data < 0:
+        return parse_header(reply[:end]), ""
+    return parse_header(reply[:end]), reply[data + 1:]
+
+
+class DataRecorderReader():
+    """Reads recorded data from the controller into a preallocated array,
+    one column per recorder channel"""
+
+    def __init__(self, controller, channels=DEFAULT_CHANNELS,
+                 chunk_points=DEFAULT_CHUNK_POINTS,
+                 poll_interval=DEFAULT_POLL_INTERVAL, sleep=time.sleep):
+        """:param controller PIController to read from
+        :param channels Recorder channels to read
+        :param chunk_points Points per channel to read with each DRR?
+        :param poll_interval Time to wait for more points to be recorded / s
+        :param sleep Function to wait with, e.g. cothread.Sleep in an IOC"""
+        self.controller = controller
+        self.channels = list(channels)
+        self.chunk_points = chunk_points
+        self.poll_interval = poll_interval
+        self.sleep = sleep
+
+        self.data = numpy.zeros((0, len(self.channels)))
+        self.header = {}
+
+        # Where read puts each chunk, if not in data
+        self.writer = None
+
+        # Throughput of the last read
+        self.points_read = 0
+        self.bytes_read = 0
+        self.seconds = 0.0
+
+    def recorded_points(self):
+        """Number of points recorded so far"""
+        reply = self.controller.query_multiline("DRL? %d" % self.channels[0])
+        return int(reply.split("=")[-1])
+
+    def generators_running(self):
+        """True if any wave generator is still running"""
+        status, = self.controller.query_pipelined([WAVE_GENERATOR_STATUS])
+        return int(status) != 0
+
+    def read(self, points, wait=True, writer=None):
+        """Read the first points points of each channel.
+        :param wait If True, wait for points that haven't been recorded yet,
+        so reading can start while the scan is running, until the wave
+        generators stop. Otherwise stop at the end of what has been recorded.
+        :param writer If given, each chunk is written to it as it arrives
+        instead of being kept in memory
+        :return Array of shape (points read, channels), or just the last
+        chunk if there is a writer"""
+        self.writer = writer
+        if writer is None:
+            self.data = numpy.empty((points, len(self.channels)))
+        self.bytes_read = 0
+        start_time = time.time()
+
+        read = 0
+        while read < points:
+            available = self.recorded_points()
+            if available <= read:
+                if not wait:
+                    break
+                if not self.generators_running():
+                    # Aborted or a short scan: only what is recorded by
+                    # now will ever be there
+                    if self.recorded_points() <= read:
+                        logging.warning("Recording stopped after %d of %d points" % (
+                            read, points))
+                        break
+                    continue
+                self.sleep(self.poll_interval)
+                continue
+
+            count = min(self.chunk_points, points - read, available - read)
+            read += self.read_chunk(read, count)
+
+        if writer is None:
+            self.data = self.data[:read]
+        self.points_read = read
+        self.seconds = time.time() - start_time
+        logging.info("Read %d points from %d recorder channels in %f s "
+                     "(%.0f points/s, %.0f bytes/s)" % (
+                         read, len(self.channels), self.seconds,
+                         self.points_per_second(), self.bytes_per_second()))
+        return self.data
+
+    def read_chunk(self, first, count):
+        """Read count points starting at the zero based point first into
+        the data array
+        :return number of points read"""
+        reply = self.controller.query_multiline("DRR? %d %d %s" % (
+            first + 1, count, " ".join(["%d" % ch for ch in self.channels])))
+        self.bytes_read += len(reply)
+
+        self.header, values = split_reply(reply)
+        values = numpy.fromstring(values, sep=" ")
+        rows = len(values) // len(self.channels)
+        values = values[:rows * len(self.channels)].reshape(rows, len(self.channels))
+        if self.writer is None:
+            self.data[first:first + rows] = values
+        else:
+            self.data = values
+            self.writer.write(first, values)
+        return rows
+
+    def sample_time(self):
+        """Time between recorded points / s, from the last header"""
+        return float(self.header.get("SAMPLE_TIME", 0.0))
+
+    def points_per_second(self):
+        if self.seconds == 0:
+            return 0.0
+        return self.points_read * len(self.channels) / self.seconds
+
+    def bytes_per_second(self):
+        if self.seconds == 0:
+            return 0.0
+        return self.bytes_read / self.seconds
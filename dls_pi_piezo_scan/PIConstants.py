@@ -4,6 +4,36 @@
 ACTION_REPLACE = "X"
 ACTION_APPEND = "&"
 
+# How wave table contents are turned into WAV commands
+ENCODING_EXPLICIT = 0
+ENCODING_COMPACT = 1
+
+# How the scan moves the axes
+SCAN_MODE_STEP = 0
+SCAN_MODE_ROTATED = 1
+SCAN_MODE_FLY = 2
+SCAN_MODE_VOLUME = 3
+
+# Fly scans: X ramps continuously along each row then flies back
+# while Y steps. Above 100 Hz position lags demand by over 2 um.
+FLY_MAX_ROW_RATE = 100.0
+# Most wave table points in the ramp of one row
+FLY_ROW_POINTS = 2000
+# Flyback takes this share of the ramp points, and gets
+# to the start of the row by this share of the flyback
+FLY_FLYBACK_POINTS = 0.1
+FLY_FLYBACK_CURVE = 0.9
+# Output that pulses at each column
+FLY_TRIGGER_OUTPUT = 1
+# Most trigger points in one TWS command
+TRIGGERS_PER_LINE = 10
+
+# File formats for recorded data
+FILE_FORMAT_NPY = 0
+FILE_FORMAT_HDF5 = 1
+DEFAULT_FILE_PATH = "/tmp"
+DEFAULT_FILE_NAME = "pi_scan"
+
 # States for STATE PV
 STATE_NOT_CONFIGRED = 0
 STATE_PREPARING = 1
@@ -21,5 +51,56 @@ AXISX = 1
 AXISY = 3
 AXISZ = 2
 
+# The scan uses a bank of three wave tables, TABLEX, TABLEY and TABLEZ
+# moved up by TABLES_PER_BANK for each bank. A scan queue loads the next
+# scan into the other bank while one runs.
+TABLES_PER_BANK = 3
+TABLE_BANKS = 2
+
+# How often a scan queue asks if the wave generators have stopped / s
+QUEUE_POLL_INTERVAL = 0.01
+
 E727_AVAILALBE_DATAPOINTS = 262144
+E727_WAVE_TABLES = 8
+E727_WAVE_GENERATORS = 3
+E727_RECORDER_CHANNELS = 8
+
+# Length of one servo cycle / s
+E727_SERVO_CYCLE = 0.00005
+
+# Wave table rate, in servo cycles per wave table point. 20 is 1 ms
+# per point, so MOVETIME and EXPOSURE are counted in points as they are.
+DEFAULT_WAVE_TABLE_RATE = 20
+# Coarsest rate chosen for a scan: 100 ms per point
+MAX_WAVE_TABLE_RATE = 2000
+# The data recorder takes a sample every this many wave table points
+RECORD_RATE_FACTOR = 2
+# How far MOVETIME and EXPOSURE may be from what they ask for / %
+DEFAULT_RATE_TOLERANCE = 1.0
+
+# Most bytes of a batched upload we let sit unacknowledged in the
+# controller input buffer before waiting for a reply
+E727_MAX_OUTSTANDING_BYTES = 4096
+
+# Lines of an upload between ERR? checkpoints. An error is pinned
+# down to the lines since the last checkpoint.
+DEFAULT_CHECKPOINT_LINES = 32
+
+# Single character command asking which wave generators are running
+WAVE_GENERATOR_STATUS = chr(9)
+
+# How long a blocking controller waits for a reply before giving up / s
+DEFAULT_REPLY_TIMEOUT = 5.0
+
+# Asks for the error code, at each checkpoint of an upload
+CHECK_ERROR = "ERR?\n"
 
+# GCS error codes reported by ERR?
+GCS_NO_ERROR = 0
+GCS_ERROR_PARAM_SYNTAX = 1
+GCS_ERROR_UNKNOWN_COMMAND = 2
+GCS_ERROR_MOVE_WITHOUT_SERVO = 5
+GCS_ERROR_POS_OUT_OF_LIMITS = 7
+GCS_ERROR_STOPPED = 10
+GCS_ERROR_INVALID_AXIS = 15
+GCS_ERROR_PARAM_OUT_OF_RANGE = 17
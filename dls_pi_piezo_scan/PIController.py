@@ -1,30 +1,103 @@
 # Standard dependencies
+import time
 import socket
+import select
 import logging
+import threading
+import functools
+import collections
+
+from PIConstants import *
+
+def transaction(method):
+    """Hold the controller's lock for the whole of a method, so that
+    threads never interleave their commands or read each other's replies"""
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+
+class ControllerTimeout(socket.timeout):
+    """The controller didn't answer in time"""
+
 
 class PIController():
     """Handles connection to the controller and sending/receiving commands"""
 
-    def __init__(self, host, port=50000, debug=False):
+    # Sends and receives block the calling thread
+    cooperative = False
+
+    def __init__(self, host, port=50000, debug=False,
+                 max_outstanding_bytes=E727_MAX_OUTSTANDING_BYTES,
+                 checkpoint_lines=DEFAULT_CHECKPOINT_LINES, sock=None,
+                 timeout=DEFAULT_REPLY_TIMEOUT):
         """:param host IP address of controller (or terninal server
         :param port IP port of controller or terminal server
-        :param debug If True, doesn't connect but prints commands"""
+        :param debug If True, doesn't connect but prints commands
+        :param max_outstanding_bytes Most bytes of a batched upload sent
+        before we wait for the controller to catch up
+        :param checkpoint_lines Lines between the ERR? checkpoints of an
+        upload, so an error is pinned down to this many lines, or 0 for
+        one at the end of each upload or batch
+        :param sock Socket to use rather than making one, e.g. to record
+        or replay the session with SessionTrace
+        :param timeout Seconds to wait for a reply before giving up"""
 
         # Debug flag causes us to not actually connect
         # and print out commands instead
         self.debug = debug
+        self.timeout = timeout
+
+        # Flow control for batched uploads
+        self.max_outstanding_bytes = max_outstanding_bytes
+
+        # ERR? checkpoints of an upload whose replies we haven't read yet:
+        # the first and last line each one covers and the bytes sent for
+        # them, and the total of those bytes
+        self.checkpoint_lines = checkpoint_lines
+        self.checkpoints = collections.deque()
+        self.outstanding_bytes = 0
+        self.replies = collections.deque()
+        self.received = ""
+
+        # Where the last upload failed: 1 based numbers of the first and
+        # last lines the error could be in, GCS error code and the commands
+        self.error_line = 0
+        self.error_last_line = 0
+        self.error_code = GCS_NO_ERROR
+        self.error_command = ""
+
+        # ScanMetrics to report round trip times to, if any
+        self.metrics = None
+
+        # Held for each exchange with the controller. Pollers in cothreads
+        # try for it without blocking, and keep out of the way if it's taken.
+        self.lock = self.create_lock()
 
         # Set up connection to controller
         self.host = host
         self.port = port
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.settimeout(1.0) # seconds
+        self.socket = sock if sock is not None else self.create_socket()
+        # Wake up at least once a second to check the deadline
+        self.socket.settimeout(min(1.0, timeout)) # seconds
         self.connect()
 
+    def create_lock(self):
+        """The lock held for each exchange with the controller"""
+        return threading.RLock()
+
+    def create_socket(self):
+        """Make the socket used to talk to the controller"""
+        return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
     def connect(self):
         """Connect socket to controller"""
         if not self.debug:
             self.socket.connect((self.host, self.port))
+            # Commands and replies are small, don't let Nagle hold them back
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             logging.info(
                 "Connect to real controller at host = %s:%d" % (
                 self.host, self.port))
@@ -39,33 +112,300 @@ class PIController():
         else:
             logging.info("SEND %s" % command)
 
-    def send_multiline(self, multiline_input):
-        """Send a multiline string of commands line by line"""
+    def write(self, data):
+        """Write a block of already encoded commands to the controller"""
+        if not self.debug:
+            self.socket.sendall(data)
+        else:
+            logging.info("SEND %s" % memoryview(data).tobytes())
+
+    @transaction
+    def send_multiline(self, multiline_input, batch=False, encoded=False):
+        """Send a multiline string of commands line by line
+        :param batch If True, send the commands with send_batched instead
+        :param encoded For send_batched"""
+        if batch:
+            return self.send_batched(multiline_input, encoded)
+        return self.send_lines(multiline_input)
+
+    def send_lines(self, multiline_input):
+        """Send a multiline string of commands one line at a time.
+
+        Every checkpoint_lines lines are followed by ERR?, without waiting
+        for the reply, so the reply that reports an error says which lines
+        caused it. At each checkpoint we read the replies that have arrived,
+        so we stop soon after a line fails rather than at the end."""
+
+        lines = []
         for line in multiline_input.split("\n"):
             line_stripped = line.strip()
             if len(line_stripped) > 0:
-                logging.debug("Send " + line_stripped)
-                self.send(line_stripped + "\n")
+                lines.append(line_stripped)
             else:
                 logging.warning("Skipped sending empty command line")
+        self.clear_upload_error()
+
+        failed = None
+        for first, last, size in self.checkpoint_windows(lines):
+            for line in lines[first:last + 1]:
+                logging.debug("Send " + line)
+                self.send(line + "\n")
+            self.send_checkpoint()
+            self.add_checkpoint(first, last, size)
+            failed = self.read_checkpoints(wait=False)
+            if failed is not None:
+                break
 
         # Check if any previous lines caused errors
-        self.send("ERR?\n")
-        if int(self.get_response()) != 0:
+        if failed is None:
+            failed = self.read_checkpoints(wait=True)
+        else:
+            self.read_checkpoints(wait=True)
+
+        if failed is not None:
+            self.set_upload_error(failed, lines)
             logging.error("send_multiline: Stopping on controller error")
             return False
 
         return True
 
+    def checkpoint_windows(self, lines):
+        """Split lines into the runs that each ERR? checkpoint follows: at
+        most checkpoint_lines lines, and no more bytes than can be
+        outstanding, unless a single line is longer
+        :return list of (first, last, bytes), with the indices of the first
+        and last lines and the bytes sent for them and their ERR?"""
+        windows = []
+        first = 0
+        size = len(CHECK_ERROR)
+        for number, line in enumerate(lines):
+            line_size = len(line) + 1
+            if number > first and (
+                    0 < self.checkpoint_lines <= number - first or
+                    size + line_size > self.max_outstanding_bytes):
+                windows.append((first, number - 1, size))
+                first = number
+                size = len(CHECK_ERROR)
+            size += line_size
+        if first < len(lines):
+            windows.append((first, len(lines) - 1, size))
+        return windows
+
+    def send_checkpoint(self):
+        """Ask for the error code without waiting for the reply"""
+        self.send(CHECK_ERROR)
+
+    def add_checkpoint(self, first, last, size):
+        """Note a checkpoint that has been sent, to be read by read_checkpoints"""
+        self.checkpoints.append((first, last, size))
+        self.outstanding_bytes += size
+
+    def read_checkpoints(self, wait, keep=0):
+        """Read the replies to checkpoints that have arrived
+        :param wait If True, wait for them
+        :param keep Leave this many of the latest checkpoints unread
+        :return (first line index, last line index, error code) of the
+        first checkpoint that failed, or None"""
+        failed = None
+        while len(self.checkpoints) > keep:
+            reply = self.checkpoint_reply(wait)
+            if reply is None:
+                break
+            first, last, size = self.checkpoints.popleft()
+            self.outstanding_bytes -= size
+            code = int(reply)
+            if code != GCS_NO_ERROR and failed is None:
+                failed = (first, last, code)
+        return failed
+
+    def checkpoint_reply(self, wait):
+        """The reply to the oldest checkpoint
+        :param wait If False, return None rather than wait for it"""
+        if self.debug:
+            # The zero makes ERR? command happy
+            return "0"
+        deadline = time.time() + self.timeout
+        while len(self.replies) == 0:
+            if not wait and not self.data_waiting():
+                return None
+            received = self.receive(4096, deadline)
+            responses, self.received = split_responses(self.received + received)
+            self.replies.extend(responses)
+        return self.replies.popleft()
+
+    def data_waiting(self):
+        """True if a reply has arrived that we haven't read"""
+        if hasattr(self.socket, "data_waiting"):
+            # Recording or replaying
+            return self.socket.data_waiting()
+        return len(select.select([self.socket], [], [], 0)[0]) > 0
+
+    def set_upload_error(self, failed, lines):
+        """Say where an upload failed
+        :param failed (first, last, code): indices in lines of the first
+        and last lines the error could be in, and the error code"""
+        first, last, code = failed
+        self.error_line = first + 1
+        self.error_last_line = last + 1
+        self.error_code = code
+        self.error_command = "\n".join(lines[first:last + 1])
+        if first == last:
+            logging.error("Controller error %d at line %d: %s" % (
+                code, self.error_line, self.error_command))
+        else:
+            logging.error("Controller error %d in lines %d to %d:\n%s" % (
+                code, self.error_line, self.error_last_line, self.error_command))
+
+    def clear_upload_error(self):
+        self.error_line = 0
+        self.error_last_line = 0
+        self.error_code = GCS_NO_ERROR
+        self.error_command = ""
+
+    def send_batched(self, multiline_input, encoded=False):
+        """Send a multiline string of commands in a few large writes.
+
+        The commands are encoded once, and ERR? follows every
+        checkpoint_lines lines. We write as many of these runs at once as
+        fit in max_outstanding_bytes, along with those the controller
+        hasn't replied to yet, so its input buffer never holds more than
+        that and it always has the next run to work on. We stop at the
+        first checkpoint that reports an error, knowing which lines it
+        was in.
+        :param multiline_input String of commands
+        :param encoded If True, the commands are already encoded as
+        encode_commands would, such as from CommandStore.select"""
+        data = multiline_input if encoded else encode_commands(multiline_input)
+        lines = data.split("\n")
+        if lines[-1] == "":
+            lines.pop()
+        windows = self.checkpoint_windows(lines)
+        self.clear_upload_error()
+
+        failed = None
+        sent = 0
+        start = time.time()
+        while failed is None and sent < len(windows):
+            # Add runs while they fit, and at least one
+            block = []
+            while sent < len(windows) and (
+                    self.outstanding_bytes + windows[sent][2] <= self.max_outstanding_bytes
+                    or self.outstanding_bytes == 0):
+                first, last, size = windows[sent]
+                block.append("\n".join(lines[first:last + 1]) + "\n" + CHECK_ERROR)
+                self.add_checkpoint(first, last, size)
+                sent += 1
+            if len(block) > 0:
+                self.write_checkpointed("".join(block), len(block))
+                logging.debug("Sent lines up to %d of %d" % (windows[sent - 1][1] + 1,
+                                                             len(lines)))
+                start = time.time()
+
+            # Wait for the controller to work through the oldest run
+            failed = self.read_checkpoints(wait=True, keep=max(0, len(self.checkpoints) - 1))
+
+        # Collect the rest of the replies, so none are left for later
+        rest = self.read_checkpoints(wait=True)
+        if failed is None:
+            failed = rest
+        self.record_latency(start)
+
+        if failed is not None:
+            self.set_upload_error(failed, lines)
+            logging.error("send_batched: Stopping on controller error "
+                          "after line %d of %d" % (windows[sent - 1][1] + 1, len(lines)))
+            return False
+        return True
+
+    def write_checkpointed(self, data, count):
+        """Write encoded lines with count ERR? checkpoints among them,
+        whose replies are read by checkpoint_reply"""
+        self.write(data)
+
+    @transaction
+    def query(self, command):
+        """Send a single query and return the controller's reply to it"""
+        self.send(command + "\n")
+        return self.get_response()
+
+    @transaction
+    def query_pipelined(self, commands):
+        """Send several queries in one write, then read all their replies
+        :param commands Queries, which may include single character
+        commands such as #9 (chr(9))
+        :return list of replies, in order"""
+        self.write(encode_queries(commands))
+        if self.debug:
+            logging.info("Receive in debug mode")
+            return ["0"] * len(commands)
+        return self.receive_responses(len(commands))
+
+    def receive_responses(self, count):
+        """Read the replies to count queries that have been sent
+        :return list of replies, in order"""
+        deadline = time.time() + self.timeout
+        responses = []
+        data = ""
+        while len(responses) < count:
+            received = self.receive(4096, deadline)
+            complete, data = split_responses(data + received)
+            responses += complete
+        return responses
+
+    def receive(self, size, deadline):
+        """Receive what the controller has sent, waiting until deadline
+        :raises ControllerTimeout if nothing came in time
+        :raises socket.error if the connection has closed"""
+        while True:
+            try:
+                received = self.socket.recv(size)
+            except socket.timeout:
+                if time.time() >= deadline:
+                    raise ControllerTimeout("No reply from controller at %s:%d" % (
+                        self.host, self.port))
+                logging.warning("Timeout on receive from socket")
+                continue
+            if len(received) == 0:
+                raise socket.error("Connection to controller closed")
+            return received
+
+    @transaction
+    def query_multiline(self, command):
+        """Send a query whose reply may run over many lines, such as DRR?,
+        and return all of it. Every line but the last ends in a space."""
+        self.send(command + "\n")
+        if self.debug:
+            logging.info("Receive in debug mode")
+            return ""
+
+        chunks = []
+        while True:
+            # Long replies take a while, so the deadline is for each part
+            received = self.receive(65536, time.time() + self.timeout)
+            chunks.append(received)
+            if received.endswith("\n") and not "".join(chunks[-2:]).endswith(" \n"):
+                return "".join(chunks)[:-1]
+
+    def check_error(self):
+        """Ask the controller for its error code, which also clears it.
+        Being a round trip, the time it takes is reported to metrics."""
+        start = time.time()
+        code = int(self.query("ERR?"))
+        self.record_latency(start)
+        return code
+
+    def record_latency(self, start):
+        """Report the time since start to metrics as an ERR? round trip"""
+        if self.metrics is not None:
+            self.metrics.record("ERR_LATENCY", (time.time() - start) * 1000.0)
+
     def get_response(self):
         """Receive a line from controller"""
         if not self.debug:
+            deadline = time.time() + self.timeout
             data = ""
             while "\n" not in data:
-                try:
-                    data = data + self.socket.recv(1024)
-                except:
-                    logging.warning("Timeout on receive from socket")
+                data = data + self.receive(1024, deadline)
             logging.info("RECEIVE: " + data)
         else:
             logging.info("Receive in debug mode")
@@ -80,3 +420,46 @@ class PIController():
     def __exit__(self, exc_type, exc_val, exc_tb):
         """Make sure we close the socket on destruction"""
         self.socket.close()
+
+def encode_commands(multiline_input):
+    """Encode a multiline string of commands as the bytes sent down
+    the wire: every line stripped, empty lines dropped, newline terminated"""
+    lines = [line.strip() for line in multiline_input.split("\n")]
+    return "".join([line + "\n" for line in lines if len(line) > 0])
+
+def encode_queries(commands):
+    """Join queries into one write. Single character commands need
+    no newline after them."""
+    return "".join([command if is_single_character(command) else command + "\n"
+                    for command in commands])
+
+def is_single_character(command):
+    """True for the single control character commands such as #9"""
+    return len(command) == 1 and ord(command) < 32
+
+def parse_values(reply):
+    """Parse a reply of <id>=<value> lines, such as to POS? or WGN?
+    :return dict of value by id"""
+    values = {}
+    for line in reply.split("\n"):
+        if "=" in line:
+            key, value = line.split("=", 1)
+            values[int(key)] = float(value)
+    return values
+
+def split_responses(data):
+    """Split received data into complete GCS responses.
+
+    Every line of a multi-line response except the last ends in a space
+    before the newline.
+    :return list of complete responses and the unterminated remainder"""
+    responses = []
+    start = 0
+    while True:
+        end = data.find("\n", start)
+        while end > start and data[end - 1] == " ":
+            end = data.find("\n", end + 1)
+        if end < 0:
+            return responses, data[start:]
+        responses.append(data[start:end])
+        start = end + 1
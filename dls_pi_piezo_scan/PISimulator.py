@@ -0,0 +1,639 @@
+#!/bin/env dls-python
+"""Local TCP server that simulates a PI E727 controller.
+
+Speaks the subset of the GCS command set this package sends, models the
+wave table memory, wave generators and data recorder, and can add the
+latency and bandwidth of an Ethernet or terminal server connection so
+uploads can be benchmarked without hardware."""
+
+# Standard dependencies
+import re
+import math
+import time
+import socket
+import Queue
+import logging
+import argparse
+import threading
+import SocketServer
+
+# Extra dependencies
+from pkg_resources import require
+require("numpy")
+import numpy
+
+from PIConstants import *
+
+# Link models: reply latency / s and bandwidth / bytes per second.
+# A terminal server is limited by the 115200 baud serial line behind it.
+LINK_PROFILES = {"ethernet": (0.0002, 10000000.0),
+                 "terminal_server": (0.005, 11520.0)}
+
+# Port the E727 listens on over Ethernet
+E727_ETHERNET_PORT = 50000
+
+# Limits of travel of the simulated stage / um
+MIN_POSITION = 0.0
+MAX_POSITION = 300.0
+
+# Wave generator start mode bits
+WGO_START = 0x1
+WGO_FROM_LAST_POSITION = 0x100
+
+# Characters that end a command: newline, or any single character command
+COMMAND_END = re.compile(r"[\n\x00-\x09\x0b-\x1f]")
+
+
+class GCSError(Exception):
+    """A command failed with a GCS error code"""
+    def __init__(self, code):
+        Exception.__init__(self, "GCS error %d" % code)
+        self.code = code
+
+
+class WaveTable():
+    """Segments of one wave table, joined up when the values are needed"""
+
+    def __init__(self):
+        self.segments = []
+        self.points = 0
+        self.cache = None
+
+    def append(self, segment):
+        self.segments.append(segment)
+        self.points += len(segment)
+        self.cache = None
+
+    def values(self):
+        if self.cache is None:
+            if len(self.segments) > 0:
+                self.cache = numpy.concatenate(self.segments)
+            else:
+                self.cache = numpy.zeros(0)
+        return self.cache
+
+
+class GeneratorRun():
+    """Snapshot of a wave generator from the moment it was started"""
+
+    def __init__(self, start_cycle, values, mode, cycles, rate, offset, origin):
+        self.start_cycle = start_cycle
+        self.values = values
+        self.mode = mode
+        self.cycles = cycles
+        self.rate = rate
+        self.offset = offset
+        self.origin = origin
+
+    def total_points(self):
+        """Points output before the generator stops, None if it never does"""
+        if self.cycles == 0:
+            return None
+        return self.cycles * len(self.values)
+
+    def output(self, servo_cycles):
+        """Generator output at an array of absolute servo cycle counts"""
+        if len(self.values) == 0:
+            return numpy.zeros(len(servo_cycles)) + self.origin
+
+        points = numpy.maximum(servo_cycles - self.start_cycle, 0) // self.rate
+        total = self.total_points()
+        if total is not None:
+            points = numpy.minimum(points, total - 1)
+        cycle = points // len(self.values)
+        output = self.values[points % len(self.values)] + self.offset
+        if self.mode & WGO_FROM_LAST_POSITION:
+            output = output + cycle * (self.values[-1] - self.values[0])
+        return output
+
+    def points_output(self, servo_cycle):
+        """Points output so far"""
+        points = max(servo_cycle - self.start_cycle, 0) // self.rate
+        total = self.total_points()
+        if total is not None:
+            points = min(points, total)
+        return points
+
+    def finished(self, servo_cycle):
+        total = self.total_points()
+        return total is not None and \
+            (servo_cycle - self.start_cycle) // self.rate >= total
+
+
+class PISimulator():
+    """State of a simulated E727 and the commands that act on it"""
+
+    def __init__(self, speed=1.0, clock=time.time,
+                 datapoints=E727_AVAILALBE_DATAPOINTS,
+                 recorder_points=E727_AVAILALBE_DATAPOINTS / E727_RECORDER_CHANNELS):
+        """:param speed How many times faster than real time the servo runs
+        :param clock Function giving the current time / s
+        :param datapoints Wave table memory shared by all tables / points
+        :param recorder_points Points each data recorder channel holds"""
+        self.speed = speed
+        self.clock = clock
+        self.datapoints = datapoints
+        self.recorder_points = recorder_points
+        self.epoch = clock()
+        self.lock = threading.Lock()
+
+        self.error = GCS_NO_ERROR
+        self.servo = dict((axis, 0) for axis in self.axes())
+        self.position = dict((axis, 0.0) for axis in self.axes())
+
+        self.tables = dict((table, WaveTable())
+                           for table in xrange(1, E727_WAVE_TABLES + 1))
+        self.generators = self.axes()
+        self.selected_table = dict((gen, gen) for gen in self.generators)
+        self.cycles = dict((gen, 0) for gen in self.generators)
+        self.offset = dict((gen, 0.0) for gen in self.generators)
+        self.wave_table_rate = dict((gen, 1) for gen in self.generators)
+        self.runs = {}
+
+        self.record_table_rate = 1
+        self.recorder = {}
+        self.record_start = None
+
+        self.trigger_points = {}
+        self.trigger_output = {}
+
+        self.commands = {"SVO": self.svo, "MOV": self.mov, "STP": self.stp,
+                         "WAV": self.wav, "WSL": self.wsl, "WGC": self.wgc,
+                         "WOS": self.wos, "WTR": self.wtr, "WGO": self.wgo,
+                         "RTR": self.rtr, "DRC": self.drc, "TWC": self.twc,
+                         "TWS": self.tws, "CTO": self.cto,
+                         "ERR?": self.err, "POS?": self.pos, "DRR?": self.drr,
+                         "DRL?": self.drl, "WGN?": self.wgn, "WGI?": self.wgi,
+                         "\x09": self.wave_generator_status}
+
+    def axes(self):
+        return range(1, E727_WAVE_GENERATORS + 1)
+
+    def servo_cycle(self):
+        """Servo cycles since the simulator was created"""
+        return int((self.clock() - self.epoch) * self.speed / E727_SERVO_CYCLE)
+
+    def used_datapoints(self):
+        return sum(table.points for table in self.tables.values())
+
+    def receive(self, data):
+        """Process received bytes.
+        :return list of replies and any incomplete command left over"""
+        replies = []
+        start = 0
+        for match in COMMAND_END.finditer(data):
+            if match.group() == "\n":
+                command = data[start:match.start()]
+            else:
+                command = match.group()
+            start = match.end()
+            reply = self.handle(command)
+            if reply is not None:
+                replies.append(reply)
+        return replies, data[start:]
+
+    def handle(self, command):
+        """Execute one command line, returning the reply for a query"""
+        if len(command) == 1 and ord(command) < 32:
+            # Single character command
+            words = [command]
+        else:
+            words = command.split()
+        if len(words) == 0:
+            return None
+
+        with self.lock:
+            try:
+                handler = self.commands[words[0].upper()]
+            except KeyError:
+                self.set_error(GCS_ERROR_UNKNOWN_COMMAND)
+                return None
+
+            try:
+                return handler(words[1:])
+            except GCSError as error:
+                self.set_error(error.code)
+            except (ValueError, IndexError):
+                self.set_error(GCS_ERROR_PARAM_SYNTAX)
+            if words[0].endswith("?"):
+                # Queries always get an answer
+                return ""
+
+    def set_error(self, code):
+        """Errors stick until read with ERR?, the first one wins"""
+        logging.debug("Simulator error %d" % code)
+        if self.error == GCS_NO_ERROR:
+            self.error = code
+
+    # Argument helpers
+
+    def pairs(self, args):
+        if len(args) == 0 or len(args) % 2 != 0:
+            raise GCSError(GCS_ERROR_PARAM_SYNTAX)
+        return zip(args[0::2], args[1::2])
+
+    def axis(self, word):
+        axis = int(word)
+        if axis not in self.axes():
+            raise GCSError(GCS_ERROR_INVALID_AXIS)
+        return axis
+
+    def table(self, word):
+        table = int(word)
+        if table not in self.tables:
+            raise GCSError(GCS_ERROR_PARAM_OUT_OF_RANGE)
+        return table
+
+    def generator_ids(self, word):
+        """Generator 0 addresses all of them"""
+        gen = int(word)
+        if gen == 0:
+            return self.generators
+        if gen not in self.generators:
+            raise GCSError(GCS_ERROR_PARAM_OUT_OF_RANGE)
+        return [gen]
+
+    # Motion
+
+    def current_position(self, axis, servo_cycle):
+        if axis in self.runs:
+            return float(self.runs[axis].output(numpy.array([servo_cycle]))[0])
+        return self.position[axis]
+
+    def svo(self, args):
+        for axis, state in self.pairs(args):
+            self.servo[self.axis(axis)] = int(state)
+
+    def mov(self, args):
+        for axis, target in self.pairs(args):
+            axis = self.axis(axis)
+            target = float(target)
+            if not self.servo[axis]:
+                raise GCSError(GCS_ERROR_MOVE_WITHOUT_SERVO)
+            if target < MIN_POSITION or target > MAX_POSITION:
+                raise GCSError(GCS_ERROR_POS_OUT_OF_LIMITS)
+            self.position[axis] = target
+
+    def stp(self, args):
+        self.stop_generators(self.generators)
+        # A real E727 reports that it was stopped
+        self.set_error(GCS_ERROR_STOPPED)
+
+    def pos(self, args):
+        servo_cycle = self.servo_cycle()
+        axes = [self.axis(axis) for axis in args] or self.axes()
+        return " \n".join(["%d=%f" % (axis, self.current_position(axis, servo_cycle))
+                           for axis in axes])
+
+    # Wave tables and generators
+
+    def wav(self, args):
+        """WAV <table> X|& LIN|SIN_P <seglength> <amplitude> <offset>
+        <wavelength> <startpoint> <speedupdown or curvecenterpoint>"""
+        table = self.table(args[0])
+        action = args[1]
+        shape = args[2].upper()
+        seglength, amplitude, offset, wavelength, startpoint = \
+            int(args[3]), float(args[4]), float(args[5]), int(args[6]), int(args[7])
+        if action not in (ACTION_REPLACE, ACTION_APPEND) or \
+                shape not in ("LIN", "SIN_P") or len(args) != 9:
+            raise GCSError(GCS_ERROR_PARAM_SYNTAX)
+        if seglength < 1 or wavelength < 1 or startpoint < 0:
+            raise GCSError(GCS_ERROR_PARAM_OUT_OF_RANGE)
+
+        # Replacing frees the table's points before we check for room
+        freed = self.tables[table].points if action == ACTION_REPLACE else 0
+        if self.used_datapoints() - freed + seglength > self.datapoints:
+            raise GCSError(GCS_ERROR_PARAM_OUT_OF_RANGE)
+
+        phase = (numpy.arange(seglength) - startpoint) / float(wavelength)
+        phase = numpy.clip(phase, 0.0, 1.0)
+        if shape == "LIN":
+            segment = offset + amplitude * phase
+        else:
+            segment = offset + amplitude * (1.0 - numpy.cos(2.0 * math.pi * phase)) / 2.0
+
+        if action == ACTION_REPLACE:
+            self.tables[table] = WaveTable()
+        self.tables[table].append(segment)
+
+    def wsl(self, args):
+        for gen, table in self.pairs(args):
+            for gen in self.generator_ids(gen):
+                self.selected_table[gen] = self.table(table)
+
+    def wgc(self, args):
+        for gen, cycles in self.pairs(args):
+            if int(cycles) < 0:
+                raise GCSError(GCS_ERROR_PARAM_OUT_OF_RANGE)
+            for gen in self.generator_ids(gen):
+                self.cycles[gen] = int(cycles)
+
+    def wos(self, args):
+        for gen, offset in self.pairs(args):
+            for gen in self.generator_ids(gen):
+                self.offset[gen] = float(offset)
+
+    def wtr(self, args):
+        """WTR <generator> <rate> <interpolation>"""
+        if len(args) % 3 != 0:
+            raise GCSError(GCS_ERROR_PARAM_SYNTAX)
+        for i in xrange(0, len(args), 3):
+            rate = int(args[i + 1])
+            if rate < 1:
+                raise GCSError(GCS_ERROR_PARAM_OUT_OF_RANGE)
+            for gen in self.generator_ids(args[i]):
+                self.wave_table_rate[gen] = rate
+
+    def wgo(self, args):
+        servo_cycle = self.servo_cycle()
+        for gen, mode in self.pairs(args):
+            gen = self.axis(gen)
+            mode = int(mode)
+            if not mode & WGO_START:
+                self.stop_generators([gen])
+                continue
+            if not self.servo[gen]:
+                raise GCSError(GCS_ERROR_MOVE_WITHOUT_SERVO)
+            values = self.tables[self.selected_table[gen]].values()
+            self.runs[gen] = GeneratorRun(servo_cycle, values, mode,
+                                          self.cycles[gen],
+                                          self.wave_table_rate[gen],
+                                          self.offset[gen],
+                                          self.current_position(gen, servo_cycle))
+            # Starting a generator starts a new recording
+            self.record_start = servo_cycle
+
+    def running_generators(self, servo_cycle):
+        return [gen for gen in sorted(self.runs)
+                if not self.runs[gen].finished(servo_cycle)]
+
+    def wave_generator_status(self, args):
+        """#9: bit n-1 set while generator n is running"""
+        return "%d" % sum(1 << (gen - 1)
+                          for gen in self.running_generators(self.servo_cycle()))
+
+    def generator_progress(self, args):
+        """Points each generator asked about has output so far, and the
+        length of its table"""
+        servo_cycle = self.servo_cycle()
+        progress = []
+        for gen in [self.axis(gen) for gen in args] or self.generators:
+            run = self.runs.get(gen)
+            if run is None or len(run.values) == 0:
+                progress.append((gen, 0, 1))
+            else:
+                progress.append((gen, run.points_output(servo_cycle), len(run.values)))
+        return progress
+
+    def wgn(self, args):
+        """WGN? [<generator>...] cycles completed since the generator started"""
+        return " \n".join(["%d=%d" % (gen, points // length)
+                            for gen, points, length in self.generator_progress(args)])
+
+    def wgi(self, args):
+        """WGI? [<generator>...] index of the wave table point being output"""
+        return " \n".join(["%d=%d" % (gen, points % length)
+                            for gen, points, length in self.generator_progress(args)])
+
+    def stop_generators(self, generators):
+        servo_cycle = self.servo_cycle()
+        for gen in generators:
+            if gen in self.runs:
+                self.position[gen] = self.current_position(gen, servo_cycle)
+                del self.runs[gen]
+
+    # Triggers
+
+    def twc(self, args):
+        self.trigger_points = {}
+
+    def cto(self, args):
+        if len(args) % 3 != 0:
+            raise GCSError(GCS_ERROR_PARAM_SYNTAX)
+        for i in xrange(0, len(args), 3):
+            self.trigger_output[(int(args[i]), int(args[i + 1]))] = args[i + 2]
+
+    def tws(self, args):
+        """TWS {<output> <point> <switch>}"""
+        if len(args) == 0 or len(args) % 3 != 0:
+            raise GCSError(GCS_ERROR_PARAM_SYNTAX)
+        for i in xrange(0, len(args), 3):
+            output, point, switch = int(args[i]), int(args[i + 1]), int(args[i + 2])
+            if point < 1:
+                raise GCSError(GCS_ERROR_PARAM_OUT_OF_RANGE)
+            self.trigger_points[(output, point)] = switch
+
+    # Data recorder
+
+    def rtr(self, args):
+        rate = int(args[0])
+        if rate < 1:
+            raise GCSError(GCS_ERROR_PARAM_OUT_OF_RANGE)
+        self.record_table_rate = rate
+
+    def drc(self, args):
+        """DRC <channel> <source axis> <record option>"""
+        if len(args) % 3 != 0:
+            raise GCSError(GCS_ERROR_PARAM_SYNTAX)
+        for i in xrange(0, len(args), 3):
+            channel = int(args[i])
+            if channel < 1 or channel > E727_RECORDER_CHANNELS:
+                raise GCSError(GCS_ERROR_PARAM_OUT_OF_RANGE)
+            self.recorder[channel] = (self.axis(args[i + 1]), int(args[i + 2]))
+
+    def recorded_points(self):
+        if self.record_start is None:
+            return 0
+        elapsed = self.servo_cycle() - self.record_start
+        return min(elapsed // self.record_table_rate + 1, self.recorder_points)
+
+    def recorded_data(self, channel, first, count):
+        """Values in a recorder channel. With an ideal servo the target
+        and actual positions are the same."""
+        axis = self.recorder[channel][0]
+        servo_cycles = self.record_start + \
+            (first + numpy.arange(count)) * self.record_table_rate
+        if axis in self.runs:
+            return self.runs[axis].output(servo_cycles)
+        return numpy.zeros(count) + self.position[axis]
+
+    def drl(self, args):
+        """DRL? [<channel>...] points recorded so far"""
+        channels = [int(ch) for ch in args] or sorted(self.recorder)
+        for channel in channels:
+            if channel not in self.recorder:
+                raise GCSError(GCS_ERROR_PARAM_OUT_OF_RANGE)
+        points = self.recorded_points()
+        return " \n".join(["%d=%d" % (channel, points) for channel in channels])
+
+    def drr(self, args):
+        """DRR? [<start point> <number of points> [<channel>...]]"""
+        available = self.recorded_points()
+        first = int(args[0]) if len(args) > 0 else 1
+        count = int(args[1]) if len(args) > 1 else available
+        channels = [int(ch) for ch in args[2:]] or sorted(self.recorder)
+        if first < 1 or count < 0:
+            raise GCSError(GCS_ERROR_PARAM_OUT_OF_RANGE)
+        for channel in channels:
+            if channel not in self.recorder:
+                raise GCSError(GCS_ERROR_PARAM_OUT_OF_RANGE)
+        count = max(0, min(count, available - first + 1))
+
+        header = ["# REM E-727",
+                  "# VERSION = 1",
+                  "# TYPE = 1",
+                  "# SEPARATOR = 32",
+                  "# DIM = %d" % len(channels),
+                  "# SAMPLE_TIME = %f" % (self.record_table_rate * E727_SERVO_CYCLE),
+                  "# NDATA = %d" % count]
+        header += ["# NAME%d = Axis %d %s" % (i, self.recorder[ch][0],
+                   "Target Position" if self.recorder[ch][1] == 1 else "Current Position")
+                   for i, ch in enumerate(channels)]
+        header.append("# END_HEADER")
+        reply = " \n".join(header)
+        if count == 0 or len(channels) == 0:
+            return reply
+
+        data = numpy.column_stack([self.recorded_data(ch, first - 1, count)
+                                   for ch in channels])
+        row = " ".join(["%f"] * len(channels))
+        values = ((row + " \n") * count) % tuple(data.ravel())
+        # The last line of a reply has no trailing space
+        return reply + " \n" + values[:-2]
+
+    def err(self, args):
+        error = self.error
+        self.error = GCS_NO_ERROR
+        return "%d" % error
+
+
+class SimulatorHandler(SocketServer.BaseRequestHandler):
+    """Serves one client connection, limited to the link's latency and
+    bandwidth. Replies are sent a latency after the commands they answer
+    came in, by a thread of their own, so that like the controller we get
+    on with the next commands in the meantime."""
+
+    def handle(self):
+        server = self.server
+        # Replies go as soon as they are due, as from the controller
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        replies = Queue.Queue()
+        sender = threading.Thread(target=self.send_replies, args=(replies,))
+        sender.daemon = True
+        sender.start()
+
+        data = ""
+        try:
+            while True:
+                received = self.request.recv(4096)
+                if len(received) == 0:
+                    return
+                arrived = time.time()
+                if server.bandwidth:
+                    time.sleep(len(received) / server.bandwidth)
+
+                responses, data = server.simulator.receive(data + received)
+                if len(responses) > 0:
+                    # The replies to everything that came in one go
+                    # share a single trip back over the link
+                    replies.put((arrived + server.latency,
+                                 "".join([response + "\n" for response in responses])))
+        finally:
+            replies.put(None)
+
+    def send_replies(self, replies):
+        """Send each batch of replies once it is due, at the link's bandwidth"""
+        server = self.server
+        while True:
+            batch = replies.get()
+            if batch is None:
+                return
+            due, reply = batch
+            if server.bandwidth:
+                due += len(reply) / server.bandwidth
+            time.sleep(max(0.0, due - time.time()))
+            try:
+                self.request.sendall(reply)
+            except socket.error:
+                return
+
+
+class PISimulatorServer(SocketServer.ThreadingTCPServer):
+    """TCP server for a simulated controller"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", E727_ETHERNET_PORT),
+                 simulator=None, latency=None, bandwidth=None):
+        """:param address (host, port) to listen on, port 0 picks a free one
+        :param simulator PISimulator to serve, a new one by default
+        :param latency Delay before the replies to each batch of
+        commands received / s, default from the port
+        :param bandwidth Bytes per second each way, default from the port"""
+        profile = LINK_PROFILES[link_profile_for_port(address[1])]
+        self.simulator = simulator or PISimulator()
+        self.latency = profile[0] if latency is None else latency
+        self.bandwidth = profile[1] if bandwidth is None else bandwidth
+        SocketServer.ThreadingTCPServer.__init__(self, address, SimulatorHandler)
+        self.thread = None
+
+    def start(self):
+        """Serve in a background thread
+        :return (host, port) clients should connect to"""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def link_profile_for_port(port):
+    """The E727 itself listens on port 50000, anything else is assumed to
+    be a terminal server in front of its serial port"""
+    if port in (0, E727_ETHERNET_PORT):
+        return "ethernet"
+    return "terminal_server"
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Simulate a PI E727 controller on a local TCP port, "
+                                     "for testing and benchmarking scans without hardware.")
+
+    parser.add_argument("--address", type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=E727_ETHERNET_PORT,
+                        help="Port to listen on. 50000 behaves like the controller's Ethernet "
+                        "port, anything else like a terminal server port")
+    parser.add_argument("--profile", choices=sorted(LINK_PROFILES), help="Link to model, overrides the port")
+    parser.add_argument("--latency", type=float, help="Reply latency (s)")
+    parser.add_argument("--bandwidth", type=float, help="Link bandwidth (bytes/s), 0 for unlimited")
+    parser.add_argument("--speed", type=float, default=1.0, help="Run the servo this many times faster than real time")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+
+    logging.basicConfig(level=logging.INFO)
+
+    latency, bandwidth = args.latency, args.bandwidth
+    if args.profile is not None:
+        profile = LINK_PROFILES[args.profile]
+        latency = profile[0] if latency is None else latency
+        bandwidth = profile[1] if bandwidth is None else bandwidth
+
+    server = PISimulatorServer((args.address, args.port),
+                               PISimulator(speed=args.speed),
+                               latency=latency, bandwidth=bandwidth)
+    logging.info("Simulating E727 on %s:%d, latency %f s, bandwidth %f bytes/s" % (
+        args.address, args.port, server.latency, server.bandwidth))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
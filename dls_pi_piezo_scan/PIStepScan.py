@@ -4,6 +4,10 @@ import logging
 
 # Extra dependencies
 from pkg_resources import require
+require("numpy")
+import numpy
+require('cothread')
+import cothread
 
 # Other files in this module
 import CommandTemplates
@@ -11,6 +15,16 @@ import RecordInterface
 import CommandStore
 import PIController
 import CoordinateTransform
+import WaveEncoder
+import PlanCache
+import ScanMetrics
+import DataRecorderReader
+import RecordingWriter
+import ScanMonitor
+import ConfigureWorker
+import TriggerTable
+import ScanQueue
+import WaveTableRate
 
 from PIConstants import *
 
@@ -23,6 +37,18 @@ max_x = 300.0
 max_y = 300.0
 max_z = 300.0
 
+# Parameters that don't change the commands for a scan
+NON_PLAN_PARAMETERS = ("STATE", "start_scan", "configure_scan", "abort_scan")
+
+# Groups of setup commands after the wave tables, each sent
+# only when it has changed since the last upload
+REST_GROUPS = ("rates", "routing", "recorder", "offsets")
+
+# Groups sent on every upload whether they have changed or not. Generators
+# started with WGO mode 257 move their offsets on as they play, so the
+# controller's offsets are only the ones we sent until a scan starts.
+ALWAYS_SENT_GROUPS = ("offsets",)
+
 class Param():
     """A parameter with some of the same interface as an EPICS
     record from epicsdbbuilder, so we can post params in externally."""
@@ -57,14 +83,65 @@ class PIStepScan():
         # Placeholder for EPICS records. Remains None if we
         # use outside an IOC
         self.records = None
+        # Read-only records reporting on the scan, if we have any
+        self.status_records = {}
+        # Records saying where to write recorded data, if we have any
+        self.file_records = {}
+
+        # Wave table contents described by the scan, and the points
+        # they use once encoded, per table
+        self.wave_blocks = []
+        self.table_points = {}
+
+        # Commands compiled for parameters we have configured before
+        self.plan_cache = PlanCache.PlanCache()
+
+        # Hash of each group of setup commands the controller has now
+        self.uploaded = {}
+
+        # Timings and sizes of recent scans, shared with the controller
+        # so it can report round trip times
+        self.metrics = ScanMetrics.ScanMetrics()
+        self.controller.metrics = self.metrics
+
+        # Follows started scans, if we have records to report to
+        self.monitor = None
+
+        # Configures in the background when CONFIGURE is put, if we have records
+        self.worker = None
+
+        # Scans to run one after another, if we have records
+        self.queue = None
+
+        # Called with the new state whenever it changes, e.g. by a ScanManager
+        self.state_callback = None
+
+        # Bank of wave tables the scan is written to, and parameters
+        # used instead of the records, both set by a ScanQueue
+        self.table_bank = 0
+        self.param_overrides = {}
+
+        # Wave table points held by tables that stay on the controller
+        # alongside this scan's, e.g. the bank still playing while a
+        # queue loads the next scan into the other one
+        self.resident_points = 0
 
     def create_records(self):
         """Create records for EPICS interface"""
 
-        self.records = RecordInterface.create_records(configure_scan_function=self.configure_scan,
-                                                        start_scan_function=self.start_scan,
+        self.worker = ConfigureWorker.ConfigureWorker(self)
+        self.records = RecordInterface.create_records(configure_scan_function=self.worker.configure,
+                                                        start_scan_function=self.worker.start,
+                                                        abort_scan_function=self.abort_scan,
                                                       min_x=min_x, min_y=min_y, min_z=min_z,
                                                       max_x=max_x, max_y=max_y, max_z=max_z)
+        self.status_records = RecordInterface.create_status_records()
+        self.file_records = RecordInterface.create_file_records(save_function=self.save)
+        self.metrics.records = RecordInterface.create_metrics_records(
+            ScanMetrics.TIMINGS, ScanMetrics.SIZES)
+        self.monitor = ScanMonitor.ScanMonitor(self)
+        self.queue = ScanQueue.ScanQueue(self)
+        self.queue.create_records()
 
     def insert_params(self, params):
         """Create "records" from an external list, which are actually Param objects"""
@@ -74,6 +151,11 @@ class PIStepScan():
             self.records[key] = Param(value)
 
 
+    def current_parameters(self):
+        """Values of the records that describe the scan, e.g. to queue it"""
+        return dict((key, record.get()) for key, record in self.records.iteritems()
+                    if key not in NON_PLAN_PARAMETERS)
+
     def load_command_templates(self):
         """Makes the command templates accessible"""
 
@@ -101,36 +183,101 @@ class PIStepScan():
         # Get all the values from our records
         for key, record in self.records.iteritems():
             self.params[key] = record.get()
+        self.params.update(self.param_overrides)
+
+        # Wave tables the X, Y and Z generators play
+        offset = self.table_bank * TABLES_PER_BANK
+        self.params.update({"TABLE_OFFSET": offset,
+                            "WAVE_TABLEX": TABLEX + offset,
+                            "WAVE_TABLEY": TABLEY + offset,
+                            "WAVE_TABLEZ": TABLEZ + offset})
+        self.choose_rates()
+
+    def choose_rates(self):
+        """Set the wave table and data recorder rates, WTR and RTR, and
+        MOVETIME and EXPOSURE in wave table points at that rate"""
+        if self.scan_mode() == SCAN_MODE_FLY:
+            # The rate is set by the row rate, and there is no dwell
+            rate, points = self.fly_timing()
+            self.params.update({"WTR": rate, "RTR": rate})
+            return
+
+        if self.params.get("AUTO_RATE", False):
+            rate, (move, exposure) = WaveTableRate.choose_rate(
+                [self.params["MOVETIME"], self.params["EXPOSURE"]],
+                self.params.get("RATE_TOLERANCE", DEFAULT_RATE_TOLERANCE))
+            logging.info("Wave table rate %d: %f ms per point" % (
+                rate, rate * E727_SERVO_CYCLE * 1000.0))
+        else:
+            rate = DEFAULT_WAVE_TABLE_RATE
+            # The records are floats, but segments are whole points
+            move, exposure = [int(round(self.params[name]))
+                              for name in ("MOVETIME", "EXPOSURE")]
+        self.params.update({"WTR": rate,
+                            "RTR": rate * RECORD_RATE_FACTOR,
+                            "MOVE_POINTS": move,
+                            "EXPOSURE_POINTS": exposure})
+
+    def scan_mode(self):
+        return self.params.get("SCAN_MODE", SCAN_MODE_STEP)
+
+    def scan_extent(self):
+        """Lowest and highest demand positions on each axis,
+        relative to X0, Y0 and Z0
+        :return two arrays of x, y, z"""
+        ranges = numpy.array([self.params["DX"] * self.params["NX"],
+                              self.params["DY"] * self.params["NY"],
+                              self.params["DZ"] * self.params["NZ"]])
+
+        if self.scan_mode() == SCAN_MODE_ROTATED:
+            # Where the corners of the sample frame grid end up in the lab
+            corners = numpy.array([[x, y, 0.0] for x in (0.0, ranges[0])
+                                   for y in (0.0, ranges[1])])
+            lab = self.transform.forward_array(corners, theta=self.params["THETA"])
+            return lab.min(axis=0), lab.max(axis=0)
+
+        if self.scan_mode() == SCAN_MODE_FLY:
+            # Rows run half a step either side of the columns
+            half_step = numpy.array([self.params["DX"] / 2.0, 0.0, 0.0])
+            return -half_step, ranges * [1, 1, 0] - half_step
+
+        return numpy.zeros(3), ranges
 
     def verify_parameters(self):
         """Check validity of scan parameters"""
-        x_range = self.params["DX"] * self.params["NX"]
-        y_range = self.params["DY"] * self.params["NY"]
-        z_range = self.params["DZ"] * self.params["NZ"]
+        low, high = self.scan_extent()
 
         failure = []
 
-        # Won't hit x limit
-        if self.params["X0"] < min_x:
-            failure.append("Will hit x negative limit")
-        if self.params["X0"] + x_range > max_x:
-            failure.append("Will hit x positive limit")
-
-        # Won't hit y limit
-        if self.params["Y0"] < min_y:
-            failure.append("Will hit y negative limit")
-        if self.params["Y0"] + y_range > max_y:
-            failure.append("Will hit y positive limit")
-
-        # Won't hit z limit
-        if self.params["Z0"]  < min_z:
-            failure.append("Will hit z negative limit")
-        if self.params["Z0"] + z_range > max_z:
-            failure.append("Will hit z positive limit")
-
-        # Number of wave points can fit in available memory
-        total_points = self.calculate_required_data_points()
+        # Won't hit x, y or z limits
+        for axis, origin, lowest, highest, min_limit, max_limit in zip(
+                ("x", "y", "z"),
+                (self.params["X0"], self.params["Y0"], self.params["Z0"]),
+                low, high, (min_x, min_y, min_z), (max_x, max_y, max_z)):
+            if origin + lowest < min_limit:
+                failure.append("Will hit %s negative limit" % axis)
+            if origin + highest > max_limit:
+                failure.append("Will hit %s positive limit" % axis)
+
+        if self.scan_mode() == SCAN_MODE_FLY and \
+                self.params["ROW_RATE"] > FLY_MAX_ROW_RATE:
+            failure.append("Row rate too high. Position lags demand by over "
+                           "2 um above %.0f Hz" % FLY_MAX_ROW_RATE)
+
+        # Every segment is at least a point long
+        if self.scan_mode() != SCAN_MODE_FLY:
+            point_time = self.params["WTR"] * E727_SERVO_CYCLE * 1000.0
+            for name, points in (("MOVETIME", "MOVE_POINTS"),
+                                 ("EXPOSURE", "EXPOSURE_POINTS")):
+                if self.params[points] < 1:
+                    failure.append("%s too short. Less than one wave table "
+                                   "point of %f ms" % (name, point_time))
+
+        # Number of wave points can fit in available memory,
+        # along with any tables that are staying
+        total_points = self.calculate_required_data_points() + self.resident_points
         points_percentage = float(total_points) / float(E727_AVAILALBE_DATAPOINTS) * 100.0
+        self.publish_table_points(points_percentage)
 
         if total_points > E727_AVAILALBE_DATAPOINTS:
             failure.append("Too many points in scan. "
@@ -149,19 +296,28 @@ class PIStepScan():
             return True
 
     def calculate_required_data_points(self):
-        # TODO: Not sure this is a perfect calculation yet
-        # TODO: Only valid with 1ms per point (WTR = 20) as currently
-        # TODO actually its definitely not because Y takes less than the others
-        points_per_x_step = self.params["MOVETIME"] + self.params["EXPOSURE"]
-        points_per_y_step = self.params["MOVETIME"] + self.params["EXPOSURE"]
-        points_per_z_step = self.params["MOVETIME"] + self.params["EXPOSURE"]
-        total_points = points_per_x_step * self.params["NX"] + \
-                       points_per_y_step * self.params["NY"] + \
-                       points_per_z_step * self.params["NZ"]
-        return total_points
+        """Total wave table points used by the setup commands, as counted
+        when they were encoded. Segment lengths are in points, so this
+        holds whatever the wave table rate."""
+        return sum(self.table_points.values())
+
+    def publish_table_points(self, points_percentage):
+        """Report wave table usage per axis"""
+        for axis, table in (("X", TABLEX), ("Y", TABLEY), ("Z", TABLEZ)):
+            points = self.table_points.get(table, 0)
+            logging.info("Wave table %d (%s) uses %d points" % (table, axis, points))
+            self.set_status("POINTS_" + axis, points)
+        self.set_status("POINTS_USED", points_percentage)
+
+    def set_status(self, name, value):
+        """Set a status record, if we have it"""
+        if name in self.status_records:
+            self.status_records[name].set(value)
 
     def set_state(self, new_state):
         self.records["STATE"].set(new_state)
+        if self.state_callback is not None:
+            self.state_callback(new_state)
 
     def get_state(self):
         return self.records["STATE"].get()
@@ -169,30 +325,83 @@ class PIStepScan():
     def configure_scan(self):
         """Sets up a scan"""
 
+        with self.metrics.timed("CONFIGURE_TIME"):
+            return self.configure_scan_phases()
+
+    def configure_scan_phases(self):
+        """The steps of configure_scan, each one timed"""
+
         self.set_state(STATE_PREPARING)
-        self.get_scan_parameters()
+        with self.metrics.timed("GATHER_TIME"):
+            self.get_scan_parameters()
+
+        # Reuse the commands if we have seen these parameters before,
+        # otherwise generate them first, since that counts
+        # the wave table points we need to check
+        with self.metrics.timed("GENERATE_TIME"):
+            generated = self.generate_commands()
+        self.metrics.set_counter("CACHE_HITS", self.plan_cache.hits)
+        self.metrics.set_counter("CACHE_MISSES", self.plan_cache.misses)
+        if generated == False:
+            self.set_state(STATE_ERROR)
+            return False
 
         # Check parameters are valid
-        if self.verify_parameters() == False:
+        with self.metrics.timed("VERIFY_TIME"):
+            verified = self.verify_parameters()
+        if verified == False:
             # Parameter checks failed
             self.set_state(STATE_ERROR)
             return False
 
-        if self.prepare_setup_commands() == False:
+        with self.metrics.timed("UPLOAD_TIME"):
+            sent = self.send_setup_commands()
+        if sent == False:
             self.set_state(STATE_ERROR)
             return False
 
+        if True:
+            # If we got to this point then configured scan OK.
+            self.set_state(STATE_READY)
+
+    def generate_commands(self):
+        """Use cached commands for the current parameters, or prepare them"""
+        if self.load_cached_plan():
+            return True
+
+        if self.prepare_setup_commands() == False:
+            return False
+
         if self.prepare_start_commands() == False:
-            self.set_state(STATE_ERROR)
             return False
 
-        if self.send_setup_commands() == False:
-            self.set_state(STATE_ERROR)
+        self.save_plan()
+        return True
+
+    def plan_key(self):
+        """Hash of the parameters that determine the scan commands"""
+        return PlanCache.PlanCache.key(dict(
+            (key, value) for key, value in self.params.iteritems()
+            if key not in NON_PLAN_PARAMETERS))
+
+    def load_cached_plan(self):
+        """Use cached commands for the current parameters if we have them
+        :return True if we found a plan"""
+        plan = self.plan_cache.get(self.plan_key())
+        if plan is None:
             return False
 
-        if True:
-            # If we got to this point then configured scan OK.
-            self.set_state(STATE_READY)
+        logging.info("Using cached commands for these scan parameters")
+        self.setup_commands = plan.setup_commands.copy()
+        self.start_commands = plan.start_commands.copy()
+        self.table_points = dict(plan.table_points)
+        return True
+
+    def save_plan(self):
+        """Cache the commands prepared for the current parameters"""
+        self.plan_cache.put(self.plan_key(), PlanCache.ScanPlan(
+            self.setup_commands.copy(), self.start_commands.copy(),
+            dict(self.table_points)))
 
     def start_scan(self, value = None):
         """starts a scan which has already been configured"""
@@ -210,23 +419,24 @@ class PIStepScan():
                 logging.error("Error sending start commands.")
                 return False
 
-            # Started scan OK.
+            self.scan_started()
+
+    def scan_started(self):
+        """Started scan OK. With a monitor, we are running until
+        it sees the wave generators stop"""
+        if self.monitor is not None:
+            self.set_state(STATE_SCAN_RUNNING)
+            self.monitor.start()
+        else:
             self.set_state(STATE_READY)
 
     def create_odd_rows(self):
         """Create an odd row: x steps forwards then y makes one step forwards"""
 
-        # Add the x steps forwards
-        for step in xrange(self.params["NX"]):
-            if step == 0:
-                # First step replaces wavetable contents
-                action = ACTION_REPLACE
-            else:
-                # Subsequent steps are appended
-                action = ACTION_APPEND
-
-            self.setup_commands.add(self.templates["x_step"].format(
-                xDemand=self.params["DX"] * step, first=action, TABLE=TABLEX, **self.params))
+        # Add the x steps forwards.
+        # First step replaces wavetable contents, the rest are appended
+        x_demand = self.params["DX"] * numpy.arange(self.params["NX"])
+        self.add_x_steps(ACTION_REPLACE, x_demand)
 
         # Add the y step
         # Y waits while X is going forward
@@ -234,9 +444,9 @@ class PIStepScan():
 
         # How long y waits while x is moving
         y_wait_time = self.params["NX"] * (
-                self.params["MOVETIME"] + self.params["EXPOSURE"])
+                self.params["MOVE_POINTS"] + self.params["EXPOSURE_POINTS"])
         # Time for y to move one step
-        y_move_time = self.params["MOVETIME"]
+        y_move_time = self.params["MOVE_POINTS"]
         # y position before step
         # is zero because we set generator to start where it left off
         y0 = 0
@@ -246,26 +456,15 @@ class PIStepScan():
         x_demand = (self.params["NX"] - 1) * self.params["DX"]
 
         # Add the commands
-        self.setup_commands.add(
-            self.templates["y_step"].format(y0=y0, y1=y1, first=ACTION_REPLACE,
-                                            yWaitTime=y_wait_time,
-                                            yMOVETIME=y_move_time,
-                                            xDemand=x_demand,
-                                            TABLE=TABLEY,
-                                            **self.params))
+        self.add_y_step(TABLEY, ACTION_REPLACE, y0, y1, y_wait_time, y_move_time, x_demand)
 
     def create_even_rows(self):
         """Create an even-numbered row: x steps backwards then y makes one step forwards"""
 
         # Add the x steps backwards
-        for step in xrange(self.params["NX"]):
-            # Always append since even row is added after odd
-            action = ACTION_APPEND
-            x_demand = self.params["DX"] * (self.params["NX"] - 1 - step)
-            self.setup_commands.add(
-                self.templates["x_step"].format(xDemand=x_demand, first=action,
-                                                TABLE=TABLEX,
-                                                **self.params))
+        # Always append since even row is added after odd
+        x_demand = self.params["DX"] * (self.params["NX"] - 1 - numpy.arange(self.params["NX"]))
+        self.add_x_steps(ACTION_APPEND, x_demand)
 
         # Add the y step
         # Y waits while X is going forward
@@ -273,9 +472,9 @@ class PIStepScan():
 
         # How long Y waits for while X is moving
         y_wait_time = self.params["NX"] * (
-        self.params["MOVETIME"] + self.params["EXPOSURE"])
+        self.params["MOVE_POINTS"] + self.params["EXPOSURE_POINTS"])
         # Time for Y to complete 1 step
-        y_move_time = self.params["MOVETIME"]
+        y_move_time = self.params["MOVE_POINTS"]
         # Y start position for step: from endpoint of previous step
         y0 = self.params["DY"]
         # Y end position for step
@@ -284,62 +483,284 @@ class PIStepScan():
         x_demand = 0 * self.params["DX"]
 
         # Add the commands
+        self.add_y_step(TABLEX, ACTION_APPEND, y0, y1, y_wait_time, y_move_time, x_demand)
+
+    def create_rotated_rows(self):
+        """Create one row of the sample frame grid rotated by THETA into the
+        lab frame, as a table for each axis that moves.
+
+        Rows all go the same way. The row holds the first point for EXPOSURE,
+        moves to and exposes each of the others, then moves to the start of
+        the next row. Rotation is linear, so every row is the first one
+        shifted by the same amount: each table is played for NY cycles from
+        the last position, and holds one row rather than the whole scan."""
+        nx = self.params["NX"]
+
+        # Sample frame positions along the row, then the start of the next row
+        sample = numpy.zeros((nx + 1, 3))
+        sample[:nx, 0] = self.params["DX"] * numpy.arange(nx)
+        sample[nx, 1] = self.params["DY"]
+        lab = self.transform.forward_array(sample, theta=self.params["THETA"])
+
+        lengths = numpy.roll(numpy.tile([self.params["MOVE_POINTS"],
+                                         self.params["EXPOSURE_POINTS"]], nx), -1)
+        for table, demand in zip((TABLEX, TABLEY, TABLEZ), lab.T):
+            # An axis the rotation leaves still doesn't need a table
+            if numpy.ptp(demand) > WaveEncoder.VALUE_TOLERANCE:
+                self.add_holds(table, ACTION_REPLACE,
+                               numpy.repeat(demand, 2)[1:-1], lengths)
+
+    def create_volume_tables(self):
+        """Create the tables for a stack of NZ layers, each a grid of NY
+        rows of NX points, as one hardware timed sequence.
+
+        X holds one row and is played for every row of every layer. Y holds
+        one layer, stepping DY each row and going back to the first row at
+        the end. Z holds one layer too, stepping DZ at the end, and is played
+        from the last position so each layer is DZ above the last. Each axis
+        moves to the next point during the MOVETIME that ends a row or layer."""
+        nx = self.params["NX"]
+        ny = self.params["NY"]
+        move = self.params["MOVE_POINTS"]
+        row_length = nx * (move + self.params["EXPOSURE_POINTS"])
+
+        # Expose each point, then move to the start of the next row
+        x_demand = numpy.append(self.params["DX"] * numpy.arange(nx), 0.0)
+        self.add_holds(TABLEX, ACTION_REPLACE, numpy.repeat(x_demand, 2)[1:-1],
+                       numpy.roll(numpy.tile([move, self.params["EXPOSURE_POINTS"]], nx), -1))
+
+        # Each row at its own y, then move to the next row, or the first
+        y_demand = self.params["DY"] * numpy.arange(ny)
+        self.add_holds(TABLEY, ACTION_REPLACE,
+                       numpy.vstack([y_demand, numpy.roll(y_demand, -1)]).T.ravel(),
+                       numpy.tile([row_length - move, move], ny))
+
+        # Up one layer at the end of each layer
+        self.add_holds(TABLEZ, ACTION_REPLACE, [0.0, self.params["DZ"]],
+                       [ny * row_length - move, move])
+
+    def fly_timing(self):
+        """Wave table rate and points in the ramp of a fly scan row, to
+        take 1/ROW_RATE seconds
+        :return WTR, ramp points"""
+        row_cycles = int(1.0 / (self.params["ROW_RATE"] * E727_SERVO_CYCLE))
+        rate = max(1, row_cycles // FLY_ROW_POINTS)
+        return rate, max(1, row_cycles // rate)
+
+    def create_fly_rows(self):
+        """Create one row of a fly scan, played NY times: X ramps across
+        the row at constant speed and flies back while Y steps up DY.
+        Like RasterGenerator, the row runs half a step either side of
+        the columns, so each point is exposed from half a step before
+        it to half a step after."""
+        rate, points = self.fly_timing()
+        flyback = int(points * FLY_FLYBACK_POINTS)
+        curve = int(flyback * FLY_FLYBACK_CURVE)
+        width = self.params["DX"] * self.params["NX"]
+        start = -self.params["DX"] / 2.0
+
+        ramps = ((TABLEX, [(points, width, start, points),
+                           (flyback, -width, start + width, curve)]),
+                 (TABLEY, [(points, 0.0, 0.0, points),
+                           (flyback, self.params["DY"], 0.0, curve)]))
+        for table, segments in ramps:
+            commands = []
+            for i, (length, amplitude, offset, curve_length) in enumerate(segments):
+                commands.append(self.templates["ramp"].format(
+                    TABLE=self.wave_table(table), first=ACTION_APPEND if i > 0 else ACTION_REPLACE,
+                    LENGTH=length, AMPLITUDE=amplitude, OFFSET=offset,
+                    CURVE=curve_length))
+            self.setup_commands.add("".join(commands),
+                                    group="table %d" % self.wave_table(table))
+            self.table_points[table] = points + flyback
+
+        self.add_fly_triggers(points)
+
+    def add_fly_triggers(self, points):
+        """Pulse the trigger output as the X ramp passes each column
+        :param points Points in the ramp"""
         self.setup_commands.add(
-            self.templates["y_step"].format(y0=y0, y1=y1, first=ACTION_APPEND,
-                                            yWaitTime=y_wait_time,
-                                            yMOVETIME=y_move_time,
-                                            xDemand=x_demand,
-                                            TABLE=TABLEX,
-                                            **self.params))
+            self.templates["setup_trigger"].format(OUTPUT=FLY_TRIGGER_OUTPUT)
+            + TriggerTable.render_triggers(
+                TriggerTable.column_points(self.params["NX"], points),
+                FLY_TRIGGER_OUTPUT),
+            group="trigger")
+
+    def add_x_steps(self, action, x_demand):
+        """Add X steps: each holds at its demand position for MOVETIME
+        while moving then for EXPOSURE
+        :param x_demand Array of X demand positions"""
+        self.add_holds(TABLEX, action,
+                       numpy.repeat(x_demand, 2),
+                       numpy.tile([self.params["MOVE_POINTS"], self.params["EXPOSURE_POINTS"]],
+                                  len(x_demand)))
+
+    def add_y_step(self, table, action, y0, y1, y_wait_time, y_move_time, x_demand):
+        """Add a Y step: wait at y0 while X moves along the row, then move to y1"""
+        self.add_holds(table, action,
+                       [y0, x_demand, y1],
+                       [y_wait_time, y_move_time, y_move_time])
+
+    def add_holds(self, table, action, values, lengths):
+        """Add a run of constant segments to a wave table. They are turned
+        into commands by encode_wave_tables once the whole scan is described.
+        :param action ACTION_REPLACE or ACTION_APPEND for the first segment
+        :param values Demand position of each segment
+        :param lengths Length of each segment in points"""
+        self.wave_blocks.append(WaveEncoder.HoldBlock(self.wave_table(table), action,
+                                                      values, lengths))
+
+    def wave_table(self, table):
+        """The wave table in the current bank for the generator that
+        plays table in the first bank"""
+        return table + self.params.get("TABLE_OFFSET", 0)
+
+    def encode_wave_tables(self):
+        """Turn the wave table segments into commands, and count
+        the points each table will use
+        :return dict of TableEncoding by wave table"""
+        commands, encodings = WaveEncoder.encode_tables(
+            self.wave_blocks, self.params.get("ENCODING", ENCODING_COMPACT))
+
+        # Each table is its own group, so one can change without the others.
+        # Points are counted by the table in the first bank, like generators.
+        for table in WaveEncoder.block_tables(self.wave_blocks):
+            self.setup_commands.add(encodings[table].commands,
+                                    group="table %d" % table)
+            self.table_points[table - self.params.get("TABLE_OFFSET", 0)] = \
+                encodings[table].points
+        return encodings
 
     def set_wave_generator_cycles(self, table, number_of_cycles):
         self.setup_commands.add(
             self.templates["set_wave_generator_cycles"].format(TABLE=table,
-                                                               N_CYCLES=number_of_cycles)
+                                                               N_CYCLES=number_of_cycles),
+            group="cycles"
         )
 
+    def add_rest_commands(self, **commands):
+        """Add rates, routing, recording and offsets, each as its own group
+        :param commands Commands to use for groups instead of their template"""
+        for group in REST_GROUPS:
+            if group in commands:
+                self.setup_commands.add(commands[group], group=group)
+            else:
+                self.setup_commands.add(self.templates[group].format(**self.params),
+                                        group=group)
+
     def prepare_setup_commands(self):
         """Prepares the setup commands with the current scan parameters"""
 
         # NOTE must have already got and checked parameters
 
         self.setup_commands.clear()
+        self.table_points = {}
+        self.wave_blocks = []
+
+        if self.scan_mode() == SCAN_MODE_ROTATED:
+            # One row on each axis that moves, repeated for every row
+            self.create_rotated_rows()
+            self.encode_wave_tables()
+        elif self.scan_mode() == SCAN_MODE_FLY:
+            # One continuous row, repeated for every row
+            self.create_fly_rows()
+        elif self.scan_mode() == SCAN_MODE_VOLUME:
+            # One row and one layer, repeated for the whole stack
+            self.create_volume_tables()
+            self.encode_wave_tables()
+        else:
+            # Create the odd and even rows
+            self.create_odd_rows()
+            self.create_even_rows()
+            self.encode_wave_tables()
 
-        # Create the odd and even rows
-        self.create_odd_rows()
-        self.create_even_rows()
-
-        Y_CYCLES = self.params["NY"]/2
-        self.set_wave_generator_cycles(TABLEY, Y_CYCLES)
+        cycles = self.generator_cycles()
+        for table in sorted(cycles):
+            self.set_wave_generator_cycles(table, cycles[table])
 
         # Add remaining commands
-        self.setup_commands.add(self.templates["rest"].format(**self.params))
+        self.add_rest_commands()
         return True
 
+    def generator_cycles(self):
+        """Number of cycles each wave generator runs for in the scan
+        :return dict of cycles by generator, for the generators given a count"""
+        if self.scan_mode() in (SCAN_MODE_ROTATED, SCAN_MODE_FLY):
+            # Every table that moves holds one row
+            return dict((table, self.params["NY"]) for table in self.table_points)
+        if self.scan_mode() == SCAN_MODE_VOLUME:
+            # X holds one row, Y and Z one layer
+            return {TABLEX: self.params["NY"] * self.params["NZ"],
+                    TABLEY: self.params["NZ"],
+                    TABLEZ: self.params["NZ"]}
+        # Each Y cycle is an odd and an even row
+        return {TABLEY: self.params["NY"]/2}
+
     def prepare_start_commands(self):
         """Prepare the commands that will start the scan"""
 
         self.start_commands.clear()
-        self.start_commands.add("""WGO 1 257 2 257""")
+        if self.scan_mode() in (SCAN_MODE_ROTATED, SCAN_MODE_VOLUME):
+            # Start every generator that has a table, from the last position
+            self.start_commands.add("WGO " + " ".join(
+                ["%d 257" % table for table in sorted(self.table_points)]))
+        elif self.scan_mode() == SCAN_MODE_FLY:
+            self.start_commands.add(self.templates["fly_start"].format(
+                XSTART=self.params["X0"] - self.params["DX"] / 2.0, **self.params))
+        else:
+            self.start_commands.add("""WGO 1 257 2 257""")
 
     def prepare_stop_commands(self):
         """Prepare the commands that will stop the scan"""
 
         self.stop_commands.add(self.templates["stop_commands"])
 
-    def send_setup_commands(self):
-        """Send down the setup commands"""
+    def send_setup_commands(self, tables_only=False):
+        """Send down the setup commands
+        :param tables_only If True, only send the wave tables, which can be
+        done while the generators play tables in the other bank"""
+
+        # Only send the groups that differ from what the controller has
+        digests = self.setup_commands.group_digests()
+        changed = [group for group in digests
+                   if self.uploaded.get(group) != digests[group]
+                   or group in ALWAYS_SENT_GROUPS]
+        if tables_only:
+            changed = [group for group in changed if group.startswith("table ")]
+        if len(changed) == 0:
+            logging.info("Setup commands unchanged, nothing to send")
+            return True
+
+        logging.info("Sending setup commands: %s" % ", ".join(map(str, changed)))
 
-        logging.info("Sending setup commands")
+        commands = self.setup_commands.select(changed)
+        self.metrics.record("UPLOAD_BYTES", len(commands))
+        self.metrics.record("UPLOAD_LINES", commands.count("\n"))
 
         start = time.time()
-        status = self.controller.send_multiline(self.setup_commands.get())
+        status = self.controller.send_multiline(commands, batch=True, encoded=True)
         end = time.time()
 
         logging.info("Finished setup commands, took %f s" % (end - start))
 
+        # Line of the commands sent that failed, if any
+        self.set_status("ERROR_LINE", self.controller.error_line)
+        self.set_status("ERROR_CODE", self.controller.error_code)
+
+        if status == False:
+            # We don't know what the controller has now
+            self.forget_upload()
+        else:
+            # Tables in the other bank are still there
+            self.uploaded.update((group, digests[group]) for group in changed)
+
         return status
 
+    def forget_upload(self):
+        """Send all the setup commands next time, e.g. after the
+        controller has been restarted"""
+        self.uploaded = {}
+
     def send_start_commands(self):
         """Send down the start commands
         This will actually triggers the start of the scan"""
@@ -347,22 +768,80 @@ class PIStepScan():
         logging.info("Sending start commands")
 
         start = time.time()
-        self.controller.send_multiline(self.start_commands.get())
+        with self.metrics.timed("START_TIME"):
+            self.controller.send_multiline(self.start_commands.get())
         end = time.time()
 
         logging.info("Finished start commands, took %f s" % (end - start))
 
 
+    def file_setting(self, name, default):
+        """Value of a file record, or the default outside an IOC"""
+        if name in self.file_records:
+            return self.file_records[name].get()
+        return default
+
+    def save(self, value=None):
+        """Callback for the SAVE record: write the recording in a cothread"""
+        cothread.Spawn(self.save_in_background)
+
+    def save_in_background(self):
+        try:
+            self.save_recording()
+        except Exception:
+            logging.exception("Saving the recording failed")
+
+    def scan_finished(self):
+        """The monitor has seen the wave generators stop"""
+        if self.file_setting("AUTO_SAVE", False):
+            self.save()
+
+    def save_recording(self, points=None, wait=False):
+        """Read the data recorder and write it, with the scan metadata,
+        to the file set by the file records
+        :param points Points to read, default all recorded so far
+        :param wait If True, wait for points still being recorded
+        :return Path of the file written"""
+        reader = DataRecorderReader.DataRecorderReader(self.controller,
+                                                       sleep=cothread.Sleep)
+        if points is None:
+            points = reader.recorded_points()
+
+        writer = RecordingWriter.create_writer(
+            self.file_setting("FILE_FORMAT", FILE_FORMAT_NPY),
+            self.file_setting("FILE_PATH", DEFAULT_FILE_PATH),
+            self.file_setting("FILE_NAME", DEFAULT_FILE_NAME),
+            points, len(reader.channels))
+        reader.read(points, wait, writer=writer)
+        writer.close(self.recording_metadata(reader))
+
+        logging.info("Wrote %d recorded points to %s" % (writer.rows, writer.path))
+        return writer.path
+
+    def recording_metadata(self, reader):
+        """What we know about the scan, to save with its recorded data"""
+        return {"params": self.params,
+                "setup_commands": self.setup_commands.get(),
+                "start_commands": self.start_commands.get(),
+                "timing": dict((name, statistic.last())
+                               for name, statistic in self.metrics.statistics.iteritems()
+                               if len(statistic.values) > 0),
+                "channels": reader.channels,
+                "channel_names": reader.header.get("NAMES", []),
+                "sample_time": reader.sample_time(),
+                "read_time": reader.seconds}
+
     def abort_scan(self, value=None):
         """Wrapper to be used as callback for abort record"""
-        self.controller.send_stop_commands()
+        self.send_stop_commands()
 
     def send_stop_commands(self):
         """Send the stop commands to the controller"""
 
         logging.info("Sending stop commands")
         start = time.time()
-        self.controller.send_multiline(self.stop_commands.get())
+        with self.metrics.timed("STOP_TIME"):
+            self.controller.send_multiline(self.stop_commands.get())
         end = time.time()
         logging.info("elapsed time: %f s" % (end - start))
 
@@ -371,35 +850,37 @@ class PICalibrationScan(PIStepScan):
         """Create one row """
 
         # Describe a single step
-        self.setup_commands.add(self.templates["x_step"].format(
-            xDemand=self.params["DX"],
-            first=ACTION_REPLACE,
-            TABLE=TABLEX,
-            **self.params))
+        self.add_x_steps(ACTION_REPLACE, numpy.array([self.params["DX"]]))
+        self.encode_wave_tables()
 
         # Set wave generator cycles to do the right number of steps
         self.set_wave_generator_cycles(self.params["axis_to_scan"], self.params["NX"])
 
+    def generator_cycles(self):
+        """One cycle per step on the axis being scanned"""
+        return {self.params["axis_to_scan"]: self.params["NX"]}
+
     def prepare_setup_commands(self):
         """Prepare setup commands. Describe a single step
         on the axis to be scanned, then set the wave generator cycles to
         the number of steps."""
 
         self.setup_commands.clear()
+        self.table_points = {}
+        self.wave_blocks = []
         self.create_signle_row()
 
         # Set up triggering
         # Set level high for one wave generator cycle when we are stationary between steps
-        trigger_point = self.params["MOVETIME"] + int(self.params["EXPOSURE"] / 2)
+        trigger_point = self.params["MOVE_POINTS"] + int(self.params["EXPOSURE_POINTS"] / 2)
         self.setup_commands.add(
-            self.templates["setup_trigger"].format(
-                OUTPUT=1,
-                TABLE=self.params["axis_to_scan"],
-                TRIGPOINT=trigger_point
-            )
+            self.templates["setup_trigger"].format(OUTPUT=1)
+            + TriggerTable.render_triggers([trigger_point],
+                                           self.params["axis_to_scan"]),
+            group="trigger"
         )
 
-        self.setup_commands.add(self.templates["rest"].format(**self.params))
+        self.add_rest_commands()
 
     def prepare_start_commands(self):
         """Prepare the commands that will start the scan"""
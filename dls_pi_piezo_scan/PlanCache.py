@@ -0,0 +1,78 @@
+# Standard dependencies
+import hashlib
+import logging
+import collections
+
+# Default limits on what we keep
+DEFAULT_MAX_PLANS = 16
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+
+class ScanPlan():
+    """Commands compiled for one set of scan parameters"""
+
+    def __init__(self, setup_commands, start_commands, table_points):
+        """:param setup_commands CommandStore of setup commands
+        :param start_commands CommandStore of start commands
+        :param table_points dict of wave table points used per table"""
+        self.setup_commands = setup_commands
+        self.start_commands = start_commands
+        self.table_points = table_points
+
+    def size(self):
+        """Bytes of commands held by the plan"""
+        return self.setup_commands.size() + self.start_commands.size()
+
+
+class PlanCache():
+    """Least recently used cache of compiled scan plans, keyed by a hash of
+    the scan parameters and limited by both number of plans and bytes"""
+
+    def __init__(self, max_plans=DEFAULT_MAX_PLANS, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_plans = max_plans
+        self.max_bytes = max_bytes
+
+        # Oldest first
+        self.plans = collections.OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(params):
+        """Canonical hash of a dict of scan parameters"""
+        return hashlib.sha1(repr(sorted(params.items()))).hexdigest()
+
+    def get(self, key):
+        """Return the plan for key, or None if we don't have it"""
+        plan = self.plans.pop(key, None)
+        if plan is None:
+            self.misses += 1
+            return None
+
+        # Now the most recently used
+        self.plans[key] = plan
+        self.hits += 1
+        return plan
+
+    def put(self, key, plan):
+        """Keep a plan, evicting the least recently used ones to make room"""
+        self.remove(key)
+        if plan.size() > self.max_bytes:
+            logging.info("Scan plan of %d bytes too big to cache" % plan.size())
+            return
+
+        self.plans[key] = plan
+        self.bytes += plan.size()
+        while len(self.plans) > self.max_plans or self.bytes > self.max_bytes:
+            self.remove(next(iter(self.plans)))
+
+    def remove(self, key):
+        plan = self.plans.pop(key, None)
+        if plan is not None:
+            self.bytes -= plan.size()
+
+    def clear(self):
+        self.plans.clear()
+        self.bytes = 0
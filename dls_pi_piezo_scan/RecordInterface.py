@@ -6,6 +6,7 @@ from PIConstants import *
 
 def create_records(configure_scan_function,
                    start_scan_function,
+                   abort_scan_function,
                    min_x, min_y, min_z, max_x, max_y, max_z):
     """Create the records for the scan interface"""
 
@@ -31,17 +32,17 @@ def create_records(configure_scan_function,
                                        on_update=configure_scan_function,
                                        always_update=True)
 
+    # Stop the wave generators and the axes
+    records["abort_scan"] = builder.mbbOut('ABORT',
+                                       initial_value=0,
+                                       PINI='NO',
+                                       NOBT=2,
+                                       ZRVL=0, ZRST='Abort',
+                                       on_update=abort_scan_function,
+                                       always_update=True)
+
     # Status to say we're sending commands
-    records["STATE"] = builder.mbbIn("STATE",
-                                            initial_value=0,
-                                            PINI='YES',
-                                            NOBT=2,
-                                            ZRVL=STATE_NOT_CONFIGRED, ZRST='Not configured', ZRSV="INVALID",
-                                            ONVL=STATE_PREPARING, ONST='Preparing', ONSV="MINOR",
-                                            TWVL=STATE_ERROR, TWST='Error', TWSV="MAJOR",
-                                            THVL=STATE_READY, THST='Ready', THSV="NO_ALARM",
-                                            FRVL=STATE_SCAN_RUNNING, FRST="Scan running", FRSV="NO_ALARM"
-                                            )
+    records["STATE"] = create_state_record()
     # Number of steps in x
     records["NX"] = builder.longOut("NX",
                                              initial_value=30,
@@ -118,4 +119,201 @@ def create_records(configure_scan_function,
                                             DRVL=0.001, DRVH=300.0,
                                             EGU="ms", PREC=1)
 
-    return records
\ No newline at end of file
+    # How to write the wave tables
+    records["ENCODING"] = builder.mbbOut("ENCODING",
+                                         initial_value=ENCODING_COMPACT,
+                                         PINI='YES',
+                                         NOBT=2,
+                                         ZRVL=ENCODING_EXPLICIT, ZRST='Explicit',
+                                         ONVL=ENCODING_COMPACT, ONST='Compact')
+
+    # Step scan along the axes, a sample frame grid rotated by THETA,
+    # continuous rows, or a stack of NZ step scan layers
+    records["SCAN_MODE"] = builder.mbbOut("SCAN_MODE",
+                                          initial_value=SCAN_MODE_STEP,
+                                          PINI='YES',
+                                          NOBT=2,
+                                          ZRVL=SCAN_MODE_STEP, ZRST='Step',
+                                          ONVL=SCAN_MODE_ROTATED, ONST='Rotated',
+                                          TWVL=SCAN_MODE_FLY, TWST='Fly',
+                                          THVL=SCAN_MODE_VOLUME, THST='Volume')
+    # Rows per second in a fly scan / Hz
+    records["ROW_RATE"] = builder.aOut("ROW_RATE",
+                                       initial_value=10.0,
+                                       PINI='YES',
+                                       DRVL=0.01, DRVH=FLY_MAX_ROW_RATE,
+                                       EGU="Hz", PREC=2)
+
+    # Pick the wave table rate that gets MOVETIME and EXPOSURE to within
+    # RATE_TOLERANCE in the fewest points, rather than 1 ms per point
+    records["AUTO_RATE"] = builder.boolOut("AUTO_RATE",
+                                           initial_value=0,
+                                           PINI='YES',
+                                           ZNAM="Off", ONAM="On")
+    records["RATE_TOLERANCE"] = builder.aOut("RATE_TOLERANCE",
+                                             initial_value=DEFAULT_RATE_TOLERANCE,
+                                             PINI='YES',
+                                             DRVL=0.0, DRVH=50.0,
+                                             EGU="%", PREC=1)
+
+    return records
+
+def create_state_record():
+    """Create the STATE record, saying what the scan is doing"""
+    return builder.mbbIn("STATE",
+                         initial_value=0,
+                         PINI='YES',
+                         NOBT=2,
+                         ZRVL=STATE_NOT_CONFIGRED, ZRST='Not configured', ZRSV="INVALID",
+                         ONVL=STATE_PREPARING, ONST='Preparing', ONSV="MINOR",
+                         TWVL=STATE_ERROR, TWST='Error', TWSV="MAJOR",
+                         THVL=STATE_READY, THST='Ready', THSV="NO_ALARM",
+                         FRVL=STATE_SCAN_RUNNING, FRST="Scan running", FRSV="NO_ALARM"
+                         )
+
+def create_manager_records(configure_function, start_function):
+    """Create the records to configure and start all the scans of a
+    ScanManager, and their combined STATE"""
+
+    records = {}
+
+    records["start_scan"] = builder.mbbOut('START',
+                                           initial_value=0,
+                                           PINI='NO',
+                                           NOBT=2,
+                                           ZRVL=0, ZRST='Start',
+                                           ONVL=1, ONST='Starting',
+                                           on_update=start_function,
+                                           always_update=True)
+
+    records["configure_scan"] = builder.mbbOut('CONFIGURE',
+                                               initial_value=0,
+                                               PINI='NO',
+                                               NOBT=2,
+                                               ZRVL=0, ZRST='Configure',
+                                               ONVL=1, ONST='Configuring',
+                                               on_update=configure_function,
+                                               always_update=True)
+
+    records["STATE"] = create_state_record()
+
+    return records
+
+def create_queue_records(add_function, run_function, clear_function):
+    """Create the records for a ScanQueue: ADD queues a scan with the
+    current parameters, RUN runs the queue and CLEAR empties it"""
+
+    records = {}
+
+    for name, function in (("ADD", add_function), ("RUN", run_function),
+                           ("CLEAR", clear_function)):
+        records["QUEUE_" + name] = builder.mbbOut("QUEUE_" + name,
+                                                  initial_value=0,
+                                                  PINI='NO',
+                                                  NOBT=2,
+                                                  ZRVL=0, ZRST=name.capitalize(),
+                                                  on_update=function,
+                                                  always_update=True)
+
+    # Scans waiting, and scans started since the queue was run
+    records["QUEUE_LENGTH"] = builder.longIn("QUEUE_LENGTH",
+                                             initial_value=0)
+    records["QUEUE_DONE"] = builder.longIn("QUEUE_DONE",
+                                           initial_value=0)
+
+    return records
+
+def create_status_records():
+    """Create the read-only records that report on the configured scan"""
+
+    records = {}
+
+    # Wave table points used by each axis
+    for axis in ("X", "Y", "Z"):
+        records["POINTS_" + axis] = builder.longIn("POINTS_" + axis,
+                                                   initial_value=0,
+                                                   LOPR=0, HOPR=E727_AVAILALBE_DATAPOINTS)
+
+    # Share of the controller wave table memory used by the scan
+    records["POINTS_USED"] = builder.aIn("POINTS_USED",
+                                         initial_value=0,
+                                         LOPR=0, HOPR=100,
+                                         EGU="%", PREC=1)
+
+    # Progress of the running scan
+    records["PROGRESS"] = builder.aIn("PROGRESS",
+                                      initial_value=0,
+                                      LOPR=0, HOPR=100,
+                                      EGU="%", PREC=1)
+    records["ETA"] = builder.aIn("ETA",
+                                 initial_value=0,
+                                 EGU="s", PREC=1)
+
+    # Where the last upload failed, 0 if it didn't
+    records["ERROR_LINE"] = builder.longIn("ERROR_LINE",
+                                           initial_value=0)
+    records["ERROR_CODE"] = builder.longIn("ERROR_CODE",
+                                           initial_value=GCS_NO_ERROR)
+
+    return records
+
+def create_metrics_records(timings, sizes):
+    """Create read-only records for the latest value and the rolling
+    minimum, mean and maximum of each metric
+    :param timings Names of metrics that are durations / ms
+    :param sizes Names of metrics that are counts of bytes or lines"""
+
+    records = {}
+
+    for names, egu, prec in ((timings, "ms", 3), (sizes, "", 0)):
+        for name in names:
+            for suffix in ("", ":MIN", ":MEAN", ":MAX"):
+                records[name + suffix] = builder.aIn(name + suffix,
+                                                     initial_value=0,
+                                                     EGU=egu, PREC=prec)
+
+    # Plan cache lookups since the IOC started
+    for name in ("CACHE_HITS", "CACHE_MISSES"):
+        records[name] = builder.longIn(name, initial_value=0)
+
+    return records
+
+def create_file_records(save_function):
+    """Create the records saying where recorded data is written
+    :param save_function Called to write the recording"""
+
+    records = {}
+
+    # Write what the data recorder has now
+    records["SAVE"] = builder.mbbOut("SAVE",
+                                     initial_value=0,
+                                     PINI='NO',
+                                     NOBT=2,
+                                     ZRVL=0, ZRST='Save',
+                                     on_update=save_function,
+                                     always_update=True)
+
+    # Write it whenever a scan finishes
+    records["AUTO_SAVE"] = builder.boolOut("AUTO_SAVE",
+                                           initial_value=0,
+                                           PINI='YES',
+                                           ZNAM="Off", ONAM="On")
+
+    # Directory to write to
+    records["FILE_PATH"] = builder.stringOut("FILE_PATH",
+                                             initial_value=DEFAULT_FILE_PATH,
+                                             PINI='YES')
+
+    # File name, without the extension
+    records["FILE_NAME"] = builder.stringOut("FILE_NAME",
+                                             initial_value=DEFAULT_FILE_NAME,
+                                             PINI='YES')
+
+    records["FILE_FORMAT"] = builder.mbbOut("FILE_FORMAT",
+                                            initial_value=FILE_FORMAT_NPY,
+                                            PINI='YES',
+                                            NOBT=2,
+                                            ZRVL=FILE_FORMAT_NPY, ZRST='npy',
+                                            ONVL=FILE_FORMAT_HDF5, ONST='HDF5')
+
+    return records
@@ -0,0 +1,105 @@
+"""Write recorded positions to disk as they are read.
+
+Data goes straight into a memory-mapped .npy file or a chunked HDF5
+dataset, so memory use stays flat however long the recording. Scan
+metadata is written alongside: a JSON file next to a .npy file, or a
+metadata group in the HDF5 file."""
+
+# Standard dependencies
+import os
+import json
+
+# Extra dependencies
+from pkg_resources import require, DistributionNotFound
+require("numpy")
+import numpy
+
+# HDF5 is optional, we can always write .npy files
+try:
+    require("h5py")
+    import h5py
+except (DistributionNotFound, ImportError):
+    h5py = None
+
+from PIConstants import *
+
+# Rows per HDF5 chunk
+HDF5_CHUNK_ROWS = 4096
+
+
+class NpyWriter():
+    """Write rows into a memory-mapped .npy file, with the metadata
+    in a .json file of the same name"""
+
+    extension = ".npy"
+
+    def __init__(self, path, points, channels):
+        """:param path File to write
+        :param points Rows the file can hold
+        :param channels Columns in each row"""
+        self.path = path
+        self.rows = 0
+        self.data = numpy.lib.format.open_memmap(path, mode="w+", dtype=numpy.float64,
+                                                 shape=(points, channels))
+
+    def write(self, first, rows):
+        """Write rows starting at the zero based row first"""
+        self.data[first:first + len(rows)] = rows
+        self.rows = max(self.rows, first + len(rows))
+
+    def close(self, metadata):
+        """Finish the file. Rows past the end of the recording are left as
+        zeros; the metadata says how many rows were written."""
+        self.data.flush()
+        self.data = None
+        with open(os.path.splitext(self.path)[0] + ".json", "w") as metadata_file:
+            json.dump(dict(metadata, points=self.rows), metadata_file,
+                      indent=2, sort_keys=True)
+
+
+class HDF5Writer():
+    """Write rows into a chunked HDF5 dataset, with the metadata in a group
+    of JSON encoded datasets"""
+
+    extension = ".h5"
+
+    def __init__(self, path, points, channels):
+        """:param path File to write
+        :param points Rows we expect to write
+        :param channels Columns in each row"""
+        if h5py is None:
+            raise ImportError("h5py is needed to write HDF5 files")
+        self.path = path
+        self.rows = 0
+        self.file = h5py.File(path, "w")
+        self.data = self.file.create_dataset(
+            "positions", shape=(points, channels), maxshape=(None, channels),
+            chunks=(max(1, min(points, HDF5_CHUNK_ROWS)), channels),
+            dtype=numpy.float64)
+
+    def write(self, first, rows):
+        """Write rows starting at the zero based row first"""
+        if first + len(rows) > self.data.shape[0]:
+            self.data.resize(first + len(rows), axis=0)
+        self.data[first:first + len(rows)] = rows
+        self.rows = max(self.rows, first + len(rows))
+
+    def close(self, metadata):
+        """Trim the dataset to the rows written and add the metadata"""
+        self.data.resize(self.rows, axis=0)
+        group = self.file.create_group("metadata")
+        for key, value in dict(metadata, points=self.rows).iteritems():
+            group.create_dataset(key, data=json.dumps(value))
+        self.file.close()
+
+
+WRITERS = {FILE_FORMAT_NPY: NpyWriter,
+           FILE_FORMAT_HDF5: HDF5Writer}
+
+
+def create_writer(file_format, path, name, points, channels):
+    """Make a writer for the given format
+    :param path Directory to write to
+    :param name File name without extension"""
+    writer = WRITERS[file_format]
+    return writer(os.path.join(path, name + writer.extension), points, channels)
@@ -0,0 +1,155 @@
+"""Run scans on several controllers from one IOC.
+
+Configuring uploads to every controller at once, each scan in a cothread
+if its controller is cooperative or a thread of its own if not, so the
+dead time is that of the slowest rather than the sum. Starting sends
+everything but the WGO commands first, then writes the WGOs back to back
+so the scans start as close together as we can get them."""
+
+# Standard dependencies
+import time
+import logging
+import threading
+import collections
+
+# Extra dependencies
+from pkg_resources import require
+require('cothread')
+import cothread
+
+# Other files in this module
+import RecordInterface
+import PIController
+import ConfigureWorker
+
+from PIConstants import *
+
+
+def aggregate_state(states):
+    """Combine the states of several scans: any error is an error, then
+    any scan still preparing or running counts, and we are only ready
+    when every scan is"""
+    states = set(states)
+    for state in (STATE_ERROR, STATE_PREPARING, STATE_SCAN_RUNNING):
+        if state in states:
+            return state
+    if states == set([STATE_READY]):
+        return STATE_READY
+    return STATE_NOT_CONFIGRED
+
+
+class ScanManager():
+    """A set of named scans, each with its own controller, configured
+    and started together"""
+
+    def __init__(self):
+        self.scans = collections.OrderedDict()
+
+        # Records for the scans together, if we have any
+        self.records = None
+        self.worker = None
+
+        # Time between the first and last WGO of the last start / s
+        self.start_skew = 0.0
+
+    def add(self, name, scan):
+        """:param name Name of the scan, which prefixes its records
+        :param scan PIStepScan"""
+        self.scans[name] = scan
+        scan.state_callback = self.update_state
+
+    def create_records(self, device):
+        """Create the records for each scan, under device:name, then those
+        for all of them under device"""
+        for name, scan in self.scans.items():
+            RecordInterface.builder.SetDeviceName("%s:%s" % (device, name))
+            scan.create_records()
+
+        RecordInterface.builder.SetDeviceName(device)
+        self.worker = ConfigureWorker.ConfigureWorker(self, cooperative=True)
+        self.records = RecordInterface.create_manager_records(
+            configure_function=self.worker.configure,
+            start_function=self.worker.start)
+
+    def get_state(self):
+        return aggregate_state([scan.get_state() for scan in self.scans.values()])
+
+    def set_state(self, new_state):
+        if self.records is not None:
+            self.records["STATE"].set(new_state)
+
+    def update_state(self, new_state=None):
+        """Publish the combined state, when one of the scans changes"""
+        self.set_state(self.get_state())
+
+    def configure_scan(self):
+        """Configure every scan at once. Runs in a cothread, and returns
+        when they are all done."""
+        start = time.time()
+        waiting = []
+        for name, scan in self.scans.items():
+            if scan.controller.cooperative:
+                waiting.append(cothread.Spawn(self.configure_one, name, scan))
+            else:
+                done = cothread.Event()
+                worker = threading.Thread(target=self.configure_in_thread,
+                                          args=(name, scan, done),
+                                          name="configure_%s" % name)
+                worker.daemon = True
+                worker.start()
+                waiting.append(done)
+
+        for task in waiting:
+            task.Wait()
+        logging.info("Configured %d scans in %f s" % (len(self.scans),
+                                                      time.time() - start))
+        return self.get_state() == STATE_READY
+
+    def configure_in_thread(self, name, scan, done):
+        try:
+            self.configure_one(name, scan)
+        finally:
+            cothread.Callback(done.Signal)
+
+    def configure_one(self, name, scan):
+        try:
+            scan.configure_scan()
+        except Exception:
+            logging.exception("Configuring scan %s failed" % name)
+            scan.set_state(STATE_ERROR)
+
+    def start_scan(self, value=None):
+        """Start every scan, once they are all ready"""
+        if self.get_state() != STATE_READY:
+            logging.error("Can't start scans - they all need to be configured first")
+            return False
+
+        # Split the WGOs from whatever has to happen before them
+        go_commands = {}
+        for name, scan in self.scans.items():
+            lines = [line.strip() for line in scan.start_commands.get().split("\n")]
+            go_commands[name] = PIController.encode_commands("\n".join(
+                [line for line in lines if line.startswith("WGO")]))
+            before = [line for line in lines if len(line) > 0 and not line.startswith("WGO")]
+            if len(before) > 0 and not scan.controller.send_multiline("\n".join(before)):
+                logging.error("Error sending start commands for scan %s" % name)
+                scan.set_state(STATE_ERROR)
+                return False
+
+        # Start the wave generators as close together as we can
+        start = time.time()
+        for name, scan in self.scans.items():
+            scan.controller.write(go_commands[name])
+        self.start_skew = time.time() - start
+        logging.info("Started %d scans within %f ms" % (len(self.scans),
+                                                        self.start_skew * 1000.0))
+
+        started = True
+        for name, scan in self.scans.items():
+            if scan.controller.check_error() != GCS_NO_ERROR:
+                logging.error("Error starting scan %s" % name)
+                scan.set_state(STATE_ERROR)
+                started = False
+            else:
+                scan.scan_started()
+        return started
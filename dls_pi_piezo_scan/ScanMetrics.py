@@ -0,0 +1,82 @@
+# Standard dependencies
+import time
+import logging
+import contextlib
+import collections
+
+# Number of scans we keep statistics over
+DEFAULT_HISTORY = 20
+
+# Durations / ms
+TIMINGS = ("GATHER_TIME",       # Reading the scan parameters
+           "GENERATE_TIME",     # Preparing the commands, or finding them in the cache
+           "VERIFY_TIME",       # Checking the parameters
+           "UPLOAD_TIME",       # Sending the setup commands
+           "CONFIGURE_TIME",    # All of configuring a scan
+           "START_TIME",        # Sending the start commands
+           "STOP_TIME",         # Sending the stop commands
+           "ERR_LATENCY")       # Round trip for ERR? to the controller
+
+# Amounts of setup commands sent
+SIZES = ("UPLOAD_BYTES",
+         "UPLOAD_LINES")
+
+
+class RollingStatistic():
+    """Minimum, mean and maximum of the most recent values"""
+
+    def __init__(self, history=DEFAULT_HISTORY):
+        self.values = collections.deque(maxlen=history)
+
+    def add(self, value):
+        self.values.append(value)
+
+    def last(self):
+        return self.values[-1]
+
+    def minimum(self):
+        return min(self.values)
+
+    def mean(self):
+        return sum(self.values) / float(len(self.values))
+
+    def maximum(self):
+        return max(self.values)
+
+
+class ScanMetrics():
+    """Timings and sizes for each configure, start and abort, with rolling
+    statistics published to records if we have them"""
+
+    def __init__(self, history=DEFAULT_HISTORY):
+        self.statistics = dict((name, RollingStatistic(history))
+                               for name in TIMINGS + SIZES)
+
+        # Records to publish to, none if we are outside an IOC
+        self.records = {}
+
+    def record(self, name, value):
+        """Add a new value for a metric and publish its statistics"""
+        statistic = self.statistics[name]
+        statistic.add(value)
+        logging.debug("%s: %f" % (name, value))
+
+        if name in self.records:
+            self.records[name].set(statistic.last())
+            self.records[name + ":MIN"].set(statistic.minimum())
+            self.records[name + ":MEAN"].set(statistic.mean())
+            self.records[name + ":MAX"].set(statistic.maximum())
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """Record how long the body of a with statement takes / ms"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, (time.time() - start) * 1000.0)
+
+    def set_counter(self, name, value):
+        """Publish a count that is kept elsewhere, such as cache hits"""
+        if name in self.records:
+            self.records[name].set(value)
@@ -0,0 +1,117 @@
+"""Follow a running scan and report its progress.
+
+A cothread polls the wave generators at a fixed rate. Each poll is one
+write of #9 (which generators are running), WGN? (cycles completed) and
+WGI? (point within the current cycle), so it costs one round trip. Polls
+are skipped while another thread holds the controller, so they never
+hold up an upload or wait for one."""
+
+# Standard dependencies
+import time
+import socket
+import logging
+
+# Extra dependencies
+from pkg_resources import require
+require('cothread')
+import cothread
+
+# Other files in this module
+import PIController
+
+from PIConstants import *
+
+# Time between polls / s
+DEFAULT_POLL_INTERVAL = 0.2
+
+
+class ScanMonitor():
+    """Polls the controller while a scan runs, updating STATE, progress
+    and the estimated time left"""
+
+    def __init__(self, scan, interval=DEFAULT_POLL_INTERVAL):
+        """:param scan PIStepScan whose scan we follow
+        :param interval Time between polls / s"""
+        self.scan = scan
+        self.interval = interval
+        self.running = False
+        self.start_time = None
+
+        # Points in each generator's table, and in the whole scan, by
+        # generator. Kept from the start, since a queue may be preparing
+        # the next scan while this one runs.
+        self.table_points = {}
+        self.total_points = {}
+
+    def start(self):
+        """Start following a scan that has just been started"""
+        cycles = self.scan.generator_cycles()
+        self.table_points = dict(self.scan.table_points)
+        self.total_points = dict(
+            (gen, self.table_points.get(gen, 0) * cycles[gen]) for gen in cycles
+            if self.table_points.get(gen, 0) > 0)
+        self.start_time = time.time()
+        self.scan.set_status("PROGRESS", 0.0)
+
+        if not self.running:
+            self.running = True
+            cothread.Spawn(self.run)
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        """Poller cothread: poll until no generator is running"""
+        while self.running:
+            cothread.Sleep(self.interval)
+            if not self.running:
+                return
+            if not self.scan.controller.lock.acquire(False):
+                # Keep out of the way of uploads
+                continue
+            try:
+                self.poll()
+            except (socket.error, ValueError, cothread.Timedout) as error:
+                logging.warning("Scan progress poll failed: %s" % error)
+            finally:
+                self.scan.controller.lock.release()
+
+    def poll(self):
+        """Ask the controller how far the scan has got, in one round trip"""
+        generators = " ".join(["%d" % gen for gen in sorted(self.total_points)])
+        if len(generators) > 0:
+            status, cycles, index = self.scan.controller.query_pipelined(
+                [WAVE_GENERATOR_STATUS, "WGN? " + generators, "WGI? " + generators])
+            cycles = PIController.parse_values(cycles)
+            index = PIController.parse_values(index)
+        else:
+            status, = self.scan.controller.query_pipelined([WAVE_GENERATOR_STATUS])
+            cycles, index = {}, {}
+
+        if int(status) == 0:
+            self.finished()
+            return
+
+        # The scan is as far along as its slowest generator
+        fractions = [(cycles.get(gen, 0) * self.table_points[gen] + index.get(gen, 0))
+                     / float(total) for gen, total in self.total_points.items()]
+        if len(fractions) > 0:
+            self.update(min(1.0, min(fractions)))
+
+    def update(self, fraction):
+        """Publish progress, and estimate the time left from how long it has
+        taken to get this far"""
+        self.scan.set_status("PROGRESS", fraction * 100.0)
+        if fraction > 0:
+            elapsed = time.time() - self.start_time
+            self.scan.set_status("ETA", elapsed * (1.0 - fraction) / fraction)
+
+    def finished(self):
+        """No generators running, so the scan is over"""
+        self.running = False
+        self.scan.set_status("PROGRESS", 100.0)
+        self.scan.set_status("ETA", 0.0)
+        if self.scan.get_state() == STATE_SCAN_RUNNING:
+            self.scan.set_state(STATE_READY)
+        logging.info("Scan finished after %f s" % (time.time() - self.start_time))
+        self.scan.scan_finished()
@@ -0,0 +1,173 @@
+"""Run a list of scans back to back.
+
+The wave tables of the next scan are uploaded into the spare bank of
+tables while the current scan plays the other bank. Once the wave
+generators stop, switching over only needs the setup commands that
+differ, at least the WSL routing to the new bank, and the WGO. So
+there is no full upload between one scan and the next. Uploads go
+through ConfigureWorker.call_in_background, so a blocking controller
+never holds up the IOC, and the queue won't run while a configure is
+in progress."""
+
+# Standard dependencies
+import time
+import socket
+import logging
+import collections
+
+# Extra dependencies
+from pkg_resources import require
+require('cothread')
+import cothread
+
+# Other files in this module
+import RecordInterface
+import ConfigureWorker
+
+from PIConstants import *
+
+
+class ScanQueue():
+    """Scans waiting to run on a PIStepScan, each a dict of parameters
+    used instead of the scan's records"""
+
+    def __init__(self, scan, poll_interval=QUEUE_POLL_INTERVAL):
+        """:param scan PIStepScan to run the scans on
+        :param poll_interval How often to ask if the current scan has
+        finished, once the next one is loaded / s"""
+        self.scan = scan
+        self.poll_interval = poll_interval
+        self.entries = collections.deque()
+        self.running = False
+
+        # Scans started since the queue was last run
+        self.done = 0
+
+        # Records for the queue, if we have any
+        self.records = None
+
+    def create_records(self):
+        self.records = RecordInterface.create_queue_records(
+            add_function=self.add_current, run_function=self.start,
+            clear_function=self.clear)
+
+    def publish(self):
+        if self.records is not None:
+            self.records["QUEUE_LENGTH"].set(len(self.entries))
+            self.records["QUEUE_DONE"].set(self.done)
+
+    def add(self, params):
+        """Queue a scan
+        :param params dict of parameters that differ from the records"""
+        self.entries.append(dict(params))
+        self.publish()
+
+    def extend(self, params_list):
+        """Queue several scans"""
+        for params in params_list:
+            self.add(params)
+
+    def add_current(self, value=None):
+        """Queue a scan with the parameters the records have now"""
+        self.add(self.scan.current_parameters())
+
+    def clear(self, value=None):
+        """Drop the scans that haven't started. The current one carries on."""
+        self.entries.clear()
+        self.publish()
+
+    def configuring(self):
+        """True if the scan's ConfigureWorker is busy with the tables"""
+        return self.scan.worker is not None and self.scan.worker.configuring
+
+    def in_background(self, function, *args):
+        """Call function without holding up the IOC on the controller"""
+        return ConfigureWorker.call_in_background(
+            self.scan.controller.cooperative, function, *args)
+
+    def start(self, value=None):
+        """Run the queued scans, in a cothread"""
+        if self.configuring():
+            logging.error("Not running the scan queue - a configure is in progress")
+            return
+        if not self.running:
+            self.running = True
+            self.done = 0
+            cothread.Spawn(self.run)
+
+    def run(self):
+        """Load each scan while the one before runs, then switch to it"""
+        try:
+            while len(self.entries) > 0:
+                if self.configuring():
+                    logging.error("Scan queue stopped: a configure is in progress")
+                    self.clear()
+                    break
+                params = self.entries.popleft()
+                self.publish()
+                if not self.in_background(self.preload, params,
+                                          1 - self.scan.table_bank):
+                    logging.error("Scan queue stopped: could not load the next scan")
+                    self.scan.set_state(STATE_ERROR)
+                    self.clear()
+                    break
+
+                self.wait_for_generators()
+                if not self.switch():
+                    logging.error("Scan queue stopped: could not start the next scan")
+                    self.clear()
+                    break
+                self.done += 1
+                self.publish()
+        except (socket.error, cothread.Timedout) as error:
+            logging.error("Scan queue stopped: lost the controller: %s" % error)
+            self.scan.set_state(STATE_ERROR)
+            self.clear()
+        finally:
+            # Back to the records for anything configured by hand
+            self.scan.param_overrides = {}
+            self.running = False
+
+    def preload(self, params, bank):
+        """Prepare a scan and upload its wave tables into bank, leaving the
+        running scan alone"""
+        # The tables playing now stay in memory alongside the new ones
+        playing = sum(self.scan.table_points.values())
+        self.scan.param_overrides = params
+        self.scan.table_bank = bank
+        self.scan.get_scan_parameters()
+        if self.scan.generate_commands() == False:
+            return False
+        self.scan.resident_points = playing
+        try:
+            if self.scan.verify_parameters() == False:
+                return False
+        finally:
+            self.scan.resident_points = 0
+        return self.scan.send_setup_commands(tables_only=True) != False
+
+    def wait_for_generators(self):
+        """Wait until no wave generator is running. Only asks when no other
+        thread is using the controller, so the IOC never waits on a lock."""
+        controller = self.scan.controller
+        while True:
+            if controller.lock.acquire(False):
+                try:
+                    if int(controller.query_pipelined(
+                            [WAVE_GENERATOR_STATUS])[0]) == 0:
+                        return
+                finally:
+                    controller.lock.release()
+            cothread.Sleep(self.poll_interval)
+
+    def switch(self):
+        """Send the rest of the setup, including routing the generators to
+        the new bank, then start"""
+        start = time.time()
+        if self.in_background(self.scan.send_setup_commands) == False:
+            self.scan.set_state(STATE_ERROR)
+            return False
+        self.scan.set_state(STATE_READY)
+        started = self.scan.start_scan() != False
+        logging.info("Switched to the next scan in %f s" % (time.time() - start))
+        return started
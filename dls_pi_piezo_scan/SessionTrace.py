@@ -0,0 +1,202 @@
+"""Record what goes over the wire to a controller, and play it back.
+
+RecordingSocket wraps the socket a PIController talks through and writes
+every send and receive to a trace, one JSON object to a line, with the
+time since the start of the session. ReplaySocket stands in for the
+socket and serves the recorded replies from a trace, so a slow or failed
+configure can be run again, or a change benchmarked against real
+traffic, with no hardware.
+
+Replies are served with the delay the controller took to give them,
+counted from the send they followed, or as fast as possible. Sends are
+checked against the trace, and the first difference is logged."""
+
+# Standard dependencies
+import time
+import json
+import bisect
+import select
+import logging
+import collections
+
+
+def encode_data(data):
+    """Bytes as a JSON string, one character to a byte"""
+    return memoryview(data).tobytes().decode("latin-1")
+
+
+def decode_data(text):
+    return text.encode("latin-1")
+
+
+def read_trace(path):
+    """:return list of the events in a trace file"""
+    with open(path) as trace:
+        return [json.loads(line) for line in trace if len(line.strip()) > 0]
+
+
+class RecordingSocket():
+    """A socket that writes everything sent and received to a trace file.
+    Anything else goes to the socket it wraps."""
+
+    def __init__(self, sock, path):
+        """:param sock Socket to wrap, blocking or cothread
+        :param path Trace file to write"""
+        self.sock = sock
+        self.trace = open(path, "w")
+        self.start = time.time()
+
+    def record(self, op, **fields):
+        fields.update({"t": round(time.time() - self.start, 6), "op": op})
+        self.trace.write(json.dumps(fields, sort_keys=True) + "\n")
+
+    def connect(self, address):
+        self.sock.connect(address)
+        self.record("connect", host=address[0], port=address[1])
+
+    def send(self, data):
+        sent = self.sock.send(data)
+        self.record("send", data=encode_data(data[:sent]))
+        return sent
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+        self.record("send", data=encode_data(data))
+
+    def recv(self, size):
+        received = self.sock.recv(size)
+        self.record("recv", data=encode_data(received))
+        return received
+
+    def data_waiting(self):
+        """True if a reply has arrived that hasn't been read"""
+        return len(select.select([self.sock], [], [], 0)[0]) > 0
+
+    def close(self):
+        self.sock.close()
+        self.trace.close()
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class Reply():
+    """A chunk of recorded data received, and when it came"""
+
+    def __init__(self, data, after, delay):
+        """:param after Bytes sent before it arrived
+        :param delay Seconds after the last of those bytes went"""
+        self.data = data
+        self.after = after
+        self.delay = delay
+
+
+class ReplaySocket():
+    """A socket that serves the replies in a trace, as if from the
+    controller the trace was recorded from"""
+
+    def __init__(self, path, speed=1.0, sleep=None):
+        """:param path Trace file written by a RecordingSocket
+        :param speed How much faster than recorded to reply, or None for
+        as fast as possible
+        :param sleep Function to wait with. By default time.sleep, and a
+        reply is served as soon as it is asked for. Given one that only
+        suspends the caller, such as cothread.Sleep, a reply also waits
+        for the send it followed in the trace."""
+        self.speed = speed
+        self.sleep = sleep if sleep is not None else time.sleep
+        self.wait_for_sends = sleep is not None
+        self.timeout = None
+
+        # Everything the trace sent, and each chunk it received
+        sent = []
+        self.replies = collections.deque()
+        sent_bytes = 0
+        last_send = 0.0
+        for event in read_trace(path):
+            if event["op"] == "send":
+                sent.append(decode_data(event["data"]))
+                sent_bytes += len(sent[-1])
+                last_send = event["t"]
+            elif event["op"] == "recv" and len(event["data"]) > 0:
+                self.replies.append(Reply(decode_data(event["data"]), sent_bytes,
+                                          event["t"] - last_send))
+        self.expected = "".join(sent)
+
+        # What we have been sent, and when, by bytes sent so far
+        self.sent_bytes = 0
+        self.send_counts = [0]
+        self.send_times = [time.time()]
+
+        # Where our sends first differ from the trace, if they do
+        self.mismatch = None
+
+    def connect(self, address):
+        pass
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def setsockopt(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def sendall(self, data):
+        data = memoryview(data).tobytes()
+        if self.mismatch is None and \
+                data != self.expected[self.sent_bytes:self.sent_bytes + len(data)]:
+            self.mismatch = self.sent_bytes
+            logging.warning("Replay: sent %r at byte %d, the trace sent %r" % (
+                data, self.sent_bytes,
+                self.expected[self.sent_bytes:self.sent_bytes + len(data)]))
+        self.sent_bytes += len(data)
+        self.send_counts.append(self.sent_bytes)
+        self.send_times.append(time.time())
+
+    def due(self, reply):
+        """When a reply should arrive, or None if the send it follows
+        hasn't happened yet"""
+        if self.sent_bytes < reply.after:
+            if self.wait_for_sends:
+                return None
+            # A blocking caller won't send any more until it has the reply
+            sent = self.send_times[-1]
+        else:
+            sent = self.send_times[bisect.bisect_left(self.send_counts, reply.after)]
+        if self.speed is None:
+            return sent
+        return sent + reply.delay / self.speed
+
+    def data_waiting(self):
+        """True if the next reply is due. Never before we have sent what
+        the trace had when it read the reply, so a poll sees it at the
+        same point in the session."""
+        if len(self.replies) == 0 or self.sent_bytes < self.replies[0].after:
+            return False
+        return self.due(self.replies[0]) <= time.time()
+
+    def recv(self, size):
+        """The next recorded reply, once it is due. Nothing once the
+        trace has run out, as if the controller had closed the connection."""
+        if len(self.replies) == 0:
+            return ""
+        reply = self.replies[0]
+        due = self.due(reply)
+        while due is None:
+            self.sleep(0.001)
+            due = self.due(reply)
+        if due > time.time():
+            self.sleep(due - time.time())
+
+        if len(reply.data) > size:
+            # The rest straight away on the next recv
+            data, reply.data, reply.delay = reply.data[:size], reply.data[size:], 0.0
+            return data
+        self.replies.popleft()
+        return reply.data
@@ -0,0 +1,39 @@
+"""Build wave table trigger points as TWS commands.
+
+Trigger points are worked out from the step grid in integer arithmetic,
+so the last column of a long row lands where the first would put it,
+with no drift from adding up float steps. They are written out with as
+many point triplets to a TWS line as the controller takes."""
+
+# Extra dependencies
+from pkg_resources import require
+require("numpy")
+import numpy
+
+from PIConstants import *
+
+
+def column_points(columns, points):
+    """Wave table points that divide points into columns equal parts
+    :return array of the 1 based point at the start of each column"""
+    return numpy.arange(columns, dtype=numpy.int64) * points // columns + 1
+
+
+def render_triggers(trigger_points, output, switch=1):
+    """TWS commands setting a trigger output at each point
+    :param trigger_points 1 based wave table points
+    :param output Trigger output the points are for
+    :param switch 1 to set the output at the points, 0 to clear them
+    :return command lines, TRIGGERS_PER_LINE points to a line"""
+    trigger_points = numpy.asarray(trigger_points, dtype=numpy.int64)
+    full_lines, rest = divmod(len(trigger_points), TRIGGERS_PER_LINE)
+
+    # One format operation for all the full lines
+    triplet = "%d %%d %d" % (output, switch)
+    line = "TWS " + " ".join([triplet] * TRIGGERS_PER_LINE) + "\n"
+    commands = (line * full_lines) % tuple(
+        trigger_points[:full_lines * TRIGGERS_PER_LINE].tolist())
+    if rest > 0:
+        line = "TWS " + " ".join([triplet] * rest) + "\n"
+        commands += line % tuple(trigger_points[-rest:].tolist())
+    return commands
@@ -0,0 +1,147 @@
+"""Encode wave table contents as WAV commands.
+
+Scans describe each wave table as runs of holds: constant segments, each
+with a value and a length in points. These can be written out explicitly,
+one WAV line per hold, or compactly, where adjacent holds at the same value
+become one segment.
+
+Compact encoding only merges holds, which for a step scan is the MOVETIME
+and EXPOSURE holds of each step, so it roughly halves the lines rather than
+cutting them by orders of magnitude. A row is not encoded as one step
+repeated with WGC and WOS: a generator repeats its whole table, and the
+tables already hold the shortest repeat, two rows played NY/2 times,
+which still needs a segment for each step."""
+
+# Extra dependencies
+from pkg_resources import require
+require("numpy")
+import numpy
+
+# Other files in this module
+import CommandTemplates
+
+from PIConstants import *
+
+templates = CommandTemplates.get_command_templates()
+
+# Values closer than this are the same, since WAV values are
+# written with 6 decimal places
+VALUE_TOLERANCE = 5e-7
+
+
+class HoldBlock():
+    """A run of holds added to a wave table"""
+
+    def __init__(self, table, action, values, lengths):
+        """:param table Wave table number
+        :param action ACTION_REPLACE or ACTION_APPEND for the first hold
+        :param values Demand position of each hold
+        :param lengths Length of each hold in points"""
+        self.table = table
+        self.action = action
+        self.values = numpy.asarray(values, dtype=float)
+        self.lengths = numpy.asarray(lengths, dtype=int)
+
+    def points(self):
+        return int(self.lengths.sum())
+
+
+class TableEncoding():
+    """WAV commands for one wave table"""
+
+    def __init__(self, table, commands, points, segments):
+        """:param commands WAV command lines
+        :param points Wave table points used
+        :param segments Number of WAV lines"""
+        self.table = table
+        self.commands = commands
+        self.points = points
+        self.segments = segments
+
+
+def render_holds(table, action, values, lengths):
+    """One WAV line per hold, the first one with the given action.
+    All the lines are rendered in one go, rather than one format per line."""
+    if len(values) == 0:
+        return ""
+    columns = {"LENGTH": lengths.tolist(), "value": values.tolist()}
+    first = dict((name, column[:1]) for name, column in columns.items())
+    rest = dict((name, column[1:]) for name, column in columns.items())
+
+    commands = []
+    for first_action, rows in ((action, first), (ACTION_APPEND, rest)):
+        row, order = CommandTemplates.bulk_template(
+            templates["hold"], ("LENGTH", "value"),
+            TABLE=table, first=first_action)
+        commands.append(CommandTemplates.render_bulk(row, order, rows))
+    return "".join(commands)
+
+
+def render_explicit(blocks):
+    """Every hold as its own segment, in the order they were added"""
+    return "".join([render_holds(block.table, block.action,
+                                 block.values, block.lengths)
+                    for block in blocks])
+
+
+def table_holds(blocks):
+    """Join the blocks for one table into the holds it ends up containing"""
+    values = []
+    lengths = []
+    for block in blocks:
+        if block.action == ACTION_REPLACE:
+            values = []
+            lengths = []
+        values.append(block.values)
+        lengths.append(block.lengths)
+    if len(values) == 0:
+        return numpy.zeros(0), numpy.zeros(0, dtype=int)
+    return numpy.concatenate(values), numpy.concatenate(lengths)
+
+
+def merge_holds(values, lengths):
+    """Merge neighbouring holds at the same value into one"""
+    if len(values) == 0:
+        return values, lengths
+    starts = numpy.flatnonzero(numpy.concatenate(
+        ([True], numpy.abs(numpy.diff(values)) > VALUE_TOLERANCE)))
+    return values[starts], numpy.add.reduceat(lengths, starts)
+
+
+def encode_compact(table, blocks):
+    """Encode a table in as few segments as we can"""
+    values, lengths = merge_holds(*table_holds(blocks))
+    commands = render_holds(table, ACTION_REPLACE, values, lengths)
+    return TableEncoding(table, commands, int(lengths.sum()), len(values))
+
+
+def block_tables(blocks):
+    """The tables the blocks describe, in the order they first appear"""
+    tables = []
+    for block in blocks:
+        if block.table not in tables:
+            tables.append(block.table)
+    return tables
+
+
+def encode_tables(blocks, encoding):
+    """Encode all the tables the blocks describe
+    :param encoding ENCODING_EXPLICIT or ENCODING_COMPACT
+    :return commands and a TableEncoding for each table"""
+    tables = block_tables(blocks)
+
+    encodings = {}
+    if encoding == ENCODING_EXPLICIT:
+        for table in tables:
+            table_blocks = [block for block in blocks if block.table == table]
+            values, lengths = table_holds(table_blocks)
+            encodings[table] = TableEncoding(table, render_explicit(table_blocks),
+                                             int(lengths.sum()), len(values))
+        return render_explicit(blocks), encodings
+
+    commands = []
+    for table in tables:
+        encodings[table] = encode_compact(
+            table, [block for block in blocks if block.table == table])
+        commands.append(encodings[table].commands)
+    return "".join(commands), encodings
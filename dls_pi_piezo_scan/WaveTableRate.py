@@ -0,0 +1,47 @@
+"""Choose the wave table rate for a scan.
+
+Segment lengths are counted in wave table points, so a long MOVETIME or
+EXPOSURE at 1 ms per point spends most of the controller memory holding
+still. The coarsest rate that still gets every duration to within a
+tolerance uses the fewest points. All rates are tried at once."""
+
+# Extra dependencies
+from pkg_resources import require
+require("numpy")
+import numpy
+
+from PIConstants import *
+
+
+def choose_rate(durations, tolerance, max_rate=MAX_WAVE_TABLE_RATE):
+    """Wave table rate that represents each duration to within tolerance
+    in the fewest points, and of those the most accurately. If none does,
+    the rate that comes closest.
+    :param durations Times the wave tables must hold for / ms. A zero
+    duration is no points at any rate.
+    :param tolerance Largest error allowed in any duration / %
+    :param max_rate Coarsest rate to consider / servo cycles per point
+    :return rate, and the length of each duration in points"""
+    durations = numpy.asarray(durations, dtype=float)
+    if numpy.any(durations < 0):
+        raise ValueError("Negative duration for the wave table rate: %s" % durations)
+    timed = durations > 0
+    rates = numpy.arange(max_rate, 0, -1)
+    point_time = rates * E727_SERVO_CYCLE * 1000.0
+
+    # Points for each duration at each rate, never less than one
+    # unless the duration is zero
+    points = numpy.maximum(numpy.rint(durations[numpy.newaxis, :]
+                                      / point_time[:, numpy.newaxis]), timed)
+    errors = numpy.abs(points * point_time[:, numpy.newaxis] - durations) \
+        / numpy.where(timed, durations, 1.0) * 100.0
+    worst = errors.max(axis=1)
+
+    within = numpy.flatnonzero(worst <= tolerance)
+    if len(within) > 0:
+        # Sorted by error within total points
+        order = numpy.lexsort((worst[within], points[within].sum(axis=1)))
+        best = within[order[0]]
+    else:
+        best = numpy.argmin(worst)
+    return int(rates[best]), points[best].astype(int).tolist()
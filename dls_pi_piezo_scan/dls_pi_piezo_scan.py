@@ -2,11 +2,16 @@
 """Generate the commands to perform a raster scan
  on a PI E72* piezo controller
 
- Based on work by Giles Knap in the PiPiezo module"""
+ Based on work by Giles Knap in the PiPiezo module
+
+ PIStepScan runs the same rows directly from the scan IOC,
+ with SCAN_MODE set to Fly"""
 from pkg_resources import require
 require("cothread==2.14")
 
-import math, argparse
+import argparse
+
+import TriggerTable
 
 
 def enum(**enums):
@@ -162,24 +167,10 @@ class RasterGenerator():
         self.add("CTO 1 3 4")
 
         # add the points for triggering output 1
-        # Note rows and cols here refer to rows and cols of command strings
-        # you are only allowed 10 parms per line in the command interface
-        # the trigger points are for a single row of X positions
-        start = self.xmin
-        stop = self.xmax - self.xstepSize / 2.0
-        pos = start
-        for row in range(int(math.ceil(self.cols / 10.0))):  # @UnusedVariable
-            cmdr = "TWS "
-            for col in range(10):  # @UnusedVariable
-                # note the +1 because the triggers table is indexed from 1
-                nextpos = ((pos - start) * self.eguToPts + 1)
-                cmdr += "1 %4d 1 " % nextpos
-                # DEBUG cmdr += "   %4d  %6.3f" % (nextpos, pos)
-                pos += self.xstepSize
-                if round(pos, 10) > stop:
-                    # DEBUG print "pos %f, rounded %f, stop %f, xstep %f" % (pos, round(pos, 10), stop, self.xstepSize )
-                    break
-            self.add(cmdr)
+        # the trigger points are for a single row of X positions, one at
+        # the start of each column (half a step before its centre)
+        self.add(TriggerTable.render_triggers(
+            TriggerTable.column_points(int(self.cols), self.points), 1).rstrip("\n"))
 
         # set up data recorder to capture demand and actual position for 3 axes
         self.add("DRC 1 1 2")
@@ -0,0 +1,227 @@
+#!/bin/env dls-python
+"""Time scan generation, coordinate transforms and uploads.
+
+Results are written as JSON, one entry per benchmark and set of
+parameters, so runs on different commits can be compared with --compare."""
+
+# Standard dependencies
+import sys
+import json
+import time
+import logging
+import platform
+import argparse
+import subprocess
+
+# Extra dependencies
+from pkg_resources import require
+require("numpy")
+import numpy
+
+# Other files in this module
+import PIStepScan
+import PIController
+import PISimulator
+import CoordinateTransform
+from dls_pi_piezo_scan import RasterGenerator
+
+from PIConstants import *
+
+# Scan sizes to time, (NX, NY) or (cols, rows)
+STEP_SCAN_SIZES = [(10, 10), (100, 100), (1000, 100), (10000, 100)]
+RASTER_SIZES = [(10, 10), (100, 100), (1000, 1000)]
+UPLOAD_SIZES = [(10, 10), (100, 100), (1000, 100)]
+
+# Points per coordinate transform benchmark
+TRANSFORM_POINTS = 10000
+
+# Scan parameters other than the size
+BENCHMARK_PARAMS = {"STATE": STATE_NOT_CONFIGRED, "NZ": 1,
+                    "DX": 0.1, "DY": 0.1, "DZ": 0.1,
+                    "X0": 10.0, "Y0": 10.0, "Z0": 10.0,
+                    "THETA": 0.0, "MOVETIME": 40, "EXPOSURE": 100}
+
+ENCODINGS = {"explicit": ENCODING_EXPLICIT, "compact": ENCODING_COMPACT}
+
+
+def best_time(function, repeats):
+    """Shortest wall clock time of several calls / s"""
+    times = []
+    for i in range(repeats):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def result(benchmark, params, seconds, **extra):
+    """One benchmark result, as written to the JSON output"""
+    entry = {"benchmark": benchmark, "params": params, "seconds": seconds}
+    entry.update(extra)
+    return entry
+
+
+def create_scan(controller, nx, ny, encoding):
+    scan = PIStepScan.PIStepScan(controller)
+    scan.insert_params(dict(BENCHMARK_PARAMS, NX=nx, NY=ny,
+                            ENCODING=ENCODINGS[encoding]))
+    scan.get_scan_parameters()
+    return scan
+
+
+def benchmark_step_scan(repeats):
+    """Generate setup commands for a step scan"""
+    controller = PIController.PIController("127.0.0.1", debug=True)
+    results = []
+    for nx, ny in STEP_SCAN_SIZES:
+        for encoding in sorted(ENCODINGS):
+            scan = create_scan(controller, nx, ny, encoding)
+            seconds = best_time(scan.prepare_setup_commands, repeats)
+            results.append(result("prepare_setup_commands",
+                                  {"NX": nx, "NY": ny, "encoding": encoding}, seconds,
+                                  bytes=scan.setup_commands.size(),
+                                  lines=scan.setup_commands.line_count()))
+    return results
+
+
+def benchmark_raster(repeats):
+    """Generate commands for a raster scan"""
+    results = []
+    for cols, rows in RASTER_SIZES:
+        def create_commands():
+            RasterGenerator(10, 10, 90, 10, 90, rows, cols).createCommands()
+        results.append(result("RasterGenerator.createCommands",
+                              {"cols": cols, "rows": rows},
+                              best_time(create_commands, repeats)))
+    return results
+
+
+def benchmark_transform(repeats):
+    """Coordinate transforms, point by point"""
+    transform = CoordinateTransform.CoordinateTransform()
+    points = [(0.1 * i, 0.2 * i, 0.3 * i) for i in range(TRANSFORM_POINTS)]
+    results = []
+    for name, function in (("forward", transform.forward),
+                           ("inverse", transform.inverse)):
+        def transform_points():
+            for x, y, z in points:
+                function(x, y, z, theta=30.0, pitch=1.0, roll=2.0)
+        seconds = best_time(transform_points, repeats)
+        results.append(result("CoordinateTransform." + name,
+                              {"points": TRANSFORM_POINTS}, seconds,
+                              points_per_second=TRANSFORM_POINTS / seconds))
+
+    # The same, all the points at once
+    array = numpy.array(points)
+    for name, function in (("forward_array", transform.forward_array),
+                           ("inverse_array", transform.inverse_array)):
+        seconds = best_time(lambda: function(array, theta=30.0, pitch=1.0, roll=2.0),
+                            repeats)
+        results.append(result("CoordinateTransform." + name,
+                              {"points": TRANSFORM_POINTS}, seconds,
+                              points_per_second=TRANSFORM_POINTS / seconds))
+    return results
+
+
+def benchmark_upload(repeats, profile):
+    """Send setup commands to a simulated controller over a local socket"""
+    latency, bandwidth = PISimulator.LINK_PROFILES[profile]
+    server = PISimulator.PISimulatorServer(
+        ("127.0.0.1", 0), PISimulator.PISimulator(datapoints=10 ** 9),
+        latency=latency, bandwidth=bandwidth)
+    host, port = server.start()
+    controller = PIController.PIController(host, port)
+
+    results = []
+    try:
+        for nx, ny in UPLOAD_SIZES:
+            scan = create_scan(controller, nx, ny, "explicit")
+            scan.prepare_setup_commands()
+            commands = scan.setup_commands.get()
+            for batch in (False, True):
+                seconds = best_time(
+                    lambda: controller.send_multiline(commands, batch=batch), repeats)
+                results.append(result("send_multiline",
+                                      {"NX": nx, "NY": ny, "batch": batch,
+                                       "link": profile}, seconds,
+                                      bytes=len(commands),
+                                      bytes_per_second=len(commands) / seconds))
+    finally:
+        controller.socket.close()
+        server.stop()
+    return results
+
+
+def git_commit():
+    """The commit we are benchmarking, if we can tell"""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"]).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(entry):
+    return entry["benchmark"], json.dumps(entry["params"], sort_keys=True)
+
+
+def compare(results, baseline, threshold):
+    """Report benchmarks slower than the baseline by more than threshold
+    :return list of (benchmark, params, baseline seconds, seconds)"""
+    previous = dict((result_key(entry), entry) for entry in baseline["results"])
+    slower = []
+    for entry in results["results"]:
+        before = previous.get(result_key(entry))
+        if before is not None and entry["seconds"] > before["seconds"] * threshold:
+            slower.append((entry["benchmark"], entry["params"],
+                           before["seconds"], entry["seconds"]))
+    return slower
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark scan command generation and upload, "
+                                     "writing the results as JSON.")
+
+    parser.add_argument("-o", "--output", type=str, help="File to write results to, default stdout")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="Time each benchmark this many times "
+                        "and keep the fastest")
+    parser.add_argument("--link", choices=sorted(PISimulator.LINK_PROFILES), default="ethernet",
+                        help="Link to simulate for uploads")
+    parser.add_argument("--compare", type=str, help="Results from an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Report benchmarks that take this "
+                        "many times longer than in the earlier run")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    results = {"commit": git_commit(),
+               "python": platform.python_version(),
+               "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "results": benchmark_step_scan(args.repeats)
+                          + benchmark_raster(args.repeats)
+                          + benchmark_transform(args.repeats)
+                          + benchmark_upload(args.repeats, args.link)}
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            slower = compare(results, json.load(baseline_file), args.threshold)
+        for benchmark, params, before, after in slower:
+            logging.error("Slower: %s %s: %f s, was %f s" % (
+                benchmark, json.dumps(params, sort_keys=True), after, before))
+        if len(slower) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,18 @@
 #!/bin/env dls-python
 import PIController
 import PIStepScan
+import WaveEncoder
+import PlanCache
+import CommandStore
+import ScanMetrics
+import CoordinateTransform
+import ConfigureWorker
+import CothreadController
+import TriggerTable
+import dls_pi_piezo_scan
+import WaveTableRate
+import ScanQueue
+from PIConstants import *
 
 from pkg_resources import require
 require('cothread==2.13')
@@ -14,6 +26,11 @@ import random
 import logging
 
 
+# Scan parameters for tests that don't go through the records
+scan_params = {"STATE": 0, "NX": 30, "NY": 30, "NZ": 1,
+               "DX": 0.5, "DY": 0.5, "DZ": 0.5,
+               "X0": 10.0, "Y0": 10.0, "Z0": 10.0,
+               "THETA": 0.0, "MOVETIME": 40, "EXPOSURE": 100}
 
 
 class PIControllerTest(unittest.TestCase):
@@ -88,6 +105,19 @@ class TestAdd(PIControllerTest):
         self.scan.start_commands.clear()
         self.assertEqual(self.scan.start_commands.get(), "")
 
+class TestStoreSize(PIControllerTest):
+    """TestStoreSize - the store counts its lines and bytes as commands are added"""
+
+    def test_store_size(self):
+        store = self.scan.setup_commands
+        store.add("SVO 1 1\nSVO 2 1\n")
+        store.add("WGO 1")
+        self.assertEqual(store.line_count(), 3)
+        self.assertEqual(store.size(), len(store.get()))
+        store.add(" 257\n")
+        self.assertEqual(store.line_count(), 3)
+        self.assertEqual(store.get(), "SVO 1 1\nSVO 2 1\nWGO 1 257\n")
+
 class TestStartCommands(PIControllerTest):
     """TestStartCommands"""
 
@@ -104,6 +134,461 @@ class TestSetupCommands(PIControllerTest):
         self.scan.prepare_setup_commands()
         print self.scan.setup_commands.get()
 
+class TestTablePoints(PIControllerTest):
+    """TestTablePoints - wave table points are counted as commands are generated"""
+
+    def test_table_points(self):
+        self.scan.insert_params(dict(scan_params, NX=10, NY=4))
+        self.scan.get_scan_parameters()
+        self.scan.prepare_setup_commands()
+
+        # X table holds both rows plus the appended Y step of the even row,
+        # Y table holds the odd row Y step
+        y_step = 10 * 140 + 2 * 40
+        self.assertEqual(self.scan.table_points, {TABLEX: 2 * 10 * 140 + y_step,
+                                                  TABLEY: y_step})
+        self.assertEqual(self.scan.calculate_required_data_points(),
+                         2 * 10 * 140 + 2 * y_step)
+
+class TestWaveEncoder(PIControllerTest):
+    """TestWaveEncoder - compact encoding describes the same wave tables"""
+
+    def expand(self, commands):
+        """Wave table values from hold segments"""
+        values = []
+        for line in commands.strip().split("\n"):
+            words = line.split()
+            if words[2] == ACTION_REPLACE:
+                values = []
+            values += [float(words[6])] * int(words[4])
+        return values
+
+    def test_compact_encoding(self):
+        self.scan.insert_params(dict(scan_params, NX=10, NY=4,
+                                     ENCODING=ENCODING_EXPLICIT))
+        self.scan.get_scan_parameters()
+        self.scan.prepare_setup_commands()
+        explicit = self.scan.setup_commands.get()
+        explicit_points = self.scan.calculate_required_data_points()
+
+        self.scan.params["ENCODING"] = ENCODING_COMPACT
+        self.scan.prepare_setup_commands()
+        compact = self.scan.setup_commands.get()
+
+        self.assertLess(len(compact), len(explicit))
+        self.assertEqual(self.scan.calculate_required_data_points(), explicit_points)
+        for table in (TABLEX, TABLEY):
+            prefix = "WAV %d " % table
+            self.assertEqual(
+                self.expand("\n".join([l for l in explicit.split("\n") if l.startswith(prefix)])),
+                self.expand("\n".join([l for l in compact.split("\n") if l.startswith(prefix)])))
+
+    def test_bulk_rendering(self):
+        """Rendering all the lines in one go gives the same bytes as
+        formatting the template line by line"""
+        values = 0.1 * PIStepScan.numpy.arange(-50, 50)
+        lengths = PIStepScan.numpy.tile([40, 100], 50)
+        expected = "".join([WaveEncoder.templates["hold"].format(
+            TABLE=TABLEX, first=ACTION_REPLACE if i == 0 else ACTION_APPEND,
+            LENGTH=lengths[i], value=values[i]) for i in xrange(len(values))])
+        self.assertEqual(WaveEncoder.render_holds(TABLEX, ACTION_REPLACE, values, lengths),
+                         expected)
+
+class TestBatchedUpload(PIControllerTest):
+    """TestBatchedUpload - batched uploads are split into whole lines"""
+
+    def test_encode_commands(self):
+        encoded = PIController.encode_commands("  SVO 1 1\n\nSVO 2 1  \nSTP")
+        self.assertEqual(encoded, "SVO 1 1\nSVO 2 1\nSTP\n")
+
+    def test_checkpoint_windows(self):
+        lines = ["WGC 3 15"] * 5
+        # Each run of lines and its ERR? fit in 30 bytes
+        self.controller.max_outstanding_bytes = 30
+        self.assertEqual(self.controller.checkpoint_windows(lines),
+                         [(0, 1, 23), (2, 3, 23), (4, 4, 14)])
+        # Or fewer lines, if asked for
+        self.controller.checkpoint_lines = 1
+        self.assertEqual([window[:2] for window in self.controller.checkpoint_windows(lines)],
+                         [(i, i) for i in range(5)])
+        # A line too long on its own still goes
+        self.controller.max_outstanding_bytes = 5
+        self.assertEqual(self.controller.checkpoint_windows(lines[:1]), [(0, 0, 14)])
+
+    def test_send_batched(self):
+        self.scan.insert_params(scan_params)
+        self.scan.get_scan_parameters()
+        self.scan.prepare_setup_commands()
+        commands = self.scan.setup_commands.get()
+        # Ready to send as they are
+        self.assertEqual(PIController.encode_commands(commands), commands)
+        self.assertTrue(self.controller.send_multiline(commands, batch=True,
+                                                       encoded=True))
+
+class TestPlanCache(PIControllerTest):
+    """TestPlanCache - repeat configures reuse the compiled commands"""
+
+    def test_plan_cache(self):
+        self.scan.insert_params(dict(scan_params, NX=10, NY=4))
+        self.scan.get_scan_parameters()
+        self.assertFalse(self.scan.load_cached_plan())
+        self.scan.prepare_setup_commands()
+        self.scan.prepare_start_commands()
+        self.scan.save_plan()
+        setup = self.scan.setup_commands.get()
+
+        # Changing state doesn't change the plan, changing the scan does
+        self.scan.insert_params(dict(scan_params, NX=10, NY=4, STATE=STATE_READY))
+        self.scan.get_scan_parameters()
+        self.scan.setup_commands.clear()
+        self.assertTrue(self.scan.load_cached_plan())
+        self.assertEqual(self.scan.setup_commands.get(), setup)
+        self.scan.insert_params(dict(scan_params, NX=12, NY=4))
+        self.scan.get_scan_parameters()
+        self.assertFalse(self.scan.load_cached_plan())
+        self.assertEqual((self.scan.plan_cache.hits, self.scan.plan_cache.misses), (1, 2))
+
+    def test_eviction(self):
+        def plan(lines):
+            store = CommandStore.CommandStore()
+            store.add("WAV 1 X LIN 10 0 0 10 0 0\n" * lines)
+            return PlanCache.ScanPlan(store, CommandStore.CommandStore(), {})
+
+        cache = PlanCache.PlanCache(max_plans=2, max_bytes=1000)
+        for key in ("a", "b", "c"):
+            cache.put(key, plan(10))
+        self.assertEqual(cache.plans.keys(), ["b", "c"])
+
+        # Using a plan makes it the last to go
+        cache.get("b")
+        cache.put("d", plan(20))
+        self.assertEqual(cache.plans.keys(), ["b", "d"])
+        cache.put("e", plan(30))
+        self.assertEqual(cache.plans.keys(), ["e"])
+        self.assertEqual(cache.bytes, cache.plans["e"].size())
+
+class TestIncrementalUpload(PIControllerTest):
+    """TestIncrementalUpload - only changed command groups are sent again"""
+
+    def configure(self, status=True, **changes):
+        sent = []
+        self.controller.send_multiline = lambda commands, batch, encoded: sent.append(
+            commands) or status
+        self.scan.insert_params(dict(scan_params, NX=10, NY=4, **changes))
+        self.scan.get_scan_parameters()
+        self.scan.prepare_setup_commands()
+        self.assertEqual(self.scan.send_setup_commands(), status)
+        return "".join(sent)
+
+    def test_incremental_upload(self):
+        self.assertEqual(self.configure(), self.scan.setup_commands.get())
+        offsets = "WOS 1 20.000000\nWOS 3 10.000000\nWOS 2 10.000000\n"
+        self.assertEqual(self.configure(X0=20.0), offsets)
+        # The offsets move on as a scan plays, so they always go again
+        self.assertEqual(self.configure(X0=20.0), offsets)
+
+        # A failed upload leaves the controller in an unknown state
+        self.configure(status=False, X0=30.0)
+        self.assertEqual(self.configure(X0=30.0), self.scan.setup_commands.get())
+
+class TestMetrics(PIControllerTest):
+    """TestMetrics - configuring records how long each phase took"""
+
+    def test_rolling_statistic(self):
+        statistic = ScanMetrics.RollingStatistic(history=3)
+        for value in (10, 1, 2, 3):
+            statistic.add(value)
+        self.assertEqual((statistic.minimum(), statistic.mean(), statistic.maximum()),
+                         (1, 2.0, 3))
+
+    def test_configure_metrics(self):
+        self.scan.records = None
+        self.scan.insert_params(dict(scan_params, NX=10, NY=4))
+        for i in range(2):
+            self.scan.configure_scan()
+        statistics = self.scan.metrics.statistics
+        for name in ("GATHER_TIME", "GENERATE_TIME", "VERIFY_TIME",
+                     "UPLOAD_TIME", "CONFIGURE_TIME"):
+            self.assertEqual(len(statistics[name].values), 2)
+        # The second configure only sends the offsets again
+        self.assertEqual(list(statistics["UPLOAD_BYTES"].values),
+                         [self.scan.setup_commands.size(),
+                          len(self.scan.setup_commands.select(["offsets"]))])
+        self.assertEqual(len(statistics["ERR_LATENCY"].values), 2)
+        self.assertEqual(self.scan.plan_cache.hits, 1)
+
+class TestAbort(PIControllerTest):
+    """TestAbort - aborting sends the stop commands and times them"""
+
+    def test_abort(self):
+        sent = []
+        self.controller.send_multiline = lambda commands, batch=False: sent.append(
+            commands) or True
+        self.scan.abort_scan()
+        self.assertEqual(sent, [self.scan.stop_commands.get()])
+        self.assertEqual(len(self.scan.metrics.statistics["STOP_TIME"].values), 1)
+
+class TestCoordinateTransform(PIControllerTest):
+    """TestCoordinateTransform - batch transforms match point by point ones"""
+
+    def test_batch_transform(self):
+        transform = CoordinateTransform.CoordinateTransform()
+        points = PIStepScan.numpy.array([[10.0, 20.0, 30.0], [-5.0, 0.5, 100.0]])
+        lab = transform.forward_array(points, theta=30.0, pitch=1.0, roll=2.0)
+        for point, expected in zip(points, lab):
+            self.assertEqual(transform.forward(*point, theta=30.0, pitch=1.0, roll=2.0),
+                             tuple(expected))
+        real = transform.inverse_array(lab, theta=30.0, pitch=1.0, roll=2.0)
+        self.assertTrue(PIStepScan.numpy.allclose(real, points, atol=1e-5))
+
+    def test_theta_rotation(self):
+        transform = CoordinateTransform.CoordinateTransform(r_y=90.0)
+        self.assertEqual(transform.forward(1.0, 0.0, 0.0), (0.0, 0.0, -1.0))
+        self.assertEqual(len(transform.matrices), 1)
+
+class TestRotatedScan(PIControllerTest):
+    """TestRotatedScan - sample frame grids rotated into the lab frame"""
+
+    def prepare(self, **changes):
+        self.scan.insert_params(dict(scan_params, NX=10, NY=4, **changes))
+        self.scan.get_scan_parameters()
+        self.scan.prepare_setup_commands()
+        self.scan.prepare_start_commands()
+        return self.scan.calculate_required_data_points()
+
+    def test_rotated_points(self):
+        step_points = self.prepare()
+        rotated_points = self.prepare(SCAN_MODE=SCAN_MODE_ROTATED, THETA=30.0)
+        self.assertLessEqual(rotated_points, step_points)
+        self.assertEqual(self.scan.table_points, {TABLEX: 1400, TABLEY: 1400, TABLEZ: 1400})
+        self.assertEqual(self.scan.start_commands.get(), "WGO 1 257 2 257 3 257")
+
+        # Without rotation Z stays still and needs no table
+        self.prepare(SCAN_MODE=SCAN_MODE_ROTATED, THETA=0.0)
+        self.assertEqual(sorted(self.scan.table_points), [TABLEX, TABLEY])
+
+    def test_rotated_limits(self):
+        # Rotating x into z takes z below its starting position
+        self.prepare(SCAN_MODE=SCAN_MODE_ROTATED, THETA=60.0, Z0=2.0)
+        self.assertFalse(self.scan.verify_parameters())
+        self.prepare(SCAN_MODE=SCAN_MODE_ROTATED, THETA=-60.0, Z0=2.0)
+        self.assertTrue(self.scan.verify_parameters())
+
+class TestFlyScan(PIControllerTest):
+    """TestFlyScan - continuous rows with a trigger at each column"""
+
+    def prepare(self, **changes):
+        params = dict(scan_params, NX=12, NY=4, SCAN_MODE=SCAN_MODE_FLY, ROW_RATE=100.0)
+        params.update(changes)
+        self.scan.insert_params(params)
+        self.scan.get_scan_parameters()
+        self.scan.prepare_setup_commands()
+        self.scan.prepare_start_commands()
+
+    def test_fly_commands(self):
+        self.prepare()
+        # 100 Hz leaves 200 servo cycles per row, one per point
+        self.assertEqual(self.scan.fly_timing(), (1, 200))
+        self.assertEqual(self.scan.table_points, {TABLEX: 220, TABLEY: 220})
+        commands = self.scan.setup_commands.get()
+        self.assertIn("WAV 1 X LIN 200 6.000000 -0.250000 200 0 0\n"
+                      "WAV 1 & LIN 20 -6.000000 5.750000 18 0 0\n", commands)
+        self.assertIn("TWS 1 1 1 1 17 1 1 34 1", commands)
+        self.assertIn("TWS 1 167 1 1 184 1\n", commands)
+        self.assertIn("WGC 1 4\nWGC 3 4\n", commands)
+        self.assertIn("WTR 0 1 1\nRTR 1\n", commands)
+        self.assertIn("MOV 1 9.750000", self.scan.start_commands.get())
+        # Generators are numbered by the axis they drive
+        self.assertTrue(self.scan.start_commands.get().endswith("WGO %d 1 %d 257" % (AXISX, AXISY)))
+        self.assertTrue(self.scan.verify_parameters())
+
+    def test_fly_limits(self):
+        # Slow rows are played slower rather than with more points
+        self.prepare(ROW_RATE=1.0)
+        self.assertEqual(self.scan.fly_timing(), (10, 2000))
+        self.prepare(ROW_RATE=200.0)
+        self.assertFalse(self.scan.verify_parameters())
+        # Half a step before the first column is off the end
+        self.prepare(X0=0.1)
+        self.assertFalse(self.scan.verify_parameters())
+
+class TestVolumeScan(PIControllerTest):
+    """TestVolumeScan - stacks of layers as one sequence"""
+
+    def test_volume_tables(self):
+        self.scan.insert_params(dict(scan_params, NX=10, NY=4, NZ=3,
+                                     SCAN_MODE=SCAN_MODE_VOLUME))
+        self.scan.get_scan_parameters()
+        self.scan.prepare_setup_commands()
+        self.scan.prepare_start_commands()
+
+        # A row is 1400 points, a layer four rows
+        self.assertEqual(self.scan.table_points, {TABLEX: 1400, TABLEY: 5600, TABLEZ: 5600})
+        self.assertEqual(self.scan.generator_cycles(), {TABLEX: 12, TABLEY: 3, TABLEZ: 3})
+        commands = self.scan.setup_commands.get()
+        self.assertIn("WAV 3 & LIN 40 0 0.000000 40 0 0\n", commands)
+        self.assertIn("WAV 2 X LIN 5560 0 0.000000 5560 0 0\n"
+                      "WAV 2 & LIN 40 0 0.500000 40 0 0\n", commands)
+        self.assertEqual(self.scan.start_commands.get(), "WGO 1 257 2 257 3 257")
+
+class TestTriggerTable(PIControllerTest):
+    """TestTriggerTable - trigger points from the step grid, packed into TWS lines"""
+
+    def test_column_points(self):
+        self.assertEqual(list(TriggerTable.column_points(3, 10)), [1, 4, 7])
+        # No drift however long the row
+        trigger_points = TriggerTable.column_points(30000, 2000000)
+        self.assertEqual(trigger_points[-1], 29999 * 2000000 // 30000 + 1)
+
+    def test_render_triggers(self):
+        lines = TriggerTable.render_triggers(range(1, 24), 2).split("\n")
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[0].split(), ["TWS"] + ["2", "1", "1", "2", "2", "1"]
+                         + sum([["2", "%d" % i, "1"] for i in range(3, 11)], []))
+        self.assertEqual(lines[2], "TWS 2 21 1 2 22 1 2 23 1")
+        self.assertEqual(lines[3], "")
+
+    def test_raster_triggers(self):
+        # Integer steps, so the last columns are 1401, 1601, 1801 rather
+        # than the 1400, 1600, 1800 that summing float steps truncated to
+        raster = dls_pi_piezo_scan.RasterGenerator(10, 10, 90, 10, 90, 10, 10)
+        raster.createCommands()
+        self.assertIn("TWS" + "".join(" 1 %d 1" % (column * 200 + 1)
+                                      for column in range(10)) + "\n",
+                      raster.commands)
+
+class TestWaveTableRate(PIControllerTest):
+    """TestWaveTableRate - the coarsest rate that keeps MOVETIME and EXPOSURE"""
+
+    def test_choose_rate(self):
+        # 20 ms per point
+        self.assertEqual(WaveTableRate.choose_rate([40, 100], 1.0), (400, [2, 5]))
+        # Nothing gets this close, so the nearest
+        self.assertEqual(WaveTableRate.choose_rate([0.001], 1.0), (1, [1]))
+        # No move at all
+        self.assertEqual(WaveTableRate.choose_rate([0, 100], 1.0), (2000, [0, 1]))
+        self.assertRaises(ValueError, WaveTableRate.choose_rate, [-1, 100], 1.0)
+
+    def test_default_rate(self):
+        # Without AUTO_RATE, 1 ms per point as always
+        self.scan.insert_params(dict(scan_params, NX=10, NY=4))
+        self.scan.get_scan_parameters()
+        self.scan.prepare_setup_commands()
+        self.assertEqual(self.scan.table_points[TABLEY], 10 * 140 + 2 * 40)
+        self.assertIn("WTR 0 20 1\nRTR 40\n", self.scan.setup_commands.get())
+
+    def test_short_segments(self):
+        # Rounded to whole points rather than cut short
+        self.scan.insert_params(dict(scan_params, MOVETIME=0.6, EXPOSURE=99.6))
+        self.scan.get_scan_parameters()
+        self.assertEqual((self.scan.params["MOVE_POINTS"],
+                          self.scan.params["EXPOSURE_POINTS"]), (1, 100))
+
+        # Less than a point would be a segment the controller rejects
+        self.scan.insert_params(dict(scan_params, MOVETIME=0.4))
+        self.scan.get_scan_parameters()
+        self.scan.prepare_setup_commands()
+        self.assertFalse(self.scan.verify_parameters())
+
+    def test_auto_rate(self):
+        self.scan.insert_params(dict(scan_params, NX=10, NY=4, AUTO_RATE=1,
+                                     RATE_TOLERANCE=1.0))
+        self.scan.get_scan_parameters()
+        self.scan.prepare_setup_commands()
+
+        # Each step is 7 points rather than 140, the Y move 2
+        self.assertEqual(self.scan.table_points[TABLEY], 10 * 7 + 2 * 2)
+        self.assertIn("WTR 0 400 1\nRTR 800\n", self.scan.setup_commands.get())
+
+class TestQueueMemory(PIControllerTest):
+    """TestQueueMemory - the next scan has to fit beside the one playing"""
+
+    def test_preload_memory(self):
+        self.scan.insert_params(dict(scan_params, NX=10, NY=4))
+        self.scan.configure_scan()
+        queue = ScanQueue.ScanQueue(self.scan)
+        self.assertTrue(queue.preload({"X0": 20.0}, 1))
+
+        # Fits on its own, but not with what is playing
+        self.scan.table_points[TABLEX] = E727_AVAILALBE_DATAPOINTS - 100
+        self.assertFalse(queue.preload({"X0": 30.0}, 0))
+        self.assertEqual(self.scan.resident_points, 0)
+        self.assertTrue(self.scan.verify_parameters())
+
+class TestSplitResponses(PIControllerTest):
+    """TestSplitResponses - frame received data into GCS responses"""
+
+    def test_split_responses(self):
+        responses, remainder = PIController.split_responses(
+            "0\n1=1.0 \n3=2.0\n2=")
+        self.assertEqual(responses, ["0", "1=1.0 \n3=2.0"])
+        self.assertEqual(remainder, "2=")
+class TestConfigureWorker(PIControllerTest):
+    """TestConfigureWorker - configure in the background, merging requests"""
+
+    def test_merge_and_start(self):
+        self.scan.records = None
+        self.scan.insert_params(dict(scan_params, NX=10, NY=4))
+        self.controller.cooperative = True
+        worker = ConfigureWorker.ConfigureWorker(self.scan)
+
+        configures = []
+        starts = []
+        configure_scan = self.scan.configure_scan
+        def slow_configure():
+            # Another configure and a start arrive during the upload
+            configures.append(self.scan.get_state())
+            if len(configures) == 1:
+                worker.configure()
+                worker.configure()
+                worker.start()
+                self.assertEqual(starts, [])
+            return configure_scan()
+        self.scan.configure_scan = slow_configure
+        self.scan.start_scan = lambda: starts.append(self.scan.get_state())
+
+        worker.configure()
+        while worker.configuring:
+            ConfigureWorker.cothread.Yield()
+        self.assertEqual(len(configures), 2)
+        self.assertEqual(starts, [STATE_READY])
+
+    def test_call_in_background(self):
+        caller = ConfigureWorker.threading.current_thread().name
+        def thread_name(suffix):
+            return ConfigureWorker.threading.current_thread().name + suffix
+        self.assertEqual(ConfigureWorker.call_in_background(
+            True, thread_name, "!"), caller + "!")
+        self.assertNotEqual(ConfigureWorker.call_in_background(
+            False, thread_name, "!"), caller + "!")
+
+        def fail():
+            raise ValueError("upload failed")
+        self.assertRaises(ValueError, ConfigureWorker.call_in_background, False, fail)
+class TestCothreadLock(PIControllerTest):
+    """TestCothreadLock - keep other cothreads out, but not the holder"""
+
+    def test_exclusion(self):
+        cothread = CothreadController.cothread
+        lock = CothreadController.CothreadLock()
+        released = cothread.Event()
+        def hold():
+            with lock:
+                released.Wait()
+        holder = cothread.Spawn(hold, raise_on_wait=True)
+        cothread.Yield()
+
+        # A poller in another cothread keeps out of the way
+        self.assertFalse(lock.acquire(False))
+        released.Signal()
+        holder.Wait()
+
+        self.assertTrue(lock.acquire(False))
+        self.assertTrue(lock.acquire(False))
+        lock.release()
+        lock.release()
+
+
 if __name__ == "__main__":
 
     logging.basicConfig(level=logging.DEBUG)
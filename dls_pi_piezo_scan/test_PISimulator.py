@@ -0,0 +1,509 @@
+#!/bin/env dls-python
+import PISimulator
+import PIController
+import DataRecorderReader
+import RecordingWriter
+import ScanMonitor
+import ScanManager
+import PIStepScan
+import ScanQueue
+import ConfigureWorker
+import SessionTrace
+
+from PIConstants import *
+
+import unittest
+import tempfile
+import shutil
+import json
+import os
+import threading
+import time
+import socket
+
+import logging
+
+
+class PISimulatorTest(unittest.TestCase):
+    """A"""
+
+    def setUp(self):
+        self.simulator = PISimulator.PISimulator(speed=1000.0)
+
+    def tearDown(self):
+        self.simulator = None
+
+    def send(self, commands):
+        replies, remainder = self.simulator.receive(commands)
+        self.assertEqual(remainder, "")
+        return replies
+
+class TestErrors(PISimulatorTest):
+    """TestErrors - bad commands set the GCS error code until ERR? reads it"""
+
+    def test_unknown_command(self):
+        self.assertEqual(self.send("FOO 1\nERR?\nERR?\n"),
+                         [str(GCS_ERROR_UNKNOWN_COMMAND), str(GCS_NO_ERROR)])
+
+    def test_move_without_servo(self):
+        self.assertEqual(self.send("MOV 1 10\nERR?\n"),
+                         [str(GCS_ERROR_MOVE_WITHOUT_SERVO)])
+
+    def test_move_out_of_limits(self):
+        self.assertEqual(self.send("SVO 1 1\nMOV 1 1000\nERR?\n"),
+                         [str(GCS_ERROR_POS_OUT_OF_LIMITS)])
+
+class TestWaveTableMemory(PISimulatorTest):
+    """TestWaveTableMemory - wave tables share the controller memory"""
+
+    def test_memory_full(self):
+        self.simulator.datapoints = 1000
+        self.send("WAV 1 X LIN 600 0 0 600 0 0\n")
+        self.send("WAV 2 X LIN 400 0 0 400 0 0\n")
+        self.assertEqual(self.send("ERR?\n"), [str(GCS_NO_ERROR)])
+        self.assertEqual(self.simulator.used_datapoints(), 1000)
+
+        self.send("WAV 2 & LIN 1 0 0 1 0 0\n")
+        self.assertEqual(self.send("ERR?\n"), [str(GCS_ERROR_PARAM_OUT_OF_RANGE)])
+
+        # Replacing a table frees its points first
+        self.send("WAV 1 X LIN 600 0 0 600 0 0\n")
+        self.assertEqual(self.send("ERR?\n"), [str(GCS_NO_ERROR)])
+
+class TestWaveGenerator(PISimulatorTest):
+    """TestWaveGenerator - generator output follows the wave table"""
+
+    def test_steps_from_last_position(self):
+        self.send("SVO 1 1\n"
+                  "WAV 1 X LIN 10 0 0 10 0 0\n"
+                  "WAV 1 & LIN 10 0 2.5 10 0 0\n"
+                  "WSL 1 1\nWGC 1 3\nWOS 1 10\nWTR 0 1 1\nWGO 1 257\n")
+        run = self.simulator.runs[1]
+        output = run.output(run.start_cycle + PISimulator.numpy.array([0, 15, 25, 55, 100]))
+        self.assertEqual(list(output), [10.0, 12.5, 12.5, 17.5, 17.5])
+
+    def test_generator_status(self):
+        now = [0.0]
+        self.simulator = PISimulator.PISimulator(clock=lambda: now[0])
+        self.send("SVO 1 1\nWAV 1 X LIN 10 0 0 10 0 0\nWGC 1 3\nWGO 1 1\n")
+        now[0] = 25 * E727_SERVO_CYCLE
+        self.assertEqual(self.send("\x09WGN? 1\nWGI? 1\n"), ["1", "1=2", "1=5"])
+        now[0] = 30 * E727_SERVO_CYCLE
+        self.assertEqual(self.send("\x09"), ["0"])
+
+class SimulatorServerTest(unittest.TestCase):
+    """A real PIController talking to the server"""
+
+    def setUp(self):
+        self.server = PISimulator.PISimulatorServer(("127.0.0.1", 0), latency=0.0,
+                                                    bandwidth=0.0)
+        host, port = self.server.start()
+        self.controller = PIController.PIController(host, port)
+
+    def tearDown(self):
+        self.controller.socket.close()
+        self.server.stop()
+
+class TestSimulatorServer(SimulatorServerTest):
+    """TestSimulatorServer - a real PIController talking to the server"""
+
+    def test_upload(self):
+        commands = "SVO 1 1\n" + "WAV 1 & LIN 40 0 1.0 40 0 0\n" * 100
+        self.assertTrue(self.controller.send_multiline(commands, batch=True))
+        self.assertEqual(self.server.simulator.tables[1].points, 4000)
+
+    def test_upload_error(self):
+        self.assertFalse(self.controller.send_multiline("WAV 99 X LIN 1 0 0 1 0 0",
+                                                        batch=True))
+
+    def test_error_line(self):
+        lines = ["WAV 1 & LIN 10 0 0 10 0 0"] * 20
+        lines[10] = "WAV 99 X LIN 1 0 0 1 0 0"
+        self.controller.checkpoint_lines = 4
+        self.assertFalse(self.controller.send_multiline("\n".join(lines)))
+        self.assertEqual((self.controller.error_line, self.controller.error_last_line,
+                          self.controller.error_code),
+                         (9, 12, GCS_ERROR_PARAM_OUT_OF_RANGE))
+        self.assertEqual(self.controller.error_command, "\n".join(lines[8:12]))
+
+        # Batched uploads find the lines within the chunk that failed.
+        # Three lines fit in a chunk, with a checkpoint after them.
+        self.controller.max_outstanding_bytes = 100
+        self.assertFalse(self.controller.send_multiline("\n".join(lines), batch=True))
+        self.assertEqual((self.controller.error_line, self.controller.error_last_line),
+                         (10, 12))
+
+        # A checkpoint after every line finds the line itself
+        self.controller.checkpoint_lines = 1
+        for batch in (False, True):
+            self.assertFalse(self.controller.send_multiline("\n".join(lines), batch=batch))
+            self.assertEqual((self.controller.error_line, self.controller.error_last_line),
+                             (11, 11))
+            self.assertEqual(self.controller.error_command, lines[10])
+        self.assertTrue(self.controller.send_multiline("SVO 1 1\nSVO 2 1"))
+        self.assertEqual(self.controller.error_line, 0)
+
+    def test_memory_full_line(self):
+        # Line 11 is the first that doesn't fit
+        lines = ["WAV 1 X LIN 10 0 0 10 0 0"] + ["WAV 1 & LIN 10 0 0 10 0 0"] * 19
+        self.controller.checkpoint_lines = 1
+        self.controller.max_outstanding_bytes = 100
+        simulator = self.server.simulator
+        simulator.datapoints = 100
+        for batch in (False, True):
+            self.assertFalse(self.controller.send_multiline("\n".join(lines), batch=batch))
+            self.assertEqual((self.controller.error_line, self.controller.error_code),
+                             (11, GCS_ERROR_PARAM_OUT_OF_RANGE))
+            # No line was sent twice
+            self.assertEqual(simulator.tables[1].points, 100)
+
+    def test_poll_during_configure(self):
+        scan = PIStepScan.PIStepScan(self.controller)
+        scan.insert_params({"STATE": STATE_NOT_CONFIGRED, "NX": 20, "NY": 4, "NZ": 1,
+                            "DX": 0.5, "DY": 0.5, "DZ": 0.5,
+                            "X0": 10.0, "Y0": 10.0, "Z0": 10.0, "THETA": 10.0,
+                            "MOVETIME": 40, "EXPOSURE": 100,
+                            "ENCODING": ENCODING_EXPLICIT})
+        states = []
+
+        def configure():
+            for i in range(3):
+                scan.forget_upload()
+                scan.configure_scan()
+                states.append(scan.get_state())
+
+        # Configure on a thread, as ConfigureWorker does for a blocking
+        # controller, while polling like ScanMonitor
+        worker = threading.Thread(target=configure)
+        worker.start()
+        while worker.is_alive():
+            status, cycles = self.controller.query_pipelined(
+                [ScanMonitor.WAVE_GENERATOR_STATUS, "WGN? 1"])
+            self.assertEqual((status, cycles), ("0", "1=0"))
+        worker.join()
+        self.assertEqual(states, [STATE_READY] * 3)
+
+class TestLinkLatency(SimulatorServerTest):
+    """TestLinkLatency - replies to commands sent together share one trip"""
+
+    def setUp(self):
+        self.server = PISimulator.PISimulatorServer(("127.0.0.1", 0), latency=0.05,
+                                                    bandwidth=0.0)
+        host, port = self.server.start()
+        self.controller = PIController.PIController(host, port)
+
+    def test_pipelined_latency(self):
+        start = time.time()
+        self.assertEqual(self.controller.query_pipelined(["ERR?"] * 10), ["0"] * 10)
+        self.assertLess(time.time() - start, 0.2)
+
+class TestReplyTimeout(unittest.TestCase):
+    """TestReplyTimeout - give up on a controller that has stopped answering"""
+
+    def setUp(self):
+        # Accepts the connection but never answers
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(1)
+        host, port = self.listener.getsockname()
+        self.controller = PIController.PIController(host, port, timeout=0.2)
+
+    def tearDown(self):
+        self.controller.socket.close()
+        self.listener.close()
+
+    def test_timeout(self):
+        for call in (lambda: self.controller.check_error(),
+                     lambda: self.controller.query_pipelined(["ERR?", "WGN? 1"]),
+                     lambda: self.controller.query_multiline("DRR? 1 1 1"),
+                     lambda: self.controller.send_multiline("SVO 1 1"),
+                     lambda: self.controller.send_multiline("SVO 1 1", batch=True)):
+            start = time.time()
+            self.assertRaises(PIController.ControllerTimeout, call)
+            self.assertLess(time.time() - start, 1.0)
+
+class TestSessionTrace(SimulatorServerTest):
+    """TestSessionTrace - record a session with the server, then replay it"""
+
+    def setUp(self):
+        self.server = PISimulator.PISimulatorServer(("127.0.0.1", 0), latency=0.01,
+                                                    bandwidth=0.0)
+        host, port = self.server.start()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "session.jsonl")
+        self.controller = PIController.PIController(
+            host, port, checkpoint_lines=4,
+            sock=SessionTrace.RecordingSocket(
+                socket.socket(socket.AF_INET, socket.SOCK_STREAM), self.path))
+
+    def tearDown(self):
+        SimulatorServerTest.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def session(self, controller):
+        lines = ["SVO 1 1"] + ["WAV 1 & LIN 10 0 0 10 0 0"] * 10
+        uploaded = controller.send_multiline("\n".join(lines))
+        lines[6] = "WAV 99 X LIN 1 0 0 1 0 0"
+        failed = controller.send_multiline("\n".join(lines))
+        return (uploaded, failed, controller.error_line,
+                controller.query_pipelined([ScanMonitor.WAVE_GENERATOR_STATUS, "WGN? 1"]))
+
+    def test_replay(self):
+        recorded = self.session(self.controller)
+        self.controller.socket.close()
+        # The bad line 7 is after the checkpoint at line 4
+        self.assertEqual(recorded[:3], (True, False, 5))
+        events = SessionTrace.read_trace(self.path)
+        self.assertEqual(events[0]["op"], "connect")
+
+        for speed in (None, 1.0):
+            replay = SessionTrace.ReplaySocket(self.path, speed=speed)
+            start = time.time()
+            self.assertEqual(self.session(PIController.PIController(
+                "replay", 0, checkpoint_lines=4, sock=replay)), recorded)
+            self.assertIsNone(replay.mismatch)
+            elapsed = time.time() - start
+        # Each round trip took the simulator's latency, and the session
+        # waits for at least three: each upload and the query
+        self.assertGreater(elapsed, 0.03)
+
+class TestDataRecorder(SimulatorServerTest):
+    """TestDataRecorder - read the recorder back into arrays"""
+
+    def test_read_recorder(self):
+        self.controller.send_multiline("DRC 1 1 1\nDRC 2 2 1\nSVO 1 1\n"
+                                       "WAV 1 X LIN 100 10 0 100 0 0\nWGO 1 1")
+        reader = DataRecorderReader.DataRecorderReader(self.controller, channels=(1, 2),
+                                                       chunk_points=30)
+        data = reader.read(100)
+        self.assertEqual(data.shape, (100, 2))
+        self.assertEqual(list(data[:3, 0]), [0.0, 0.1, 0.2])
+        self.assertEqual(reader.sample_time(), E727_SERVO_CYCLE)
+
+    def test_recording_stopped(self):
+        # The recorder fills up at 50 points, after the generator has stopped
+        self.server.simulator.recorder_points = 50
+        self.controller.send_multiline("DRC 1 1 1\nSVO 1 1\n"
+                                       "WAV 1 X LIN 10 10 0 10 0 0\nWGC 1 1\nWGO 1 1")
+        reader = DataRecorderReader.DataRecorderReader(self.controller, channels=(1,),
+                                                       chunk_points=30, poll_interval=0.01)
+        self.assertEqual(reader.read(100).shape, (50, 1))
+
+    def test_write_recording(self):
+        self.controller.send_multiline("DRC 1 1 1\nSVO 1 1\n"
+                                       "WAV 1 X LIN 100 10 0 100 0 0\nWGO 1 1")
+        reader = DataRecorderReader.DataRecorderReader(self.controller, channels=(1,),
+                                                       chunk_points=30)
+        directory = tempfile.mkdtemp()
+        try:
+            writer = RecordingWriter.create_writer(FILE_FORMAT_NPY, directory, "scan", 100, 1)
+            reader.read(100, writer=writer)
+            writer.close({"NX": 10})
+
+            data = DataRecorderReader.numpy.load(os.path.join(directory, "scan.npy"),
+                                                 mmap_mode="r")
+            self.assertEqual(data.shape, (100, 1))
+            self.assertEqual(data[99, 0], 9.9)
+            with open(os.path.join(directory, "scan.json")) as metadata:
+                self.assertEqual(json.load(metadata), {"NX": 10, "points": 100})
+        finally:
+            shutil.rmtree(directory)
+
+    def test_save_when_finished(self):
+        self.controller.send_multiline("DRC 1 1 1\nSVO 1 1\n"
+                                       "WAV 1 X LIN 100 10 0 100 0 0\nWGO 1 1")
+        scan = PIStepScan.PIStepScan(self.controller)
+        scan.insert_params({"STATE": STATE_NOT_CONFIGRED, "NX": 4, "NY": 2, "NZ": 1,
+                            "DX": 0.5, "DY": 0.5, "DZ": 0.5,
+                            "X0": 10.0, "Y0": 10.0, "Z0": 10.0, "THETA": 0.0,
+                            "MOVETIME": 40, "EXPOSURE": 100})
+        scan.get_scan_parameters()
+        directory = tempfile.mkdtemp()
+        try:
+            scan.file_records = {"FILE_PATH": PIStepScan.Param(directory),
+                                 "FILE_NAME": PIStepScan.Param("scan"),
+                                 "FILE_FORMAT": PIStepScan.Param(FILE_FORMAT_NPY),
+                                 "AUTO_SAVE": PIStepScan.Param(1)}
+            path = os.path.join(directory, "scan.npy")
+            scan.scan_finished()
+            for i in range(100):
+                if os.path.exists(os.path.join(directory, "scan.json")):
+                    break
+                ScanMonitor.cothread.Sleep(0.01)
+
+            data = DataRecorderReader.numpy.load(path, mmap_mode="r")
+            self.assertEqual(data.shape[1], len(DataRecorderReader.DEFAULT_CHANNELS))
+            self.assertGreater(data.shape[0], 0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_split_reply(self):
+        header, values = DataRecorderReader.split_reply(
+            "# DIM = 2 \n# NAME0 = Axis 1 \n# NAME1 = Axis 2 \n# END_HEADER \n1.0 2.0 \n3.0 4.0")
+        self.assertEqual(header, {"DIM": "2", "NAMES": ["Axis 1", "Axis 2"]})
+        self.assertEqual(list(DataRecorderReader.numpy.fromstring(values, sep=" ")),
+                         [1.0, 2.0, 3.0, 4.0])
+class MonitoredScan():
+    """Just enough of a PIStepScan for a ScanMonitor to follow"""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.table_points = {1: 10}
+        self.status = {}
+        self.state = STATE_SCAN_RUNNING
+
+    def generator_cycles(self):
+        return {1: 4}
+
+    def set_status(self, name, value):
+        self.status[name] = value
+
+    def get_state(self):
+        return self.state
+
+    def set_state(self, new_state):
+        self.state = new_state
+
+    def scan_finished(self):
+        self.finished = True
+
+class TestScanMonitor(SimulatorServerTest):
+    """TestScanMonitor - follow a scan with pipelined status queries"""
+
+    def test_poll(self):
+        now = [0.0]
+        self.server.simulator.clock = lambda: now[0]
+        self.server.simulator.epoch = 0.0
+        self.controller.send_multiline("SVO 1 1\nWAV 1 X LIN 10 0 0 10 0 0\n"
+                                       "WGC 1 4\nWGO 1 1")
+        scan = MonitoredScan(self.controller)
+        monitor = ScanMonitor.ScanMonitor(scan)
+        monitor.table_points = {1: 10}
+        monitor.total_points = {1: 40}
+        monitor.start_time = ScanMonitor.time.time()
+
+        now[0] = 10 * E727_SERVO_CYCLE
+        monitor.poll()
+        self.assertEqual(scan.status["PROGRESS"], 25.0)
+        self.assertEqual(scan.state, STATE_SCAN_RUNNING)
+
+        now[0] = 40 * E727_SERVO_CYCLE
+        monitor.poll()
+        self.assertEqual(scan.status, {"PROGRESS": 100.0, "ETA": 0.0})
+        self.assertEqual(scan.state, STATE_READY)
+        self.assertTrue(scan.finished)
+
+class TestScanManager(unittest.TestCase):
+    """TestScanManager - configure and start scans on two controllers together"""
+
+    def setUp(self):
+        self.servers = []
+        self.manager = ScanManager.ScanManager()
+        for name in ("A", "B"):
+            server = PISimulator.PISimulatorServer(("127.0.0.1", 0), latency=0.0,
+                                                   bandwidth=0.0)
+            host, port = server.start()
+            self.servers.append(server)
+            scan = PIStepScan.PIStepScan(PIController.PIController(host, port))
+            scan.insert_params({"STATE": STATE_NOT_CONFIGRED, "NX": 10, "NY": 4, "NZ": 1,
+                                "DX": 0.5, "DY": 0.5, "DZ": 0.5,
+                                "X0": 10.0, "Y0": 10.0, "Z0": 10.0, "THETA": 0.0,
+                                "MOVETIME": 40, "EXPOSURE": 100})
+            self.manager.add(name, scan)
+
+    def tearDown(self):
+        for scan in self.manager.scans.values():
+            scan.controller.socket.close()
+        for server in self.servers:
+            server.stop()
+
+    def test_aggregate_state(self):
+        self.assertEqual(ScanManager.aggregate_state([STATE_READY, STATE_ERROR]),
+                         STATE_ERROR)
+        self.assertEqual(ScanManager.aggregate_state([STATE_READY, STATE_SCAN_RUNNING]),
+                         STATE_SCAN_RUNNING)
+        self.assertEqual(ScanManager.aggregate_state([STATE_READY, STATE_NOT_CONFIGRED]),
+                         STATE_NOT_CONFIGRED)
+
+    def test_configure_and_start(self):
+        self.assertFalse(self.manager.start_scan())
+        self.assertTrue(self.manager.configure_scan())
+        for server, scan in zip(self.servers, self.manager.scans.values()):
+            self.assertEqual(scan.get_state(), STATE_READY)
+            self.assertEqual(server.simulator.used_datapoints(),
+                             scan.calculate_required_data_points())
+
+        for scan in self.manager.scans.values():
+            scan.controller.send_multiline("SVO 1 1\nSVO 2 1\nSVO 3 1")
+        self.assertTrue(self.manager.start_scan())
+        for server in self.servers:
+            self.assertEqual(sorted(server.simulator.runs), [1, 2])
+
+class TestScanQueue(SimulatorServerTest):
+    """TestScanQueue - load each scan into the spare tables while the last one runs"""
+
+    def setUp(self):
+        self.server = PISimulator.PISimulatorServer(("127.0.0.1", 0),
+                                                    PISimulator.PISimulator(speed=1000.0))
+        host, port = self.server.start()
+        self.controller = PIController.PIController(host, port)
+
+    def queued_scan(self):
+        scan = PIStepScan.PIStepScan(self.controller)
+        scan.insert_params({"STATE": STATE_NOT_CONFIGRED, "NX": 4, "NY": 2, "NZ": 1,
+                            "DX": 0.5, "DY": 0.5, "DZ": 0.5,
+                            "X0": 10.0, "Y0": 10.0, "Z0": 10.0, "THETA": 10.0,
+                            "MOVETIME": 40, "EXPOSURE": 100,
+                            "SCAN_MODE": SCAN_MODE_ROTATED})
+        self.controller.send_multiline("SVO 1 1\nSVO 2 1\nSVO 3 1")
+        return scan
+
+    def test_queue(self):
+        scan = self.queued_scan()
+        uploads = []
+        send_setup_commands = scan.send_setup_commands
+        def send_in_thread(**kwargs):
+            uploads.append(threading.current_thread().name)
+            return send_setup_commands(**kwargs)
+        scan.send_setup_commands = send_in_thread
+
+        queue = ScanQueue.ScanQueue(scan)
+        queue.extend([{"X0": 20.0}, {"X0": 30.0}, {"X0": 40.0, "NX": 5}])
+        queue.run()
+        self.assertEqual(queue.done, 3)
+        # The blocking controller was only used away from the IOC's cothreads
+        self.assertEqual(len(uploads), 6)
+        self.assertNotIn(threading.current_thread().name, uploads)
+        self.assertEqual(scan.param_overrides, {})
+
+        # Banks in turn, starting with the spare one
+        simulator = self.server.simulator
+        self.assertEqual(scan.table_bank, 1)
+        self.assertEqual(simulator.selected_table[AXISX], TABLEX + TABLES_PER_BANK)
+        self.assertEqual(simulator.offset[AXISX], 40.0)
+        self.assertEqual(simulator.tables[TABLEX + TABLES_PER_BANK].points,
+                         scan.table_points[TABLEX])
+        # The scan before, with one less column, is still in the other bank
+        self.assertLess(simulator.tables[TABLEX].points, scan.table_points[TABLEX])
+
+    def test_configuring(self):
+        scan = self.queued_scan()
+        scan.worker = ConfigureWorker.ConfigureWorker(scan)
+        scan.worker.configuring = True
+
+        queue = ScanQueue.ScanQueue(scan)
+        queue.extend([{"X0": 20.0}, {"X0": 30.0}])
+        queue.start()
+        self.assertFalse(queue.running)
+
+        # Nor does a queue already running load over the configure
+        queue.run()
+        self.assertEqual(queue.done, 0)
+        self.assertEqual(len(queue.entries), 0)
+        self.assertEqual(scan.table_bank, 0)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()